@@ -0,0 +1,203 @@
+import email.utils
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+from requests import Response
+
+from metrics import metrics
+
+# status codes that signal an overloaded or temporarily unavailable server
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class EndpointStats:
+	"""Request statistics of a single api endpoint"""
+
+	def __init__(self):
+		self.requests: int = 0
+		self.errors: int = 0
+		self.throttled: int = 0
+		self.retries: int = 0
+		self.total_latency: float = 0
+		self.max_latency: float = 0
+
+	@property
+	def mean_latency(self) -> float:
+		return self.total_latency / self.requests if self.requests > 0 else 0
+
+	def __str__(self):
+		return f"requests: {self.requests}, errors: {self.errors}, throttled: {self.throttled}, retries: {self.retries}, mean latency: {self.mean_latency:.3f}s, max latency: {self.max_latency:.3f}s"
+
+
+class AdaptiveController:
+	"""
+	AIMD (additive increase, multiplicative decrease) controller for api requests
+
+	While the responses are fast and healthy the number of in-flight requests is increased and the delay between requests is decreased.
+	When the server answers with 429/5xx or the latency degrades, the concurrency is cut and the delay is increased.
+	Throttled requests are retried with jittered exponential backoff (or after the time requested by the Retry-After header),
+	the backoff pauses all requests that share the controller.
+	"""
+
+	def __init__(
+			self, initial_concurrency: int = 2, min_concurrency: int = 1, max_concurrency: int = 16,
+			initial_interval: float = 0.5, min_interval: float = 0.05, max_interval: float = 10.0,
+			additive_step: float = 0.05, multiplicative_factor: float = 0.5, target_latency: float = 2.0,
+			max_retries: int = 5, base_backoff: float = 1.0, max_backoff: float = 120.0
+	):
+		"""
+		:param initial_concurrency: max number of in-flight requests at the start
+		:param min_concurrency:
+		:param max_concurrency:
+		:param initial_interval: min seconds between the start of two requests at the start
+		:param min_interval:
+		:param max_interval:
+		:param additive_step: seconds the interval is decreased by after a healthy response
+		:param multiplicative_factor: factor the concurrency is multiplied (and the interval divided) by after an unhealthy response
+		:param target_latency: responses that take longer are considered unhealthy
+		:param max_retries: max number of retries of a throttled or failed request
+		:param base_backoff: seconds of the first backoff
+		:param max_backoff: max seconds of a backoff
+		"""
+		self.min_concurrency = min_concurrency
+		self.max_concurrency = max_concurrency
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.additive_step = additive_step
+		self.multiplicative_factor = multiplicative_factor
+		self.target_latency = target_latency
+		self.max_retries = max_retries
+		self.base_backoff = base_backoff
+		self.max_backoff = max_backoff
+
+		self.concurrency: float = initial_concurrency
+		self.interval: float = initial_interval
+		self.stats: Dict[str, EndpointStats] = {}
+
+		self._condition = threading.Condition()
+		self._in_flight: int = 0
+		self._healthy_streak: int = 0
+		self._next_start: float = 0
+		self._paused_until: float = 0
+
+	def request(self, endpoint: str, method: str, url: str, **kwargs) -> Response:
+		"""
+		Send the request, retry it if the server is overloaded
+
+		:param endpoint: name of the endpoint used for the statistics, e.g. "cf:/v1/mods/{id}"
+		:param method: http method
+		:param url:
+		:param kwargs: passed to requests.request
+		:return: response of the last attempt
+		:raises requests.RequestException: if the last attempt failed with a connection error, other request errors are raised without a retry
+		"""
+		stats = self.stats.setdefault(endpoint, EndpointStats())
+		attempt = 0
+		while True:
+			self._acquire()
+			start_time = time.perf_counter()
+			try:
+				response = requests.request(method, url, **kwargs)
+			except (requests.ConnectionError, requests.Timeout):
+				self._release(endpoint, time.perf_counter() - start_time, healthy=False)
+				stats.errors += 1
+				metrics.inc("api_requests_total", endpoint=endpoint, status="error")
+				if attempt >= self.max_retries:
+					raise
+				self._backoff(attempt, None)
+			except Exception:
+				# not retried (e.g. an invalid url or a broken redirect chain), but the slot has to be released
+				self._release(endpoint, time.perf_counter() - start_time, healthy=False)
+				stats.errors += 1
+				metrics.inc("api_requests_total", endpoint=endpoint, status="error")
+				raise
+			else:
+				latency = time.perf_counter() - start_time
+				metrics.inc("api_requests_total", endpoint=endpoint, status=response.status_code)
+				metrics.observe("api_request_duration_seconds", latency, endpoint=endpoint)
+				throttled = response.status_code in RETRY_STATUS_CODES
+				self._release(endpoint, latency, healthy=not throttled and latency <= self.target_latency)
+				if not throttled:
+					if response.status_code >= 400:
+						stats.errors += 1
+					return response
+
+				stats.throttled += 1
+				if attempt >= self.max_retries:
+					return response
+				response.close()  # releases the connection of streamed responses
+				self._backoff(attempt, response.headers.get('Retry-After', None))
+
+			stats.retries += 1
+			metrics.inc("api_retries_total", endpoint=endpoint)
+			attempt += 1
+
+	def summary(self) -> str:
+		lines = [f"concurrency: {int(self.concurrency)}, interval: {self.interval:.3f}s"]
+		for endpoint, stats in sorted(self.stats.items()):
+			lines.append(f"{endpoint} -> {stats}")
+		return "\n".join(lines)
+
+	def _acquire(self):
+		with self._condition:
+			while True:
+				now = time.monotonic()
+				wait_until = max(self._paused_until, self._next_start)
+				if now < wait_until:
+					self._condition.wait(wait_until - now)
+				elif self._in_flight >= int(self.concurrency):
+					self._condition.wait()
+				else:
+					break
+			self._in_flight += 1
+			self._next_start = now + self.interval
+
+	def _release(self, endpoint: str, latency: float, healthy: bool):
+		stats = self.stats[endpoint]
+		with self._condition:
+			self._in_flight -= 1
+			stats.requests += 1
+			stats.total_latency += latency
+			stats.max_latency = max(stats.max_latency, latency)
+
+			if healthy:
+				self.interval = max(self.min_interval, self.interval - self.additive_step)
+				self._healthy_streak += 1
+				# increase the concurrency at most once per window of in-flight requests
+				if self._healthy_streak >= int(self.concurrency):
+					self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+					self._healthy_streak = 0
+			else:
+				self.interval = min(self.max_interval, max(self.interval, self.min_interval) / self.multiplicative_factor)
+				self.concurrency = max(self.min_concurrency, self.concurrency * self.multiplicative_factor)
+				self._healthy_streak = 0
+			self._condition.notify_all()
+
+	def _backoff(self, attempt: int, retry_after: Optional[str]):
+		delay = parse_retry_after(retry_after)
+		if delay is None:
+			delay = random.uniform(0.5, 1.0) * min(self.max_backoff, self.base_backoff * 2 ** attempt)
+
+		with self._condition:
+			self._paused_until = max(self._paused_until, time.monotonic() + delay)
+			self._condition.notify_all()
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+	"""
+	:param value: Retry-After header value, either delay in seconds or a http date
+	:return: seconds to wait
+	"""
+	if not value:
+		return None
+	try:
+		return max(0.0, float(value))
+	except ValueError:
+		pass
+	try:
+		return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+	except (TypeError, ValueError):
+		return None
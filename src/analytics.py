@@ -0,0 +1,198 @@
+# in-memory columnar engine for the download composition of all projects
+#
+# The snapshots are loaded once into integer NumPy arrays and the composition (total vs. dependant vs. direct downloads)
+# and the origin breakdown are computed for every project and timestamp in a few vectorized passes,
+# instead of running the db_util queries once per project (e.g. for leaderboards and cross-project reports).
+# The results are the same as the ones of db_util.get_project_downloads_by_composition / get_project_downloads_by_origin.
+import itertools
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dataset import Database
+
+import rollups
+
+MOD_PAGE_NAME = "CurseForge Mod Page"  # name of the direct downloads in the origin breakdown
+
+
+def _fetch_columns(db: Database, query: str, column_count: int) -> np.ndarray:
+	"""
+	:return: int64 array of shape (rows, column_count)
+	"""
+	rows = db.executable.exec_driver_sql(query).tuples()
+	return np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64).reshape(-1, column_count)
+
+
+def _pack(high: np.ndarray, low: np.ndarray) -> np.ndarray:
+	return (high.astype(np.int64) << 32) | low.astype(np.int64)
+
+
+def _group_sum(keys: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	:return: the unique keys (sorted) and the exact int64 sum of the values of every key
+	"""
+	if len(keys) == 0:
+		return keys, values
+	order = np.argsort(keys, kind='stable')
+	keys = keys[order]
+	starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+	return keys[starts], np.add.reduceat(values[order], starts)
+
+
+class DownloadAnalytics:
+	"""
+	Snapshot of the download stats of all projects as compact integer arrays
+
+	Projects and timestamps are mapped to dense indices (`project_ids[index]` / `timestamps[index]`),
+	thus a (timestamp, dependency, dependant) triple fits into a single int64 key.
+	"""
+
+	def __init__(self, db: Database, granularity: str = 'raw'):
+		"""
+		:param db:
+		:param granularity: 'raw' or the rollup (see rollups.GRANULARITIES) the breakdowns are computed for
+		"""
+		self.granularity = granularity
+		file_downloads_table = rollups.get_table_name('file_downloads', granularity)
+		project_downloads_table = rollups.get_table_name('project_downloads', granularity)
+
+		self.project_names: Dict[int, str] = {row['id']: row['name'] for row in db.query("SELECT id, name FROM project")}
+		# a dependant file counts once per dependency project, regardless of how many files of the dependency it includes
+		dependencies = _fetch_columns(db, "SELECT DISTINCT project_id, file_id, dependency_project_id FROM file_dependencies", 3)
+		file_downloads = _fetch_columns(db, f"""
+		SELECT b.project_id, b.file_id, b.download_count, b.timestamp
+			FROM (SELECT DISTINCT project_id, file_id FROM file_dependencies) a
+				JOIN {file_downloads_table} b ON b.project_id = a.project_id AND b.file_id = a.file_id
+		""", 4)
+		project_downloads = _fetch_columns(db, f"SELECT project_id, download_count, timestamp FROM {project_downloads_table}", 3)
+
+		# dependants without a project row are ignored like the join on the project table in dependant_downloads
+		known_projects = np.fromiter(self.project_names.keys(), dtype=np.int64, count=len(self.project_names))
+		dependencies = dependencies[np.isin(dependencies[:, 0], known_projects)]
+
+		self.project_ids: np.ndarray = np.unique(np.concatenate((dependencies[:, 0], dependencies[:, 2], project_downloads[:, 0])))
+		self.timestamps: np.ndarray = np.unique(np.concatenate((file_downloads[:, 3], project_downloads[:, 2])))
+
+		# dependency edges sorted by file, the edges of a file are edge_dependency[edge_starts[file]:edge_starts[file] + edge_counts[file]]
+		edge_files = _pack(dependencies[:, 0], dependencies[:, 1])
+		self.file_keys, edge_file_index = np.unique(edge_files, return_inverse=True)
+		order = np.argsort(edge_file_index, kind='stable')
+		self.edge_dependency = np.searchsorted(self.project_ids, dependencies[order, 2]).astype(np.int32)
+		self.edge_dependant = np.searchsorted(self.project_ids, dependencies[order, 0]).astype(np.int32)
+		self.edge_counts = np.bincount(edge_file_index, minlength=len(self.file_keys)).astype(np.int64)
+		self.edge_starts = np.concatenate(([0], np.cumsum(self.edge_counts)[:-1])).astype(np.int64)
+
+		download_files = _pack(file_downloads[:, 0], file_downloads[:, 1])
+		file_downloads = file_downloads[np.isin(download_files, self.file_keys)]
+		self.download_file = np.searchsorted(self.file_keys, _pack(file_downloads[:, 0], file_downloads[:, 1])).astype(np.int32)
+		self.download_timestamp = np.searchsorted(self.timestamps, file_downloads[:, 3]).astype(np.int32)
+		self.download_count = file_downloads[:, 2]
+
+		self.total_project = np.searchsorted(self.project_ids, project_downloads[:, 0]).astype(np.int32)
+		self.total_timestamp = np.searchsorted(self.timestamps, project_downloads[:, 2]).astype(np.int32)
+		self.total_count = project_downloads[:, 1]
+
+		self._dependant_downloads: Optional[Dict[str, np.ndarray]] = None
+		self._composition: Optional[Dict[str, np.ndarray]] = None
+
+	def _key(self, timestamp: np.ndarray, dependency: np.ndarray, dependant: np.ndarray) -> np.ndarray:
+		project_count = len(self.project_ids)
+		return (timestamp.astype(np.int64) * project_count + dependency) * project_count + dependant
+
+	def _unkey(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+		project_count = len(self.project_ids)
+		return keys // (project_count * project_count), keys // project_count % project_count, keys % project_count
+
+	def get_dependant_downloads(self) -> Dict[str, np.ndarray]:
+		"""
+		Downloads of every dependant by dependency and timestamp (the dependant_downloads view of all projects)
+
+		:return: columns timestamp, dependency_project_id, project_id (dependant), download_count sorted in this order
+		"""
+		if self._dependant_downloads is None:
+			# every snapshot of a dependant file is repeated once per dependency edge of the file
+			repeats = self.edge_counts[self.download_file]
+			row_index = np.repeat(np.arange(len(self.download_file)), repeats)
+			edge_offset = np.arange(len(row_index)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+			edge_index = self.edge_starts[self.download_file[row_index]] + edge_offset
+
+			keys = self._key(self.download_timestamp[row_index], self.edge_dependency[edge_index], self.edge_dependant[edge_index])
+			keys, download_count = _group_sum(keys, self.download_count[row_index])
+			timestamp, dependency, dependant = self._unkey(keys)
+			self._dependant_downloads = dict(
+				timestamp=self.timestamps[timestamp], dependency_project_id=self.project_ids[dependency],
+				project_id=self.project_ids[dependant], download_count=download_count,
+			)
+		return self._dependant_downloads
+
+	def get_composition(self) -> Dict[str, np.ndarray]:
+		"""
+		Composition of the downloads of every project that has dependants, by timestamp
+
+		:return: columns project_id, total_download_count, dependant_download_count, direct_download_count, timestamp sorted by timestamp and project
+		"""
+		if self._composition is None:
+			dependant_downloads = self.get_dependant_downloads()
+			project_count = len(self.project_ids)
+			timestamp = np.searchsorted(self.timestamps, dependant_downloads['timestamp'])
+			dependency = np.searchsorted(self.project_ids, dependant_downloads['dependency_project_id'])
+			keys, dependant_count = _group_sum(timestamp.astype(np.int64) * project_count + dependency, dependant_downloads['download_count'])
+
+			# only timestamps with a total download count of the project (inner join with project_downloads)
+			total_keys = self.total_timestamp.astype(np.int64) * project_count + self.total_project
+			total_order = np.argsort(total_keys, kind='stable')
+			position = np.minimum(np.searchsorted(total_keys[total_order], keys), max(0, len(total_keys) - 1))
+			found = total_keys[total_order][position] == keys if len(total_keys) > 0 else np.zeros(len(keys), dtype=bool)
+			keys, dependant_count = keys[found], dependant_count[found]
+			total_count = self.total_count[total_order][position[found]]
+
+			self._composition = dict(
+				project_id=self.project_ids[keys % project_count], total_download_count=total_count,
+				dependant_download_count=dependant_count, direct_download_count=total_count - dependant_count,
+				timestamp=self.timestamps[keys // project_count],
+			)
+		return self._composition
+
+	def get_origin(self) -> Dict[str, np.ndarray]:
+		"""
+		Origin of the downloads of every project by timestamp, the direct downloads are the row with project_id == dependency_project_id
+
+		:return: columns dependency_project_id, project_id, download_count, percentage (NaN if the downloads of the timestamp sum to 0), timestamp
+		"""
+		dependant_downloads = self.get_dependant_downloads()
+		composition = self.get_composition()
+		dependency_project_id = np.concatenate((dependant_downloads['dependency_project_id'], composition['project_id']))
+		timestamp = np.concatenate((dependant_downloads['timestamp'], composition['timestamp']))
+		download_count = np.concatenate((dependant_downloads['download_count'], composition['direct_download_count']))
+
+		project_count = len(self.project_ids)
+		keys = np.searchsorted(self.timestamps, timestamp).astype(np.int64) * project_count + np.searchsorted(self.project_ids, dependency_project_id)
+		unique_keys, totals = _group_sum(keys, download_count)
+		total = totals[np.searchsorted(unique_keys, keys)]
+		percentage = np.full(len(download_count), np.nan)
+		np.divide(100 * download_count.astype(np.float64), total, out=percentage, where=total != 0)
+		return dict(
+			dependency_project_id=dependency_project_id, project_id=np.concatenate((dependant_downloads['project_id'], composition['project_id'])),
+			download_count=download_count, percentage=percentage, timestamp=timestamp,
+		)
+
+	def get_project_downloads_by_composition(self, mod_id: int) -> List[dict]:
+		"""Rows of db_util.get_project_downloads_by_composition"""
+		composition = self.get_composition()
+		mask = composition['project_id'] == mod_id
+		return [
+			dict(project_id=int(project_id), total_download_count=int(total), dependant_download_count=int(dependant), direct_download_count=int(direct), timestamp=int(timestamp))
+			for project_id, total, dependant, direct, timestamp in zip(*(composition[column][mask] for column in composition))
+		]
+
+	def get_project_downloads_by_origin(self, mod_id: int) -> List[dict]:
+		"""Rows of db_util.get_project_downloads_by_origin"""
+		origin = self.get_origin()
+		mask = origin['dependency_project_id'] == mod_id
+		return [
+			dict(
+				project_id=int(project_id), name=MOD_PAGE_NAME if project_id == mod_id else self.project_names.get(int(project_id)),
+				download_count=int(count), percentage=None if np.isnan(percentage) else float(percentage), timestamp=int(timestamp)
+			)
+			for project_id, count, percentage, timestamp in zip(origin['project_id'][mask], origin['download_count'][mask], origin['percentage'][mask], origin['timestamp'][mask])
+		]
@@ -0,0 +1,107 @@
+# scanning and parsing of a local mirror of modpack archives, for the bulk ingestion into the dependencies db
+# (see DependencyResolver.ingest_archive_mirror)
+#
+# An archive is mapped to its CurseForge file by (in this order):
+#   sidecar      json file named like the archive + ".json", e.g. `pack-1.2.zip.json` -> {"project_id": 123, "file_id": 456}
+#   file name    `<project id>_<file id>`, optionally followed by `_<anything>` or an extension, e.g. `123_456.zip`
+#                (the names of the temp downloads of the DependencyResolver)
+#   directories  `<project id>/<file id>/<any file name>.zip`
+import hashlib
+import json
+import mmap
+import os
+import re
+import zipfile
+from typing import Optional, List, Tuple, Iterator, NamedTuple
+
+from dependency_resolver import FileIdentifier, parse_manifest_dependencies
+
+ARCHIVE_NAME_PATTERN = re.compile(r"^(\d+)_(\d+)(?:[_.].*)?$")
+SIDECAR_SUFFIX = ".json"
+
+
+class _MappedFile(mmap.mmap):
+	"""zipfile requires seekable() of its file, mmap only provides it as of Python 3.13"""
+
+	def seekable(self) -> bool:
+		return True
+
+
+class ArchiveContent(NamedTuple):
+	dependencies: Optional[List[Tuple[int, int]]]  # (project id, file id) pairs of the manifest.json, None if the archive has no manifest
+	jar_fingerprints: List[int]  # fingerprints of the jars of archives without a manifest
+	hash: Optional[str]  # content hash in the format of get_archive_hash, e.g. 'sha1:<hex>'
+	error: Optional[str]  # the archive couldn't be read
+
+
+def read_sidecar(sidecar_path: str) -> Optional[FileIdentifier]:
+	try:
+		with open(sidecar_path) as f:
+			data = json.load(f)
+		return FileIdentifier(int(data['project_id']), int(data['file_id']))
+	except (OSError, ValueError, KeyError, TypeError):
+		return None
+
+
+def get_file_identifier(path: str) -> Optional[FileIdentifier]:
+	"""
+	:return: the CurseForge file of the archive by its sidecar, file name or directories, None if it can't be mapped
+	"""
+	if os.path.isfile(path + SIDECAR_SUFFIX):
+		return read_sidecar(path + SIDECAR_SUFFIX)
+
+	match = ARCHIVE_NAME_PATTERN.match(os.path.basename(path))
+	if match:
+		return FileIdentifier(int(match.group(1)), int(match.group(2)))
+
+	parent, file_dir = os.path.split(os.path.dirname(path))
+	project_dir = os.path.basename(parent)
+	if project_dir.isdigit() and file_dir.isdigit():
+		return FileIdentifier(int(project_dir), int(file_dir))
+	return None
+
+
+def scan_mirror(root_dir: str) -> Iterator[Tuple[str, Optional[FileIdentifier]]]:
+	"""
+	Walk the directory tree and map the archives (zip files and files named like the temp downloads) to their CurseForge file
+
+	:return: (path, file) pairs, the file is None if the archive couldn't be mapped
+	"""
+	for dir_path, _, file_names in os.walk(root_dir):
+		for file_name in sorted(file_names):
+			if file_name.endswith(SIDECAR_SUFFIX):
+				continue
+			if not file_name.lower().endswith('.zip') and not ARCHIVE_NAME_PATTERN.match(file_name):
+				continue
+			path = os.path.join(dir_path, file_name)
+			yield path, get_file_identifier(path)
+
+
+def read_archive(path: str, fingerprint_jars: bool = True, hash_archive: bool = True) -> ArchiveContent:
+	"""
+	Process pool friendly parsing of a mirrored archive
+
+	The archive is memory-mapped, thus only the pages of the central directory and of the manifest.json are read
+	(and all pages once if the archive is hashed) without copying the archive into the heap of the process.
+
+	:param path:
+	:param fingerprint_jars: fingerprint the jars of archives without a manifest.json
+	:param hash_archive: compute the content hash for the archive cache
+	"""
+	try:
+		with open(path, 'rb') as f, _MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+			archive_hash = f"sha1:{hashlib.sha1(mapped).hexdigest()}" if hash_archive else None
+			with zipfile.ZipFile(mapped) as z:
+				if 'manifest.json' in z.namelist():
+					return ArchiveContent(parse_manifest_dependencies(z), [], archive_hash, None)
+				import fingerprints  # numpy is only loaded for archives without a manifest
+				jar_fingerprints = [fingerprints.get_fingerprint(z.read(info.filename)) for info in fingerprints.get_jars(z)] if fingerprint_jars else []
+				return ArchiveContent(None, jar_fingerprints, archive_hash, None)
+	except (OSError, ValueError, zipfile.BadZipFile, json.JSONDecodeError, KeyError, TypeError) as error:
+		# an empty file can't be mapped (ValueError)
+		return ArchiveContent(None, [], None, f"{type(error).__name__}: {error}")
+
+
+def read_archives(paths: List[str], fingerprint_jars: bool = True, hash_archive: bool = True) -> List[ArchiveContent]:
+	"""read_archive for a chunk of archives, one pool task per chunk keeps the inter process overhead low"""
+	return [read_archive(path, fingerprint_jars, hash_archive) for path in paths]
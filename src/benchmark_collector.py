@@ -0,0 +1,124 @@
+# offline end-to-end benchmark of mod_data_collector.collect_data against the local fake api server
+#
+# Run this benchmark with `python benchmark_collector.py` (see `--help` for the options).
+import argparse
+import json
+import logging
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+from benchmark_server import SyntheticDataset, FakeApiServer
+
+
+def run_scenario(server_url: str, mpi_url: str, mod_id: int, unthrottled: bool) -> dict:
+	"""Runs collect_data once in a fresh process, thus the memory usage of the scenarios doesn't interfere"""
+	import mod_data_collector
+	from adaptive_throttle import AdaptiveController
+	from dependency_resolver import DependencyResolver
+	from metrics import metrics
+	from save_handlers import DatasetSaveHandler
+	from web_apis import ApiHelper
+
+	logger = logging.getLogger("Benchmark")
+	logger.setLevel(logging.WARNING)
+
+	with tempfile.TemporaryDirectory() as temp_dir:
+		api_helper = ApiHelper("BENCHMARK_API_KEY", f"sqlite:///{temp_dir}/api_cache.db")
+		if unthrottled:
+			api_helper.controller = AdaptiveController(initial_interval=0, min_interval=0, initial_concurrency=4)
+			api_helper.cf_api.controller = api_helper.controller
+			api_helper.mpi_api.controller = api_helper.controller
+		api_helper.cf_api.base_url = server_url
+		api_helper.mpi_api.base_url = mpi_url
+
+		tracemalloc.start()
+		start_time = time.perf_counter()
+		time_to_first_write = None
+		with DependencyResolver(api_helper, logger, db_url=f"sqlite:///{temp_dir}/dependencies.db", temp_download_folder_path=f"{temp_dir}/downloads") as dependency_resolver:
+			with DatasetSaveHandler(f"sqlite:///{temp_dir}/mod_stats.db", int(time.time())) as save_handler:
+				save_project_info = save_handler.save_project_info
+
+				def timed_save_project_info(*args, **kwargs):
+					nonlocal time_to_first_write
+					if time_to_first_write is None and kwargs.get('p_id', None) != mod_id:
+						time_to_first_write = time.perf_counter() - start_time
+					return save_project_info(*args, **kwargs)
+
+				save_handler.save_project_info = timed_save_project_info
+				save_handler.db.begin()
+				success = mod_data_collector.collect_data(logger, save_handler, dependency_resolver, api_helper, mod_id, force=True)
+				save_handler.db.commit()
+				stored_files = len(save_handler.db['file_dependencies']) if save_handler.db.has_table('file_dependencies') else 0
+
+		wall_time = time.perf_counter() - start_time
+		_, peak_traced = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+		api_helper.close()
+
+	return {
+		'success': success,
+		'wall_time': wall_time,
+		'time_to_first_dependant_write': time_to_first_write,
+		'stored_dependant_files': stored_files,
+		'api_requests': metrics.counter("api_requests_total").total,
+		'downloaded_bytes': metrics.counter("download_bytes_total").total,
+		'peak_traced_memory': peak_traced,
+		'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,  # linux reports kilobytes
+	}
+
+
+def run_benchmarks(dependents: List[int], files_per_dependant: int, manifest_size: int, latency: float, unthrottled: bool) -> List[dict]:
+	results = []
+	for count in dependents:
+		dataset = SyntheticDataset(dependents=count, files_per_dependant=files_per_dependant, manifest_size=manifest_size)
+		with FakeApiServer(dataset, latency=latency) as server:
+			with ProcessPoolExecutor(max_workers=1) as executor:
+				result = executor.submit(run_scenario, server.url, server.mpi_url, dataset.mod_id, unthrottled).result()
+			result['served_requests'] = server.requests
+
+		result.update(dependents=count, files_per_dependant=files_per_dependant, manifest_size=manifest_size, latency=latency)
+		result['dependents_per_second'] = count / result['wall_time']
+		result['files_per_second'] = count * files_per_dependant / result['wall_time']
+		results.append(result)
+		print_result(result)
+	return results
+
+
+def print_result(result: dict):
+	first_write = result['time_to_first_dependant_write']
+	print(
+		f"dependents: {result['dependents']:>5} | "
+		f"wall time: {result['wall_time']:8.2f}s | "
+		f"first write: {first_write if first_write is not None else float('nan'):6.2f}s | "
+		f"{result['dependents_per_second']:7.2f} dependents/s | "
+		f"{result['files_per_second']:7.2f} files/s | "
+		f"requests: {result['served_requests']:>6} | "
+		f"peak traced: {result['peak_traced_memory'] / 1e6:7.2f} MB | "
+		f"peak rss: {result['peak_rss'] / 1e6:7.2f} MB"
+	)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Offline benchmark of collect_data against a local fake CurseForge/ModpackIndex server")
+	parser.add_argument('--dependents', type=int, nargs='+', default=[10, 100, 1000], help="number of dependents of each scenario")
+	parser.add_argument('--files-per-dependant', type=int, default=2)
+	parser.add_argument('--manifest-size', type=int, default=100, help="number of mods in every manifest.json")
+	parser.add_argument('--latency', type=float, default=0.0, help="seconds of latency injected into every response")
+	parser.add_argument('--throttled', action='store_true', help="use the default request pacing of the AdaptiveController instead of an unthrottled one")
+	parser.add_argument('--output', type=str, default=None, help="write the results as json to this file, e.g. to compare runs")
+	args = parser.parse_args()
+
+	results = run_benchmarks(args.dependents, args.files_per_dependant, args.manifest_size, args.latency, not args.throttled)
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2)
+		print(f"results written to {os.path.abspath(args.output)}")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,271 @@
+# synthetic large mod_stats.db generator and query benchmark for db_util and the dashboard
+#
+# Generate a database with `python benchmark_db.py generate bench_stats.db` and
+# benchmark the queries with `python benchmark_db.py run bench_stats.db` (see `--help` for the options).
+import argparse
+import inspect
+import random
+import statistics
+import time
+from typing import List, Callable, Iterator
+
+from dataset import Database
+from dataset.util import ResultIter
+
+import db_util
+import rollups
+
+
+def generate_database(
+		db_path: str, projects: int = 10, files_per_project: int = 50, snapshots: int = 100,
+		dependents: int = 1000, files_per_dependant: int = 3, fanout: int = 2, snapshot_interval: int = 3600, seed: int = 42
+):
+	"""
+	Create a mod_stats.db with the same schema as the DatasetSaveHandler
+
+	:param db_path: path of the SQLite db file
+	:param projects: number of tracked mods
+	:param files_per_project: number of files of every tracked mod
+	:param snapshots: number of collection runs
+	:param dependents: number of modpacks that include at least one tracked mod
+	:param files_per_dependant: number of files of every modpack
+	:param fanout: number of tracked mods every modpack file depends on
+	:param snapshot_interval: seconds between two collection runs
+	:param seed:
+	"""
+	rng = random.Random(seed)
+	db: Database = db_util.connect(f"sqlite:///{db_path}")
+	start_timestamp = int(time.time()) - snapshots * snapshot_interval
+	timestamps = [start_timestamp + i * snapshot_interval for i in range(snapshots)]
+
+	mod_ids = [1000 + i for i in range(projects)]
+	modpack_ids = [100000 + i for i in range(dependents)]
+	mod_files = {mod_id: [mod_id * 1000 + i for i in range(files_per_project)] for mod_id in mod_ids}
+	modpack_files = {modpack_id: [modpack_id * 100 + i for i in range(files_per_dependant)] for modpack_id in modpack_ids}
+
+	def project_row(project_id: int, project_type: str) -> dict:
+		return dict(
+			id=project_id, slug=f"project-{project_id}", name=f"Project {project_id}", type=project_type,
+			mc_version="1.16.5, 1.18.2", summary=f"Synthetic {project_type} project {project_id}",
+			logo=f"https://media.forgecdn.net/avatars/thumbnails/{project_id}.png",
+			date_created=float(start_timestamp - 86400 * 365), date_modified=float(timestamps[-1]), date_collected=timestamps[-1]
+		)
+
+	print("generating projects...")
+	db['project'].insert_many([project_row(i, "mc-mods") for i in mod_ids] + [project_row(i, "modpacks") for i in modpack_ids])
+	db['author'].insert_many([dict(id=i, name=f"Author {i}") for i in range(max(1, (projects + dependents) // 3))])
+	db['project_authors'].insert_many([
+		dict(project_id=project_id, author_id=project_id % max(1, (projects + dependents) // 3), timestamp=timestamps[-1])
+		for project_id in mod_ids + modpack_ids
+	])
+
+	print("generating files and dependencies...")
+	all_files = [(mod_id, file_id) for mod_id in mod_ids for file_id in mod_files[mod_id]] + [(modpack_id, file_id) for modpack_id in modpack_ids for file_id in modpack_files[modpack_id]]
+	db['file'].insert_many([
+		dict(project_id=project_id, file_id=file_id, display_name=f"File {file_id}", file_name=f"file-{file_id}.jar", release_type="Release", mc_versions="1.16.5, Forge", date_created="2022-01-01T00:00:00.000Z", size=rng.randint(10 ** 4, 10 ** 8))
+		for project_id, file_id in all_files
+	])
+
+	def dependency_rows() -> Iterator[dict]:
+		for modpack_id in modpack_ids:
+			for file_id in modpack_files[modpack_id]:
+				for mod_id in rng.sample(mod_ids, min(fanout, len(mod_ids))):
+					yield dict(project_id=modpack_id, file_id=file_id, dependency_project_id=mod_id, dependency_file_id=rng.choice(mod_files[mod_id]))
+
+	db['file_dependencies'].insert_many(list(dependency_rows()), chunk_size=10000)  # insert_many iterates the rows twice
+
+	print(f"generating {snapshots} snapshots...")
+	download_counts = {file: rng.randint(0, 1000) for file in all_files}
+	for i, timestamp in enumerate(timestamps):
+		rows = []
+		for file in all_files:
+			download_counts[file] += rng.randint(0, 50)
+			rows.append(dict(project_id=file[0], file_id=file[1], download_count=download_counts[file], timestamp=timestamp))
+		db['file_downloads'].insert_many(rows, chunk_size=10000)
+
+		project_totals = {}
+		for (project_id, _), count in download_counts.items():
+			project_totals[project_id] = project_totals.get(project_id, 0) + count
+		db['project_downloads'].insert_many([dict(project_id=project_id, download_count=count, timestamp=timestamp) for project_id, count in project_totals.items()])
+
+		if (i + 1) % max(1, snapshots // 10) == 0:
+			print(f"  {i + 1}/{snapshots}")
+
+	if 'dependant_downloads' not in db.views:
+		db_util.create_view_dependant_downloads(db)
+
+	print("rolling up snapshots...")
+	rollups.update_rollups(db)
+
+	print(f"done -> {len(db['file_downloads'])} file download rows")
+	db.close()
+
+
+class _RecordingDatabase:
+	"""Delegates to the database and records the executed sql queries"""
+
+	def __init__(self, db: Database):
+		self._db = db
+		self.queries: List[str] = []
+
+	def query(self, query, *args, **kwargs):
+		self.queries.append(str(query))
+		return self._db.query(query, *args, **kwargs)
+
+	def __getattr__(self, item):
+		return getattr(self._db, item)
+
+	def __getitem__(self, item):
+		return self._db[item]
+
+
+def percentile(values: List[float], p: float) -> float:
+	values = sorted(values)
+	index = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+	return values[index]
+
+
+def measure(func: Callable[[], object], repetitions: int) -> List[float]:
+	durations = []
+	for _ in range(repetitions):
+		start_time = time.perf_counter()
+		func()
+		durations.append(time.perf_counter() - start_time)
+	return durations
+
+
+def print_latencies(name: str, durations: List[float]):
+	print(
+		f"{name:<45} n={len(durations):<4} "
+		f"p50={percentile(durations, 50) * 1000:9.2f}ms p90={percentile(durations, 90) * 1000:9.2f}ms "
+		f"p99={percentile(durations, 99) * 1000:9.2f}ms max={max(durations) * 1000:9.2f}ms mean={statistics.fmean(durations) * 1000:9.2f}ms"
+	)
+
+
+def consume(result: object):
+	"""the query functions return lazy result iterators, the scalar ones (e.g. get_project_count) are already evaluated"""
+	if isinstance(result, ResultIter):
+		list(result)
+
+
+def get_query_functions() -> List[Callable]:
+	"""db_util query functions that only require the db and optionally a mod id"""
+	functions = []
+	for name, func in inspect.getmembers(db_util, inspect.isfunction):
+		if not name.startswith("get_") or func.__module__ != db_util.__name__:
+			continue
+		required = [p for p in inspect.signature(func).parameters.values() if p.default is inspect.Parameter.empty]
+		if len(required) in (1, 2):
+			functions.append(func)
+	return functions
+
+
+def run_benchmarks(db_path: str, repetitions: int = 5, sample_projects: int = 3, show_plans: bool = True):
+	db: Database = db_util.connect(f"sqlite:///{db_path}", read_only=True)
+	mod_ids = [row['id'] for row in db.query("SELECT id FROM project WHERE type = 'mc-mods' ORDER BY id")]
+	mod_ids = random.Random(0).sample(mod_ids, min(sample_projects, len(mod_ids)))
+	print(f"benchmarking {db_path} with projects {mod_ids} ({repetitions} repetitions each)\n")
+
+	for func in get_query_functions():
+		requires_mod_id = len([p for p in inspect.signature(func).parameters.values() if p.default is inspect.Parameter.empty]) == 2
+		durations = []
+		recording_db = _RecordingDatabase(db)
+		for mod_id in (mod_ids if requires_mod_id else [None]):
+			args = (recording_db, mod_id) if requires_mod_id else (recording_db,)
+			durations.extend(measure(lambda: consume(func(*args)), repetitions))
+		print_latencies(f"db_util.{func.__name__}", durations)
+
+		if show_plans and recording_db.queries:
+			for row in db.query(f"EXPLAIN QUERY PLAN {recording_db.queries[-1]}"):
+				print(f"    {row['detail']}")
+
+	try:
+		import dashboard_app
+	except ImportError as error:
+		print(f"skipping dashboard_app.get_project_data -> {error}")
+	else:
+		slugs = [f"project-{mod_id}" for mod_id in mod_ids]
+		durations = []
+		for slug in slugs:
+			durations.extend(measure(lambda: dashboard_app.get_project_data(f"sqlite:///{db_path}", slug), repetitions))
+		print_latencies("dashboard_app.get_project_data", durations)
+
+	db.close()
+
+
+def _sorted_rows(rows) -> list:
+	return sorted(tuple(None if value is None else round(value, 6) if isinstance(value, float) else value for value in dict(row).values()) for row in rows)
+
+
+def run_analytics_benchmark(db_path: str, repetitions: int = 3, granularity: str = 'raw'):
+	"""Compare the per project SQL queries of db_util with the analytics engine for all tracked mods"""
+	try:
+		import analytics
+	except ImportError as error:
+		print(f"skipping the analytics benchmark -> {error}")
+		return
+
+	db: Database = db_util.connect(f"sqlite:///{db_path}", read_only=True)
+	mod_ids = [row['dependency_project_id'] for row in db.query("SELECT DISTINCT dependency_project_id FROM file_dependencies ORDER BY dependency_project_id")]
+	print(f"benchmarking the download composition of {len(mod_ids)} projects ({granularity}, {repetitions} repetitions)\n")
+
+	def run_sql():
+		return [(list(db_util.get_project_downloads_by_composition(db, mod_id, granularity=granularity)), list(db_util.get_project_downloads_by_origin(db, mod_id, granularity=granularity))) for mod_id in mod_ids]
+
+	def run_engine():
+		engine = analytics.DownloadAnalytics(db, granularity)
+		engine.get_composition()
+		engine.get_origin()
+		return engine
+
+	print_latencies("sql (all projects)", measure(run_sql, repetitions))
+	print_latencies("analytics (load + all projects)", measure(run_engine, repetitions))
+	engine = run_engine()
+	mismatches = 0
+	for mod_id, (composition, origin) in zip(mod_ids, run_sql()):
+		if _sorted_rows(composition) != _sorted_rows(engine.get_project_downloads_by_composition(mod_id)) or _sorted_rows(origin) != _sorted_rows(engine.get_project_downloads_by_origin(mod_id)):
+			mismatches += 1
+			print(f"  results of project {mod_id} differ")
+	print(f"\nresults -> {len(mod_ids) - mismatches}/{len(mod_ids)} projects identical")
+	db.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Synthetic mod_stats.db generator and query benchmark")
+	subparsers = parser.add_subparsers(dest='command', required=True)
+
+	generate_parser = subparsers.add_parser('generate', help="generate a synthetic database")
+	generate_parser.add_argument('db_path')
+	generate_parser.add_argument('--projects', type=int, default=10, help="number of tracked mods")
+	generate_parser.add_argument('--files', type=int, default=50, help="number of files per tracked mod")
+	generate_parser.add_argument('--snapshots', type=int, default=100, help="number of collection runs")
+	generate_parser.add_argument('--dependents', type=int, default=1000, help="number of modpacks")
+	generate_parser.add_argument('--dependant-files', type=int, default=3, help="number of files per modpack")
+	generate_parser.add_argument('--fanout', type=int, default=2, help="number of tracked mods every modpack file depends on")
+	generate_parser.add_argument('--seed', type=int, default=42)
+
+	run_parser = subparsers.add_parser('run', help="benchmark the db_util queries and the dashboard data loading")
+	run_parser.add_argument('db_path')
+	run_parser.add_argument('--repetitions', type=int, default=5)
+	run_parser.add_argument('--sample-projects', type=int, default=3, help="number of tracked mods the queries are run for")
+	run_parser.add_argument('--no-plans', action='store_true', help="don't print the query plans")
+
+	analytics_parser = subparsers.add_parser('analytics', help="compare the db_util composition queries with the analytics engine")
+	analytics_parser.add_argument('db_path')
+	analytics_parser.add_argument('--repetitions', type=int, default=3)
+	analytics_parser.add_argument('--granularity', default='raw', choices=list(rollups.GRANULARITIES))
+
+	args = parser.parse_args()
+	if args.command == 'generate':
+		generate_database(
+			args.db_path, projects=args.projects, files_per_project=args.files, snapshots=args.snapshots,
+			dependents=args.dependents, files_per_dependant=args.dependant_files, fanout=args.fanout, seed=args.seed
+		)
+	elif args.command == 'analytics':
+		run_analytics_benchmark(args.db_path, repetitions=args.repetitions, granularity=args.granularity)
+	else:
+		run_benchmarks(args.db_path, repetitions=args.repetitions, sample_projects=args.sample_projects, show_plans=not args.no_plans)
+
+
+if __name__ == '__main__':
+	main()
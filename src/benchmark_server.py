@@ -0,0 +1,255 @@
+# local stand-in for the CFCore API, the ModpackIndex API and the CurseForge CDN
+# serves synthetic mods, modpacks and modpack archives so the collector can be benchmarked offline
+import functools
+import io
+import json
+import random
+import re
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, List
+from urllib.parse import urlparse, parse_qs
+
+
+class SyntheticDataset:
+	"""Deterministic synthetic mod and modpack data"""
+
+	def __init__(self, dependents: int = 10, files_per_dependant: int = 2, manifest_size: int = 100, mod_id: int = 1000, mod_files: int = 5, seed: int = 42):
+		"""
+		:param dependents: number of modpacks that include the mod
+		:param files_per_dependant: number of files of every modpack
+		:param manifest_size: number of mods listed in the manifest.json of every modpack file
+		:param mod_id: project id of the tracked mod
+		:param mod_files: number of files of the tracked mod
+		:param seed:
+		"""
+		self.dependents = dependents
+		self.files_per_dependant = files_per_dependant
+		self.manifest_size = max(1, manifest_size)
+		self.mod_id = mod_id
+		self.mod_files = mod_files
+		self.seed = seed
+		self.base_url = ""
+
+	@property
+	def mpi_mod_id(self) -> int:
+		return self.mod_id + 500000
+
+	@property
+	def dependant_ids(self) -> List[int]:
+		return [100000 + i for i in range(self.dependents)]
+
+	def is_known_project(self, project_id: int) -> bool:
+		return project_id == self.mod_id or 100000 <= project_id < 100000 + self.dependents
+
+	def get_project_file_ids(self, project_id: int) -> List[int]:
+		if project_id == self.mod_id:
+			return [self.mod_id * 100 + i for i in range(self.mod_files)]
+		return [project_id * 100 + i for i in range(self.files_per_dependant)]
+
+	@staticmethod
+	def get_file_project_id(file_id: int) -> int:
+		return file_id // 100
+
+	def get_project(self, project_id: int) -> dict:
+		is_mod = project_id == self.mod_id
+		project_type = "mc-mods" if is_mod else "modpacks"
+		return {
+			'id': project_id, 'slug': f"project-{project_id}", 'name': f"Project {project_id}",
+			'summary': f"Synthetic {project_type} project {project_id}",
+			'links': {'websiteUrl': f"https://www.curseforge.com/minecraft/{project_type}/project-{project_id}"},
+			'logo': {'thumbnailUrl': f"{self.base_url}/logo/{project_id}.png"},
+			'latestFilesIndexes': [{'gameVersion': "1.16.5"}, {'gameVersion': "1.18.2"}],
+			'dateCreated': "2021-01-01T00:00:00.000Z", 'dateModified': "2022-01-01T00:00:00.000Z",
+			'downloadCount': random.Random(project_id + self.seed).randint(0, 10 ** 6),
+			'authors': [{'id': project_id % 997, 'name': f"Author {project_id % 997}"}]
+		}
+
+	def get_file(self, file_id: int) -> dict:
+		project_id = self.get_file_project_id(file_id)
+		archive_length = len(self.get_archive(file_id)) if project_id != self.mod_id else 1000
+		return {
+			'id': file_id, 'modId': project_id,
+			'displayName': f"File {file_id}", 'fileName': f"file-{file_id}.zip",
+			'releaseType': file_id % 3 + 1, 'gameVersions': ["1.16.5", "Forge"],
+			'fileDate': "2022-01-01T00:00:00.000Z", 'fileLength': archive_length,
+			'downloadCount': random.Random(file_id + self.seed).randint(0, 10 ** 5),
+			'downloadUrl': f"{self.base_url}/cdn/{project_id}/{file_id}.zip",
+			'hashes': [{'value': f"{file_id:040x}", 'algo': 1}]
+		}
+
+	@functools.lru_cache(maxsize=256)
+	def get_archive(self, file_id: int) -> bytes:
+		rng = random.Random(file_id + self.seed)
+		mod_file_ids = self.get_project_file_ids(self.mod_id)
+		files = [{'projectID': self.mod_id, 'fileID': rng.choice(mod_file_ids), 'required': True}]
+		for i in range(self.manifest_size - 1):
+			project_id = 200000 + rng.randint(0, 50000)
+			files.append({'projectID': project_id, 'fileID': project_id * 100 + rng.randint(0, 9), 'required': True})
+
+		manifest = {'minecraft': {'version': "1.16.5"}, 'manifestType': "minecraftModpack", 'name': f"File {file_id}", 'files': files}
+		buffer = io.BytesIO()
+		with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+			z.writestr('manifest.json', json.dumps(manifest))
+			z.writestr('overrides/config/placeholder.txt', "synthetic")
+		return buffer.getvalue()
+
+
+class FakeApiServer:
+	"""
+	Threaded http server implementing the endpoints used by web_apis and the dependency resolver
+
+	- CFCore: GET /v1/mods/{id}, POST /v1/mods, GET /v1/mods/{id}/files, POST /v1/mods/files
+	- ModpackIndex (prefixed with /mpi): GET /v1/mods, GET /v1/mod/{id}/modpacks
+	- CDN: HEAD/GET /cdn/{project_id}/{file_id}.zip with Range support
+	"""
+
+	def __init__(self, dataset: SyntheticDataset, latency: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+		"""
+		:param dataset:
+		:param latency: seconds added to every response
+		:param host:
+		:param port: 0 picks a free port
+		"""
+		self.dataset = dataset
+		self.latency = latency
+		self.requests = 0
+		self._server = ThreadingHTTPServer((host, port), self._create_handler())
+		self._server.daemon_threads = True
+		self.dataset.base_url = self.url
+		self._thread: Optional[threading.Thread] = None
+
+	@property
+	def url(self) -> str:
+		host, port = self._server.server_address[:2]
+		return f"http://{host}:{port}"
+
+	@property
+	def mpi_url(self) -> str:
+		return f"{self.url}/mpi"
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.stop()
+
+	def start(self):
+		self._thread = threading.Thread(target=self._server.serve_forever, name="FakeApiServer", daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+
+	def _create_handler(self):
+		server = self
+
+		class _Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def log_message(self, format, *args):
+				pass
+
+			def _send_json(self, data, status: int = 200):
+				body = json.dumps(data).encode()
+				self.send_response(status)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def _read_json(self) -> dict:
+				length = int(self.headers.get('Content-Length', 0))
+				return json.loads(self.rfile.read(length)) if length > 0 else {}
+
+			def _before(self):
+				server.requests += 1
+				if server.latency > 0:
+					time.sleep(server.latency)
+
+			def do_HEAD(self):
+				self._before()
+				self._handle_cdn(head=True)
+
+			def do_GET(self):
+				self._before()
+				url = urlparse(self.path)
+				path = url.path
+				query = parse_qs(url.query)
+				data = server.dataset
+
+				if path.startswith("/cdn/"):
+					self._handle_cdn(head=False)
+				elif match := re.fullmatch(r"/v1/mods/(\d+)", path):
+					project_id = int(match.group(1))
+					if data.is_known_project(project_id):
+						self._send_json({'data': data.get_project(project_id)})
+					else:
+						self._send_json({'error': "not found"}, 404)
+				elif match := re.fullmatch(r"/v1/mods/(\d+)/files", path):
+					project_id = int(match.group(1))
+					self._send_json({'data': [data.get_file(file_id) for file_id in data.get_project_file_ids(project_id)]})
+				elif path == "/mpi/v1/mods":
+					name = query.get('name', [""])[0]
+					mods = [{'id': data.mpi_mod_id, 'name': name, 'curse_info': {'curse_id': data.mod_id}}]
+					self._send_json({'data': mods})
+				elif match := re.fullmatch(r"/mpi/v1/mod/(\d+)/modpacks", path):
+					# all modpacks are returned in one page, thus the scenarios aren't capped by the missing pagination of the collector
+					modpacks = [{'id': i, 'curse_info': {'curse_id': i}} for i in data.dependant_ids] if int(match.group(1)) == data.mpi_mod_id else []
+					self._send_json({'data': modpacks})
+				else:
+					self._send_json({'error': "not found"}, 404)
+
+			def do_POST(self):
+				self._before()
+				path = urlparse(self.path).path
+				body = self._read_json()
+				data = server.dataset
+
+				if path == "/v1/mods":
+					self._send_json({'data': [data.get_project(i) for i in body.get('modIds', []) if data.is_known_project(i)]})
+				elif path == "/v1/mods/files":
+					self._send_json({'data': [data.get_file(i) for i in body.get('fileIds', [])]})
+				else:
+					self._send_json({'error': "not found"}, 404)
+
+			def _handle_cdn(self, head: bool):
+				match = re.fullmatch(r"/cdn/(\d+)/(\d+)\.zip", urlparse(self.path).path)
+				if not match:
+					self.send_error(404)
+					return
+
+				content = server.dataset.get_archive(int(match.group(2)))
+				start, end = 0, len(content) - 1
+				status = 200
+				range_header = self.headers.get('Range', None)
+				if range_header and (range_match := re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())):
+					if range_match.group(1):
+						start = int(range_match.group(1))
+						if range_match.group(2):
+							end = min(end, int(range_match.group(2)))
+					elif range_match.group(2):
+						start = max(0, len(content) - int(range_match.group(2)))
+					if start > end:
+						self.send_response(416)
+						self.send_header('Content-Range', f"bytes */{len(content)}")
+						self.send_header('Content-Length', "0")
+						self.end_headers()
+						return
+					status = 206
+
+				self.send_response(status)
+				self.send_header('Content-Type', 'application/zip')
+				self.send_header('Accept-Ranges', 'bytes')
+				self.send_header('Content-Length', str(end - start + 1))
+				if status == 206:
+					self.send_header('Content-Range', f"bytes {start}-{end}/{len(content)}")
+				self.end_headers()
+				if not head:
+					self.wfile.write(content[start:end + 1])
+
+		return _Handler
@@ -0,0 +1,463 @@
+# command line interface of the data collector and the dashboard
+#
+# Run `python cli.py --help` for the available subcommands.
+# Heavy modules (e.g. pandas, plotly and dash for the dashboard) are only imported by the subcommands that need them,
+# thus invocations of the collector (e.g. via cron) start fast.
+#
+# The configuration is read from (in ascending precedence):
+#   defaults < json config file (--config or DS_MM_CF_CONFIG) < env vars (DS_MM_CF_<KEY>, e.g. DS_MM_CF_CF_API_KEY) < command line options
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from typing import List, Optional
+
+CONFIG_ENV_VAR = "DS_MM_CF_CONFIG"
+ENV_VAR_PREFIX = "DS_MM_CF_"
+
+DEFAULT_CONFIG: dict = {
+	"cf_api_key": None,
+	"cf_api_url": None,  # override the base url of the CFCore API, e.g. for the local benchmark server
+	"mpi_api_url": None,  # override the base url of the ModpackIndex API
+	"db_url": "sqlite:///mod_stats.db",
+	"dependencies_db_url": "sqlite:///dependencies.db",
+	"attach_dependencies_db": False,  # query the file dependencies from the dependencies db instead of copying them into the mod stats db (SQLite only)
+	"api_cache_db_url": "sqlite:///api_cache.db",
+	"temp_download_folder": "/temp",
+	"mod_ids": [],
+	# retention of the download snapshots by granularity in days, older snapshots are only kept in the coarser rollups (0 keeps them forever)
+	"raw_retention_days": 0,
+	"hourly_retention_days": 0,
+	"daily_retention_days": 0,
+	"log_level": "INFO",
+	"metrics_file": None,
+	"profile_dir": None,
+	"prerender_dir": None,  # pre-render the dashboard pages of the collected mods into this directory after every run
+	"dashboard_host": "127.0.0.1",
+	"dashboard_port": 8050,
+}
+
+
+def load_config(config_file_path: Optional[str] = None) -> dict:
+	config = dict(DEFAULT_CONFIG)
+
+	config_file_path = config_file_path or os.environ.get(CONFIG_ENV_VAR, None)
+	if config_file_path:
+		with open(config_file_path) as f:
+			config.update(json.load(f))
+
+	for key, default in DEFAULT_CONFIG.items():
+		value = os.environ.get(f"{ENV_VAR_PREFIX}{key.upper()}", None)
+		if value is None:
+			continue
+		if isinstance(default, list):
+			config[key] = [int(mod_id) for mod_id in value.replace(",", " ").split()]
+		elif isinstance(default, bool):
+			config[key] = value.lower() in ("1", "true", "yes", "on")
+		elif isinstance(default, int):
+			config[key] = int(value)
+		else:
+			config[key] = value
+
+	return config
+
+
+def create_logger(level: str) -> logging.Logger:
+	console_handler = logging.StreamHandler()
+	console_handler.setLevel(logging.DEBUG)
+	console_handler.setFormatter(logging.Formatter('[%(asctime)s][%(name)s][%(levelname)s]:: %(message)s'))
+	logger = logging.getLogger("Mod")
+	logger.setLevel(level.upper())
+	logger.addHandler(console_handler)
+
+	profiler_logger = logging.getLogger("Profiler")
+	profiler_logger.setLevel(level.upper())
+	profiler_logger.addHandler(console_handler)
+	return logger
+
+
+def require_api_key(config: dict) -> str:
+	if not config["cf_api_key"]:
+		sys.exit(f"missing CFCore API key, set it via --cf-api-key, the env var {ENV_VAR_PREFIX}CF_API_KEY or the config file")
+	return config["cf_api_key"]
+
+
+def create_api_helper(config: dict):
+	from web_apis import ApiHelper
+
+	api_helper = ApiHelper(require_api_key(config), config["api_cache_db_url"])
+	if config["cf_api_url"]:
+		api_helper.cf_api.base_url = config["cf_api_url"]
+	if config["mpi_api_url"]:
+		api_helper.mpi_api.base_url = config["mpi_api_url"]
+	return api_helper
+
+
+def get_attached_dependencies_db_url(config: dict) -> Optional[str]:
+	return config["dependencies_db_url"] if config["attach_dependencies_db"] else None
+
+
+def get_retention(config: dict) -> dict:
+	return {granularity: config[f"{granularity}_retention_days"] * 86400 for granularity in ("raw", "hourly", "daily")}
+
+
+def update_rollups(save_handler, logger: logging.Logger, config: dict) -> bool:
+	save_handler.db.begin()
+	try:
+		save_handler.update_rollups(get_retention(config))
+	except Exception:
+		logger.exception("failed to update the download rollups, rollback...")
+		save_handler.db.rollback()
+		return False
+	save_handler.db.commit()
+	return True
+
+
+def prerender_pages(config: dict, logger: logging.Logger, mod_ids: Optional[List[int]]) -> bool:
+	try:
+		import dashboard_app
+	except ImportError as error:
+		logger.error(f"failed to pre-render the dashboard pages -> {error}")
+		return False
+
+	dashboard_app.dependenciesDbUrl = get_attached_dependencies_db_url(config)
+	count = dashboard_app.prerender_project_pages(config["db_url"], config["prerender_dir"], mod_ids, logger)
+	logger.info(f"pre-rendered {count} dashboard pages into <{config['prerender_dir']}>")
+	return True
+
+
+def collect(config: dict, logger: logging.Logger, mod_ids: List[int], timestamp: Optional[int], force: bool) -> bool:
+	"""Collect the data of the mods, every mod is committed on its own"""
+	import mod_data_collector
+	from dependency_resolver import DependencyResolver
+	from metrics import metrics
+	from save_handlers import DatasetSaveHandler
+
+	if timestamp is None:
+		timestamp = int(time.time())
+
+	success = True
+	api_helper = create_api_helper(config)
+	with DependencyResolver(api_helper, logger.getChild("DependencyResolver"), db_url=config["dependencies_db_url"], temp_download_folder_path=config["temp_download_folder"]) as dependency_resolver:
+		with DatasetSaveHandler(config["db_url"], timestamp, dependencies_db_url=get_attached_dependencies_db_url(config)) as save_handler:
+			for mod_id in mod_ids:
+				logger.info(f"collecting data for project <{mod_id}> (run timestamp: {timestamp})")
+				# completed steps are committed at checkpoints, thus only the unfinished step is rolled back on failure
+				save_handler.db.begin()
+				try:
+					collected = mod_data_collector.collect_data(logger.getChild("DataCollector"), save_handler, dependency_resolver, api_helper, mod_id, force=force)
+				except Exception:
+					logger.exception(f"failed to collect data for project <{mod_id}>, rollback db changes of the unfinished step...")
+					save_handler.db.rollback()
+					logger.info(f"resume the run with `--timestamp {timestamp}`")
+					success = False
+					continue
+
+				if collected:
+					logger.info("committing changes to db...")
+					save_handler.db.commit()
+				else:
+					logger.info("rollback db changes...")
+					save_handler.db.rollback()
+
+			logger.info("updating the download rollups...")
+			success &= update_rollups(save_handler, logger, config)
+
+	if config["prerender_dir"]:
+		success &= prerender_pages(config, logger, mod_ids)
+
+	api_helper.close()
+	logger.debug(f"api request stats:\n{api_helper.controller.summary()}")
+	logger.info(f"run metrics:\n{metrics.summary()}")
+	if config["metrics_file"]:
+		metrics.write_prometheus_file(config["metrics_file"])
+	return success
+
+
+def run_queue_worker(config: dict, logger: logging.Logger, timestamp: int, worker_id: Optional[str] = None) -> int:
+	"""Process the items of the run from the work queue until it is drained"""
+	import distributed_collector
+	from dependency_resolver import DependencyResolver
+	from metrics import metrics
+	from save_handlers import DatasetSaveHandler
+	from work_queue import WorkQueue
+
+	api_helper = create_api_helper(config)
+	with DependencyResolver(api_helper, logger.getChild("DependencyResolver"), db_url=config["dependencies_db_url"], temp_download_folder_path=config["temp_download_folder"]) as dependency_resolver:
+		with DatasetSaveHandler(config["db_url"], timestamp, dependencies_db_url=get_attached_dependencies_db_url(config), shared_run=True) as save_handler:
+			queue = WorkQueue(save_handler.db, worker_id)
+			worker = distributed_collector.QueueWorker(logger.getChild(f"Worker-{queue.worker_id}"), queue, save_handler, dependency_resolver, api_helper, timestamp)
+			processed = worker.work()
+
+	api_helper.close()
+	logger.info(f"worker <{queue.worker_id}> processed {processed} items, metrics:\n{metrics.summary()}")
+	return processed
+
+
+def _worker_process_main(config: dict, timestamp: int, worker_id: str):
+	run_queue_worker(config, create_logger(config["log_level"]), timestamp, worker_id)
+
+
+def collect_distributed(config: dict, logger: logging.Logger, mod_ids: List[int], timestamp: Optional[int], force: bool, workers: int) -> bool:
+	"""
+	Collect the data of the mods with local worker processes that pull the run from the work queue in the mod stats db,
+	workers on other nodes (sharing the db, e.g. PostgreSQL) can join the run with the worker subcommand
+	"""
+	import multiprocessing
+	import socket
+
+	import distributed_collector
+	from dependency_resolver import DependencyResolver
+	from save_handlers import DatasetSaveHandler
+	from work_queue import WorkQueue
+
+	if timestamp is None:
+		timestamp = int(time.time())
+
+	# the schemas are created before the workers start, thus they don't race for it
+	api_helper = create_api_helper(config)
+	with DependencyResolver(api_helper, logger.getChild("DependencyResolver"), db_url=config["dependencies_db_url"], temp_download_folder_path=config["temp_download_folder"]):
+		pass
+	api_helper.close()
+	with DatasetSaveHandler(config["db_url"], timestamp, dependencies_db_url=get_attached_dependencies_db_url(config), shared_run=True) as save_handler:
+		count = distributed_collector.enqueue_projects(WorkQueue(save_handler.db), timestamp, mod_ids, force)
+
+	logger.info(f"queued {count} new projects, starting {workers} workers (run timestamp: {timestamp})")
+	logger.info(f"more workers can join the run with `python cli.py worker --timestamp {timestamp}`")
+	# spawned instead of forked processes, they must not inherit the db connections
+	context = multiprocessing.get_context("spawn")
+	processes = [
+		context.Process(target=_worker_process_main, args=(config, timestamp, f"{socket.gethostname()}-{os.getpid()}-{index}"), name=f"QueueWorker-{index}")
+		for index in range(workers)
+	]
+	for process in processes:
+		process.start()
+	for process in processes:
+		process.join()
+
+	success = True
+	for process in processes:
+		if process.exitcode != 0:
+			logger.error(f"worker process <{process.name}> exited with code {process.exitcode}")
+			success = False
+
+	with DatasetSaveHandler(config["db_url"], timestamp, dependencies_db_url=get_attached_dependencies_db_url(config), shared_run=True) as save_handler:
+		queue = WorkQueue(save_handler.db)
+		if not queue.is_drained(timestamp):
+			logger.error(f"the work queue isn't drained, resume the run with `--timestamp {timestamp}` or more workers")
+			success = False
+		else:
+			save_handler.db.begin()
+			failed = distributed_collector.finish_run(queue, save_handler, timestamp, mod_ids)
+			save_handler.db.commit()
+			if failed:
+				logger.error(f"the data of the projects {failed} is incomplete, failed work items are listed in the work_item table")
+				success = False
+
+		logger.info("updating the download rollups...")
+		success &= update_rollups(save_handler, logger, config)
+
+	if config["prerender_dir"]:
+		success &= prerender_pages(config, logger, mod_ids)
+	return success
+
+
+def check_work_queue_db(config: dict, logger: logging.Logger) -> bool:
+	from work_queue import is_supported_db_url, SUPPORTED_BACKENDS
+
+	if is_supported_db_url(config["db_url"]):
+		return True
+	logger.error(f"runs shared by several workers need a {' or '.join(SUPPORTED_BACKENDS)} db_url, collect with --workers 1 instead")
+	return False
+
+
+def command_collect(config: dict, logger: logging.Logger, args) -> int:
+	if args.workers > 1:
+		if not check_work_queue_db(config, logger):
+			return 2
+		return 0 if collect_distributed(config, logger, [args.mod_id], args.timestamp, args.force, args.workers) else 1
+	return 0 if collect(config, logger, [args.mod_id], args.timestamp, args.force) else 1
+
+
+def command_collect_batch(config: dict, logger: logging.Logger, args) -> int:
+	mod_ids = args.mod_ids or config["mod_ids"]
+	if not mod_ids:
+		logger.error("no mod ids given, pass them as arguments or set 'mod_ids' in the config")
+		return 2
+	if args.workers > 1:
+		if not check_work_queue_db(config, logger):
+			return 2
+		return 0 if collect_distributed(config, logger, mod_ids, args.timestamp, args.force, args.workers) else 1
+	return 0 if collect(config, logger, mod_ids, args.timestamp, args.force) else 1
+
+
+def command_worker(config: dict, logger: logging.Logger, args) -> int:
+	if not check_work_queue_db(config, logger):
+		return 2
+	run_queue_worker(config, logger, args.timestamp, args.worker_id)
+	return 0
+
+
+def command_resolve_skipped(config: dict, logger: logging.Logger, args) -> int:
+	from dependency_resolver import DependencyResolver, SkipReason
+
+	api_helper = create_api_helper(config)
+	with DependencyResolver(api_helper, logger.getChild("DependencyResolver"), db_url=config["dependencies_db_url"], temp_download_folder_path=config["temp_download_folder"]) as dependency_resolver:
+		dependency_resolver.resolve_skipped_file_dependencies(
+			SkipReason[args.reason], max_file_length=args.max_file_length, timestamp=args.skipped_at,
+			download_workers=args.download_workers, parse_workers=args.parse_workers, job_id=args.job_id
+		)
+	api_helper.close()
+	return 0
+
+
+def command_ingest_mirror(config: dict, logger: logging.Logger, args) -> int:
+	from dependency_resolver import DependencyResolver
+
+	# the api is only needed for looking up the fingerprints of archives without a manifest.json
+	api_helper = create_api_helper(config) if args.match_fingerprints else None
+	with DependencyResolver(api_helper, logger.getChild("DependencyResolver"), db_url=config["dependencies_db_url"], temp_download_folder_path=config["temp_download_folder"]) as dependency_resolver:
+		dependency_resolver.ingest_archive_mirror(
+			args.directory, workers=args.workers, match_fingerprints=args.match_fingerprints, hash_archives=args.hash_archives, batch_size=args.batch_size
+		)
+	if api_helper:
+		api_helper.close()
+	return 0
+
+
+def command_compact(config: dict, logger: logging.Logger, args) -> int:
+	from save_handlers import DatasetSaveHandler
+
+	with DatasetSaveHandler(config["db_url"], int(time.time())) as save_handler:
+		return 0 if update_rollups(save_handler, logger, config) else 1
+
+
+def command_prerender(config: dict, logger: logging.Logger, args) -> int:
+	if args.output_dir:
+		config["prerender_dir"] = args.output_dir
+	if not config["prerender_dir"]:
+		logger.error("no output directory given, pass it with --output-dir or set 'prerender_dir' in the config")
+		return 2
+	return 0 if prerender_pages(config, logger, args.mod_ids or None) else 1
+
+
+def command_dump_db(config: dict, logger: logging.Logger, args) -> int:
+	import db_util
+	from dependency_resolver import SkipReason
+
+	for db_url in args.db_urls or [config["db_url"], config["dependencies_db_url"]]:
+		db = db_util.connect(db_url, read_only=True)
+		print(f"dumping database info of <{db_url}>...")
+		print("---")
+		for table_id in db.tables:
+			table = db[table_id]
+			print("Table:", table_id, "\n  Columns:", table.columns, "\n  Rows:", len(table))
+		if args.skipped_files and db.has_table('skipped_file'):
+			for row in db['skipped_file']:
+				print("reason:", SkipReason(row['reason']).name, "url:", row['url'])
+		print("---")
+		db.close()
+	return 0
+
+
+def command_dashboard(config: dict, logger: logging.Logger, args) -> int:
+	import dashboard_app
+
+	dashboard_app.configure(config["db_url"], get_attached_dependencies_db_url(config), config["prerender_dir"])
+	app = dashboard_app.app
+	# dash < 2 only provides run_server
+	run = app.run if hasattr(app, 'run') else app.run_server
+	run(host=args.host or config["dashboard_host"], port=args.port or config["dashboard_port"], debug=args.debug)
+	return 0
+
+
+def create_parser() -> argparse.ArgumentParser:
+	parser = argparse.ArgumentParser(description="Download stats of Minecraft mods hosted on CurseForge")
+	parser.add_argument('--config', type=str, default=None, help=f"json config file (default: env var {CONFIG_ENV_VAR})")
+	parser.add_argument('--cf-api-key', type=str, default=None, help="CFCore API key")
+	parser.add_argument('--db-url', type=str, default=None, help="url of the mod stats db")
+	parser.add_argument('--log-level', type=str, default=None, choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+	parser.add_argument('--metrics-file', type=str, default=None, help="write the run metrics in the Prometheus text format to this file")
+	parser.add_argument('--profile', type=str, default=None, metavar="DIR", help="profile the run and write the profiles to this directory")
+	subparsers = parser.add_subparsers(dest='command', required=True)
+
+	collect_parser = subparsers.add_parser('collect', help="collect the data of one mod")
+	collect_parser.add_argument('mod_id', type=int, help="CurseForge project id")
+	collect_parser.add_argument('--force', action='store_true', help="collect the data even if the download count didn't change")
+	collect_parser.add_argument('--timestamp', type=int, default=None, help="timestamp of an interrupted run that should be resumed")
+	collect_parser.add_argument('--workers', type=int, default=1, help="number of worker processes that share the run via the work queue")
+	collect_parser.set_defaults(func=command_collect)
+
+	batch_parser = subparsers.add_parser('collect-batch', help="collect the data of several mods in one run")
+	batch_parser.add_argument('mod_ids', type=int, nargs='*', help="CurseForge project ids (default: 'mod_ids' of the config)")
+	batch_parser.add_argument('--force', action='store_true', help="collect the data even if the download count didn't change")
+	batch_parser.add_argument('--timestamp', type=int, default=None, help="timestamp of an interrupted run that should be resumed")
+	batch_parser.add_argument('--workers', type=int, default=1, help="number of worker processes that share the run via the work queue")
+	batch_parser.set_defaults(func=command_collect_batch)
+
+	worker_parser = subparsers.add_parser('worker', help="join a run that is collected by several workers and process its work queue")
+	worker_parser.add_argument('--timestamp', type=int, required=True, help="timestamp of the run")
+	worker_parser.add_argument('--worker-id', type=str, default=None, help="name of the worker in the leases of its items (default: random)")
+	worker_parser.set_defaults(func=command_worker)
+
+	skipped_parser = subparsers.add_parser('resolve-skipped', help="retry the dependency resolution of skipped files")
+	skipped_parser.add_argument('--reason', type=str, default="DOWNLOAD_TOO_LARGE", choices=["ZERO_DOWNLOADS", "DOWNLOAD_TOO_LARGE", "DOWNLOAD_ERROR", "FILE_PARSING_ERROR"])
+	skipped_parser.add_argument('--max-file-length', type=float, default=5e8, help="max download size in bytes")
+	skipped_parser.add_argument('--skipped-at', type=int, default=None, help="only retry files that were skipped at this timestamp")
+	skipped_parser.add_argument('--download-workers', type=int, default=2)
+	skipped_parser.add_argument('--parse-workers', type=int, default=2)
+	skipped_parser.add_argument('--job-id', type=int, default=None, help="id of an interrupted job that should be resumed")
+	skipped_parser.set_defaults(func=command_resolve_skipped)
+
+	mirror_parser = subparsers.add_parser('ingest-mirror', help="resolve the dependencies of the modpack archives of a local mirror without downloading them")
+	mirror_parser.add_argument('directory', type=str, help="root directory of the mirror, see src/archive_mirror.py for the naming conventions of the archives")
+	mirror_parser.add_argument('--workers', type=int, default=None, help="number of parse processes (default: number of cpus)")
+	mirror_parser.add_argument('--no-fingerprints', dest='match_fingerprints', action='store_false', help="don't resolve archives without a manifest.json by the fingerprints of their jars (no api key needed)")
+	mirror_parser.add_argument('--no-hash', dest='hash_archives', action='store_false', help="don't save the content hashes of the archives for the archive cache")
+	mirror_parser.add_argument('--batch-size', type=int, default=500, help="archives per db transaction")
+	mirror_parser.set_defaults(func=command_ingest_mirror)
+
+	compact_parser = subparsers.add_parser('compact', help="update the download rollups and delete the snapshots that are older than their retention period")
+	compact_parser.set_defaults(func=command_compact)
+
+	prerender_parser = subparsers.add_parser('prerender', help="pre-render the dashboard pages of the mods")
+	prerender_parser.add_argument('mod_ids', type=int, nargs='*', help="CurseForge project ids (default: all tracked mods)")
+	prerender_parser.add_argument('--output-dir', type=str, default=None, help="default: 'prerender_dir' of the config")
+	prerender_parser.set_defaults(func=command_prerender)
+
+	dump_parser = subparsers.add_parser('dump-db', help="print the tables of the databases")
+	dump_parser.add_argument('db_urls', type=str, nargs='*', help="database urls (default: mod stats db and dependencies db)")
+	dump_parser.add_argument('--skipped-files', action='store_true', help="print the skipped files")
+	dump_parser.set_defaults(func=command_dump_db)
+
+	dashboard_parser = subparsers.add_parser('dashboard', help="run the dashboard web app")
+	dashboard_parser.add_argument('--host', type=str, default=None)
+	dashboard_parser.add_argument('--port', type=int, default=None)
+	dashboard_parser.add_argument('--debug', action='store_true')
+	dashboard_parser.set_defaults(func=command_dashboard)
+
+	return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+	args = create_parser().parse_args(argv)
+	config = load_config(args.config)
+	for key in ["cf_api_key", "db_url", "log_level", "metrics_file"]:
+		value = getattr(args, key)
+		if value is not None:
+			config[key] = value
+	if args.profile is not None:
+		config["profile_dir"] = args.profile
+
+	if config["profile_dir"]:
+		import profiling
+		profiling.enable(config["profile_dir"])
+
+	logger = create_logger(config["log_level"])
+	return args.func(config, logger, args)
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -3,14 +3,20 @@
 
 # Run this app with `python dashboard.py` and
 # visit http://127.0.0.1:8050/ in your web browser.
+import gzip
+import json
+import logging
+import os
+import tempfile
 import time
 from datetime import datetime
 from datetime import timedelta
-from typing import List
+from typing import List, Optional
+from urllib.parse import parse_qs
 
 import dash
-import dataset
 import pandas as pd
+import plotly.io
 import plotly.express as px
 import plotly.graph_objects as go
 from dash import dcc, html, Input, Output, State
@@ -18,10 +24,16 @@ from dataset import Database
 from plotly.subplots import make_subplots
 
 import db_util
+import stats_api
+from profiling import profiled
+
+
+def connect_db(db_path: str) -> Database:
+	return db_util.connect(db_path, read_only=True, dependencies_db_url=dependenciesDbUrl)
 
 
 def get_project_data(db_path: str, mod_slug: str):
-	db: Database = dataset.connect(db_path)
+	db: Database = connect_db(db_path)
 
 	project = db['project'].find_one(slug=mod_slug)
 	if not project:
@@ -51,13 +63,35 @@ def get_project_downloads_by_origin(db: Database, mod_id: int):
 	return df
 
 
-def get_tracked_projects(db_path: str):
-	db: Database = dataset.connect(db_path)
-	projects = [p for p in db_util.get_tracked_projects_with_logo(db)]
+def get_tracked_projects(db_path: str, page: int):
+	"""
+	:return: all mods, the modpacks/other projects of the page and the total number of modpacks/other projects
+	"""
+	db: Database = connect_db(db_path)
+	mods = list(db_util.get_tracked_projects_with_logo(db, is_mod=True))
+	modpacks = list(db_util.get_tracked_projects_with_logo(db, is_mod=False, limit=PROJECTS_PAGE_SIZE, offset=(page - 1) * PROJECTS_PAGE_SIZE))
+	modpack_count = db_util.get_project_count(db, is_mod=False)
+	db.close()
+	return mods, modpacks, modpack_count
+
+
+def search_projects(db_path: str, text: str):
+	db: Database = connect_db(db_path)
+	projects = list(db_util.search_projects(db, text, limit=SEARCH_RESULT_LIMIT))
 	db.close()
 	return projects
 
 
+def get_page(search: Optional[str]) -> int:
+	"""
+	:param search: query string of the url
+	"""
+	try:
+		return max(1, int(parse_qs((search or "").lstrip("?")).get("page", ["1"])[0]))
+	except ValueError:
+		return 1
+
+
 def strformat_timestamp_local(time_stamp: int):
 	return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time_stamp))
 
@@ -151,43 +185,61 @@ def create_project_downloads_figure(df: pd.Series):
 	return fig
 
 
-def create_projects_list(projects: List):
-	mods = []
-	modpacks = []
-	for project in projects:
-		li = html.Li([
-			html.Img(src=project['logo'], className="w-12 h-12 rounded"),
+def create_project_item(project):
+	return html.Li([
+		html.Img(src=project['logo'], className="w-12 h-12 rounded"),
+		html.Div([
+			dcc.Link([f"{project['slug']}".title()], href=f"/data/{project['slug']}", className="underline text-purple-400 hover:text-purple-600"),
 			html.Div([
-				dcc.Link([f"{project['slug']}".title()], href=f"/data/{project['slug']}", className="underline text-purple-400 hover:text-purple-600"),
-				html.Div([
-					"last check: ", html.Abbr([get_data_time_diff(project['date_collected'])], title=strformat_timestamp(project['date_collected'])), " ago"
-				], className="text-sm")
-			], className="flex flex-col"),
-		], className="flex flex-row gap-2")
-		if project['type'] == 'mc-mods':
-			mods.append(li)
-		else:
-			modpacks.append(li)
+				"last check: ", html.Abbr([get_data_time_diff(project['date_collected'])], title=strformat_timestamp(project['date_collected'])), " ago"
+			], className="text-sm")
+		], className="flex flex-col"),
+	], className="flex flex-row gap-2")
+
+
+def create_pagination(pathname: str, page: int, page_count: int):
+	links = []
+	if page > 1:
+		links.append(dcc.Link(["< previous"], href=f"{pathname}?page={page - 1}", className="text-purple-400 hover:text-purple-600"))
+	links.append(html.Span([f"page {page} of {page_count}"]))
+	if page < page_count:
+		links.append(dcc.Link(["next >"], href=f"{pathname}?page={page + 1}", className="text-purple-400 hover:text-purple-600"))
+	return html.Div(links, className="flex flex-row gap-4 mt-2 text-sm")
 
+
+def create_projects_list(mods: List, modpacks: List, modpack_count: int, pathname: str, page: int):
+	page_count = max(1, -(-modpack_count // PROJECTS_PAGE_SIZE))
 	return html.Div([
 		html.Div([
 			html.H3(["Mods"], className="mb-2"),
-			html.Ul(mods, className="flex flex-wrap gap-4")
+			html.Ul([create_project_item(project) for project in mods], className="flex flex-wrap gap-4")
 		]),
 		html.Details([
-			html.Summary([f"Modpacks/Other ({len(modpacks)})"], className="focus:outline-none mb-2"),
-			html.Ul(modpacks, className="flex flex-wrap gap-4 cursor-auto")
-		], className="cursor-pointer")
+			html.Summary([f"Modpacks/Other ({modpack_count})"], className="focus:outline-none mb-2"),
+			html.Ul([create_project_item(project) for project in modpacks], className="flex flex-wrap gap-4 cursor-auto"),
+			create_pagination(pathname, page, page_count) if page_count > 1 else None
+		], open=page > 1, className="cursor-pointer")
 	], className="flex flex-col gap-4 mt-2")
 
 
-def create_tracked_projects_content():
+def create_tracked_projects_content(pathname: str = "/", search: Optional[str] = None):
+	# only a page of the modpacks is rendered, the db can contain thousands of them
+	page = get_page(search)
 	return html.Div([
 		html.H2(["Tracked Projects"], className="text-xl"),
-		create_projects_list(get_tracked_projects(dbUrl))
+		create_projects_list(*get_tracked_projects(dbUrl, page), pathname, page)
 	], className="bg-gray-600 bg-opacity-50 p-3 rounded shadow-lg")
 
 
+def create_search_result(projects: List):
+	if not projects:
+		return [html.Span(["no projects found"], className="text-sm")]
+	return [
+		dcc.Link([project['name']], href=f"/data/{project['slug']}", className="underline text-purple-400 hover:text-purple-600")
+		for project in projects
+	]
+
+
 def create_error_element(error_code: int, error_msg: str):
 	return html.Div([
 		html.Span([str(error_code)], className="font-black text-6xl"),
@@ -200,126 +252,310 @@ def create_graph(_id, figure):
 	return dcc.Graph(id=_id, config={'displaylogo': False}, figure=figure, className="mt-2 rounded theme-bg-dark shadow-lg")
 
 
-def create_project_content(mod_name: str):
-	try:
-		project_data, authors, downloads_by_file, downloads_composition, downloads_by_origin = get_project_data(dbUrl, mod_name)
-	except TypeError:
-		return create_error_element(404, "Data Not Found")
-	except KeyError:
-		return create_error_element(500, "Internal Error")
+def get_project_page_data(db_path: str, mod_slug: str) -> Optional[dict]:
+	"""
+	Query the data of the project page and create its figures
 
-	latest_timestamp = project_data['date_collected']
+	:return: json serializable page data (see render_project_page), None if the project doesn't exist
+	"""
+	result = get_project_data(db_path, mod_slug)
+	if result is None:
+		return None
+	project_data, authors, downloads_by_file, downloads_composition, downloads_by_origin = result
 
-	authors = ", ".join(authors)
-	project_url = f"https://www.curseforge.com/minecraft/{project_data['type']}/{project_data['slug']}"
-	dropdown_options = []
+	# the history might be rolled up into buckets, thus the latest timestamp isn't necessarily the date_collected
+	latest_timestamp = int(downloads_composition['timestamp'].max()) if len(downloads_composition) > 0 else project_data['date_collected']
 
 	if len(downloads_composition) > 0:
 		latest_download_composition = downloads_composition[downloads_composition['timestamp'] == latest_timestamp].iloc[0]
 		total_downloads = latest_download_composition['total_download_count']
 		direct_downloads = latest_download_composition['direct_download_count']
 		dependant_download_count = latest_download_composition['dependant_download_count']
-		dropdown_options = [{'label': strformat_timestamp(timestamp), 'value': timestamp} for timestamp in downloads_composition['timestamp']]
 	else:
 		latest_download_composition = downloads_composition
 		total_downloads = downloads_by_file.groupby('timestamp').sum().sort_values(by='timestamp', ascending=False).iloc[0]['download_count']
 		direct_downloads = 0
 		dependant_download_count = 0
 
-	cf_points = int(total_downloads * (100 / 5650))
-	us_dollar = cf_points / 100 * 5
-
+	figures = {}
+	for figure_id, create_figure, df in (
+			('downloads_composition', create_project_downloads_figure, latest_download_composition),
+			('downloads_by_file', create_project_downloads_by_file_figure, downloads_by_file),
+			('downloads_origin', create_downloads_by_origin_figure, downloads_by_origin),
+	):
+		try:
+			figures[figure_id] = json.loads(create_figure(df).to_json())
+		except KeyError:
+			figures[figure_id] = None
+
+	return json.loads(plotly.io.json.to_json_plotly(dict(
+		project=dict(project_data), authors=authors, latest_timestamp=latest_timestamp,
+		total_downloads=total_downloads, direct_downloads=direct_downloads, dependant_download_count=dependant_download_count,
+		composition=downloads_composition.to_dict('records'), figures=figures,
+	)))
+
+
+def get_prerendered_page_path(mod_slug: str) -> str:
+	return os.path.join(prerenderDir, f"{mod_slug}.json.gz")
+
+
+def load_prerendered_page_data(mod_slug: str) -> Optional[dict]:
+	"""
+	:return: the pre-rendered page data, None if pre-rendering is disabled or the page wasn't pre-rendered
+	"""
+	if not prerenderDir or "/" in mod_slug or mod_slug.startswith("."):
+		return None
 	try:
-		composition_graph = create_graph('downloads_composition', create_project_downloads_figure(latest_download_composition))
-	except KeyError:
-		composition_graph = create_error_element(404, "Data Not Found")
+		with gzip.open(get_prerendered_page_path(mod_slug), 'rt', encoding='utf-8') as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return None
+
+
+def prerender_project_pages(db_path: str, output_dir: str, project_ids: Optional[List[int]] = None, logger: Optional[logging.Logger] = None) -> int:
+	"""
+	Pre-render the page data and figures of the projects to compressed json, the dashboard serves them instead of querying the db
+
+	:param db_path:
+	:param output_dir:
+	:param project_ids: projects that are pre-rendered, None for all tracked mods
+	:param logger:
+	:return: number of pre-rendered pages
+	"""
+	db: Database = connect_db(db_path)
+	if project_ids is None:
+		slugs = [project['slug'] for project in db_util.get_tracked_projects_with_logo(db, is_mod=True)]
+	else:
+		slugs = [project['slug'] for project in db['project'].find(id=project_ids)]
+	db.close()
 
+	os.makedirs(output_dir, exist_ok=True)
+	count = 0
+	for slug in slugs:
+		try:
+			page_data = get_project_page_data(db_path, slug)
+		except (KeyError, IndexError) as error:
+			if logger:
+				logger.warning(f"Failed to pre-render the page of <{slug}> -> {error}")
+			continue
+		if page_data is None:
+			continue
+
+		# the dashboard might read the page while it is written
+		file_path = os.path.join(output_dir, f"{slug}.json.gz")
+		with gzip.open(f"{file_path}.tmp", 'wt', encoding='utf-8') as f:
+			json.dump(page_data, f, separators=(',', ':'))
+		os.replace(f"{file_path}.tmp", file_path)
+		count += 1
+
+	return count
+
+
+def get_project_info(db_path: str, mod_id: int):
+	db: Database = connect_db(db_path)
+	project = db['project'].find_one(id=mod_id)
+	authors = [author['name'] for author in db_util.get_project_authors(db, mod_id)]
+	db.close()
+	return project, authors
+
+
+def get_project_downloads(db_path: str, mod_id: int) -> Optional[dict]:
+	"""
+	:return: total, direct and dependant downloads of the latest snapshot, None if the project has no snapshots
+	"""
+	db: Database = connect_db(db_path)
 	try:
-		file_graph = create_graph('downloads_by_file', create_project_downloads_by_file_figure(downloads_by_file))
-	except KeyError:
-		file_graph = create_error_element(404, "Data Not Found")
+		# the raw snapshot of the last run, or the newest rollup row on dbs that were compacted before the last runs were kept
+		snapshot = db_util.get_project_snapshot_at(db, mod_id)
+		if snapshot is None:
+			return None
+		timestamp = snapshot['timestamp']
+		composition = list(db_util.get_project_downloads_by_composition(db, mod_id, start=timestamp, end=timestamp, granularity=snapshot['granularity']))
+	finally:
+		db.close()
+
+	if composition:
+		row = composition[0]
+		return dict(total_downloads=row['total_download_count'], direct_downloads=row['direct_download_count'], dependant_download_count=row['dependant_download_count'])
+	return dict(total_downloads=snapshot['download_count'], direct_downloads=0, dependant_download_count=0)
+
+
+def get_project_file_downloads(db_path: str, mod_id: int) -> pd.DataFrame:
+	db: Database = connect_db(db_path)
+	df = pd.DataFrame.from_dict(db_util.get_project_downloads_by_file(db, mod_id))
+	db.close()
+	if len(df) > 0:
+		df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
+	return df
+
+
+def get_project_composition(db_path: str, mod_id: int) -> pd.DataFrame:
+	db: Database = connect_db(db_path)
+	df = pd.DataFrame.from_dict(db_util.get_project_downloads_by_composition(db, mod_id))
+	db.close()
+	return df
+
+
+def get_project_origin(db_path: str, mod_id: int) -> pd.DataFrame:
+	db: Database = connect_db(db_path)
+	df = get_project_downloads_by_origin(db, mod_id)
+	db.close()
+	return df
+
 
+def create_project_content(mod_name: str):
+	"""
+	The page of a pre-rendered project is rendered at once, otherwise the header is rendered right away and the panels
+	are filled by their own callbacks (see update_info_panel, update_downloads_panel and the chart panel callbacks)
+	"""
 	try:
-		origin_graph = create_graph('downloads_origin', create_downloads_by_origin_figure(downloads_by_origin))
+		page_data = load_prerendered_page_data(mod_name)
 	except KeyError:
-		origin_graph = create_error_element(404, "Data Not Found")
+		return create_error_element(500, "Internal Error")
+	if page_data is not None:
+		return render_project_page(page_data)
+
+	db: Database = connect_db(dbUrl)
+	project_data = db['project'].find_one(slug=mod_name)
+	db.close()
+	if not project_data:
+		return create_error_element(404, "Data Not Found")
+
+	def create_panel(panel_id: str, class_name: str = ""):
+		return dcc.Loading(html.Div(id=panel_id, className=class_name), type="dot", parent_className=class_name)
+
+	return create_project_page_layout(
+		project_data,
+		info_panel=create_panel('info-panel'),
+		downloads_panels=create_panel('downloads-panel', "contents"),
+		file_panel=create_panel('file-chart-panel'),
+		composition_panel=create_panel('composition-chart-panel'),
+		origin_panel=create_panel('origin-chart-panel'),
+		panels_store=dcc.Store(id='project-panels', data=dict(id=project_data['id'], slug=project_data['slug'])),
+	)
+
+
+def create_info_panel(project_data: dict, authors: List[str]):
+	project_url = f"https://www.curseforge.com/minecraft/{project_data['type']}/{project_data['slug']}"
+	return html.Div([
+		html.H2(["Info"], className="text-xl"),
+		html.Div([html.Span(["CF Id:"], className="mr-4"), html.Span([project_data["id"]])]),
+		html.Div([
+			html.Span(["CF Slug:"], className="mr-4"),
+			html.A([
+				project_data["slug"],
+				html.Span(["↗"], className="group-hover:text-purple-600")
+			], href=project_url, className="group text-purple-400 hover:text-purple-600 transition duration-100 ease-in")
+		]),
+		html.Div([html.Span(["Author:"], className="mr-4"), html.Span([", ".join(authors)])]),
+		html.Div([html.Span(["Type:"], className="mr-4"), html.Span([project_data["type"]])]),
+		html.Div([html.Span(["Created:"], className="mr-4"), html.Span([strformat_timestamp(project_data['date_created'])])]),
+		html.Div([html.Span(["Updated:"], className="mr-4"), html.Span([strformat_timestamp(project_data['date_modified'])])])
+	], className="bg-gray-600 bg-opacity-50 p-3 rounded shadow-lg")
+
+
+def create_downloads_panels(total_downloads: int, direct_downloads: int, dependant_download_count: int):
+	"""
+	:return: the downloads and the worth estimation panel
+	"""
+	cf_points = int(total_downloads * (100 / 5650))
+	us_dollar = cf_points / 100 * 5
+
+	return [
+		html.Div([
+			html.Div([html.H2(["Downloads"], className="text-xl")]),
+			html.Span([total_downloads], className="font-black text-6xl"),
+			html.Div([
+				html.H3(["Composition"], className="text-lg"),
+				html.Span(["Through CF Mod Page:"], className="mr-4"),
+				html.Span([direct_downloads, f" ({get_percentage(direct_downloads, total_downloads)}%)"])
+			], className="mt-2"),
+			html.Div([
+				html.Span(["Included By Dependents:"], className="mr-4"),
+				html.Span([dependant_download_count, f" ({get_percentage(dependant_download_count, total_downloads)}%)"])]),
+		], className="bg-gray-600 bg-opacity-50 p-3 rounded shadow-lg"),
+		html.Div([
+			html.H2(["Worth Estimation"], className="text-xl"),
+			html.Div([
+				cf_points, " CFP* ",
+				html.Small(["≈ $", html.Span(['%.2f' % us_dollar])], className="text-base"),
+			], className="font-black text-5xl"),
+			html.Small(["*Assuming 100 CF points equal 5650 downloads"], className="text-yellow-400"),
+		], className="bg-gray-600 bg-opacity-50 p-3 rounded shadow-lg"),
+	]
+
+
+def create_chart_panel(figure_id: str, figure):
+	return create_graph(figure_id, figure) if figure is not None else create_error_element(404, "Data Not Found")
 
+
+def create_composition_panel(dropdown_options: List[dict], latest_timestamp: int, figure):
+	return html.Div([
+		dcc.Dropdown(
+			id='timestamp-dropdown',
+			options=dropdown_options,
+			value=latest_timestamp,
+			className="cursor-pointer"
+		),
+		create_chart_panel('downloads_composition', figure),
+	])
+
+
+def create_project_page_layout(project_data: dict, info_panel, downloads_panels, file_panel, composition_panel, origin_panel, panels_store=None):
 	return html.Div([
+		panels_store,
 		html.Div([
 			html.Div([
 				html.Img(src=project_data["logo"], className="w-16 h-16 rounded"),
 				html.Div([
 					html.H1([project_data["name"]], className="text-4xl"),
 					html.Div([
-						"updated: ", html.Abbr([get_data_time_diff(latest_timestamp)], title=strformat_timestamp(latest_timestamp)), " ago"
+						"updated: ", html.Abbr([get_data_time_diff(project_data['date_collected'])], title=strformat_timestamp(project_data['date_collected'])), " ago"
 					], className="text-sm")
 				], className="flex flex-col")
 			], className="flex flex-row gap-2"),
 			html.Div([
-				html.Div([
-					html.H2(["Info"], className="text-xl"),
-					html.Div([html.Span(["CF Id:"], className="mr-4"), html.Span([project_data["id"]])]),
-					html.Div([
-						html.Span(["CF Slug:"], className="mr-4"),
-						html.A([
-							project_data["slug"],
-							html.Span(["↗"], className="group-hover:text-purple-600")
-						], href=project_url, className="group text-purple-400 hover:text-purple-600 transition duration-100 ease-in")
-					]),
-					html.Div([html.Span(["Author:"], className="mr-4"), html.Span([authors])]),
-					html.Div([html.Span(["Type:"], className="mr-4"), html.Span([project_data["type"]])]),
-					html.Div([html.Span(["Created:"], className="mr-4"), html.Span([strformat_timestamp(project_data['date_created'])])]),
-					html.Div([html.Span(["Updated:"], className="mr-4"), html.Span([strformat_timestamp(project_data['date_modified'])])])
-				], className="bg-gray-600 bg-opacity-50 p-3 rounded shadow-lg"),
-				html.Div([
-					html.Div([html.H2(["Downloads"], className="text-xl")]),
-					html.Span([total_downloads], className="font-black text-6xl"),
-					html.Div([
-						html.H3(["Composition"], className="text-lg"),
-						html.Span(["Through CF Mod Page:"], className="mr-4"),
-						html.Span([direct_downloads, f" ({get_percentage(direct_downloads, total_downloads)}%)"])
-					], className="mt-2"),
-					html.Div([
-						html.Span(["Included By Dependents:"], className="mr-4"),
-						html.Span([dependant_download_count, f" ({get_percentage(dependant_download_count, total_downloads)}%)"])]),
-				], className="bg-gray-600 bg-opacity-50 p-3 rounded shadow-lg"),
-				html.Div([
-					html.H2(["Worth Estimation"], className="text-xl"),
-					html.Div([
-						cf_points, " CFP* ",
-						html.Small(["≈ $", html.Span(['%.2f' % us_dollar])], className="text-base"),
-					], className="font-black text-5xl"),
-					html.Small(["*Assuming 100 CF points equal 5650 downloads"], className="text-yellow-400"),
-				], className="bg-gray-600 bg-opacity-50 p-3 rounded shadow-lg"),
+				info_panel,
+				*(downloads_panels if isinstance(downloads_panels, list) else [downloads_panels]),
 			], className="flex flex-row flex-wrap items-start gap-4 mt-4")
 		], className="w-full bg-gray-600 bg-opacity-50 p-3 rounded shadow-lg"),
 		html.Div([
 			html.Div([
 				html.H2(f"Downloads by File", className="text-xl"),
-				file_graph,
+				file_panel,
 			], className="flex-auto w-full md:w-2/3 lg:w-3/5 xl:w-1/2"),
 			html.Div([
 				html.H2(f"Total Downloads Composition", className="text-xl mb-2"),
-				dcc.Dropdown(
-					id='timestamp-dropdown',
-					options=dropdown_options,
-					value=latest_timestamp,
-					className="cursor-pointer"
-				),
-				composition_graph,
+				composition_panel,
 			], className="flex-auto w-full md:w-1/2 lg:w-2/5 xl:w-1/3"),
 			html.Div([
 				html.H2(f"Total Downloads by Origin", className="text-xl"),
-				origin_graph,
+				origin_panel,
 			], className="flex-auto w-full md:w-2/3 lg:w-3/5 xl:w-1/2")
 		], className="flex flex-row flex-wrap items-start gap-4 p-3 bg-gray-600 bg-opacity-50 rounded")
 	], className="flex flex-col gap-4")
 
 
+def render_project_page(page_data: dict):
+	project_data = page_data['project']
+	dropdown_options = [{'label': strformat_timestamp(row['timestamp']), 'value': row['timestamp']} for row in page_data['composition']]
+	figures = page_data['figures']
+
+	return create_project_page_layout(
+		project_data,
+		info_panel=create_info_panel(project_data, page_data['authors']),
+		downloads_panels=create_downloads_panels(page_data['total_downloads'], page_data['direct_downloads'], page_data['dependant_download_count']),
+		file_panel=create_chart_panel('downloads_by_file', figures['downloads_by_file']),
+		composition_panel=create_composition_panel(dropdown_options, page_data['latest_timestamp'], figures['downloads_composition']),
+		origin_panel=create_chart_panel('downloads_origin', figures['downloads_origin']),
+	)
+
+
 def create_sidebar_content():
 	return html.Div([
 		html.Div([
 			html.H1("MC Mod CF Stats", className="font-black text-2xl"),
+			dcc.Input(id='search-input', type='search', placeholder="search projects...", debounce=True, className="p-1 rounded text-black"),
 			html.Div(id='search-result', className="flex flex-col gap-2 hidden"),
 		], className="flex flex-col gap-2 bg-gray-600 bg-opacity-50 p-3 rounded shadow-lg"),
 		html.Nav([
@@ -342,49 +578,186 @@ def create_app_layout():
 	], className="h-full text-white")
 
 
+def create_background_callback_manager():
+	"""
+	:return: manager of the background callbacks of the slow panels, None if diskcache isn't installed (the panels are loaded by regular callbacks)
+	"""
+	try:
+		import diskcache
+		return dash.DiskcacheManager(diskcache.Cache(BACKGROUND_CALLBACK_CACHE_DIR))
+	except ImportError:
+		return None
+
+
+BACKGROUND_CALLBACK_CACHE_DIR = os.path.join(tempfile.gettempdir(), "mc_mod_cf_stats_dashboard_callbacks")
+backgroundCallbackManager = create_background_callback_manager()
+
 app = dash.Dash(
 	# include the whole tailwindcss build via CDN, while it has downsides (https://tailwindcss.com/docs/installation#using-tailwind-via-cdn)
 	# it allows very easy styling of the dash html/dcc elements via the className parameter
 	external_stylesheets=["https://unpkg.com/tailwindcss@^2/dist/tailwind.min.css"],
-	suppress_callback_exceptions=True
+	suppress_callback_exceptions=True,
+	background_callback_manager=backgroundCallbackManager
 )
 
-dbUrl = "sqlite:///mod_stats.db"  # url to the database created with the DatasetSaveHandler (supports SQLite, PostgreSQL or MySQL)
+PROJECTS_PAGE_SIZE = 50  # modpacks/other projects per page of the tracked projects list
+SEARCH_RESULT_LIMIT = 10
+
+# the background callbacks run in separate processes that might import this module again (spawn start method),
+# thus the settings are also read from env vars that configure() exports
+SETTINGS_ENV_VARS = {
+	'dbUrl': "DS_MM_CF_DASHBOARD_DB_URL",
+	'prerenderDir': "DS_MM_CF_DASHBOARD_PRERENDER_DIR",
+	'dependenciesDbUrl': "DS_MM_CF_DASHBOARD_DEPENDENCIES_DB_URL",
+}
+
+dbUrl = os.environ.get(SETTINGS_ENV_VARS['dbUrl']) or "sqlite:///mod_stats.db"  # url to the database created with the DatasetSaveHandler (supports SQLite, PostgreSQL or MySQL)
+prerenderDir = os.environ.get(SETTINGS_ENV_VARS['prerenderDir']) or None  # directory of the pages pre-rendered with prerender_project_pages, pages that weren't pre-rendered are queried from the db
+dependenciesDbUrl = os.environ.get(SETTINGS_ENV_VARS['dependenciesDbUrl']) or None  # url to the SQLite db of the DependencyResolver, set it if the DatasetSaveHandler was used with a dependencies_db_url
+
+
+def configure(db_url: str, dependencies_db_url: Optional[str] = None, prerender_dir: Optional[str] = None):
+	"""
+	Set the settings of the dashboard and export them to the env of the processes of the background callbacks
+
+	:param db_url: see dbUrl
+	:param dependencies_db_url: see dependenciesDbUrl
+	:param prerender_dir: see prerenderDir
+	"""
+	global dbUrl, dependenciesDbUrl, prerenderDir
+	dbUrl, dependenciesDbUrl, prerenderDir = db_url, dependencies_db_url, prerender_dir
+	for name, env_var in SETTINGS_ENV_VARS.items():
+		value = globals()[name]
+		if value:
+			os.environ[env_var] = value
+		else:
+			os.environ.pop(env_var, None)
+
 
 app.layout = create_app_layout()
+app.server.register_blueprint(stats_api.create_blueprint(lambda: connect_db(dbUrl)))
+
+
+@app.callback(
+	Output('info-panel', 'children'),
+	Input('project-panels', 'data')
+)
+@profiled("dashboard_update_info_panel")
+def update_info_panel(project_ref: dict):
+	project_data, authors = get_project_info(dbUrl, project_ref['id'])
+	if not project_data:
+		return create_error_element(404, "Data Not Found")
+	return create_info_panel(project_data, authors)
+
+
+@app.callback(
+	Output('downloads-panel', 'children'),
+	Input('project-panels', 'data')
+)
+@profiled("dashboard_update_downloads_panel")
+def update_downloads_panel(project_ref: dict):
+	downloads = get_project_downloads(dbUrl, project_ref['id'])
+	if downloads is None:
+		return create_error_element(404, "Data Not Found")
+	return create_downloads_panels(**downloads)
+
+
+# the charts query the download history, thus they are loaded by background callbacks (if available)
+
+@app.callback(
+	Output('file-chart-panel', 'children'),
+	Input('project-panels', 'data'),
+	background=backgroundCallbackManager is not None
+)
+@profiled("dashboard_update_file_chart_panel")
+def update_file_chart_panel(project_ref: dict):
+	df = get_project_file_downloads(dbUrl, project_ref['id'])
+	try:
+		return create_chart_panel('downloads_by_file', create_project_downloads_by_file_figure(df))
+	except KeyError:
+		return create_chart_panel('downloads_by_file', None)
+
+
+@app.callback(
+	Output('composition-chart-panel', 'children'),
+	Input('project-panels', 'data'),
+	background=backgroundCallbackManager is not None
+)
+@profiled("dashboard_update_composition_chart_panel")
+def update_composition_chart_panel(project_ref: dict):
+	df = get_project_composition(dbUrl, project_ref['id'])
+	if len(df) == 0:
+		return create_chart_panel('downloads_composition', None)
+	latest_timestamp = int(df['timestamp'].max())
+	dropdown_options = [{'label': strformat_timestamp(timestamp), 'value': timestamp} for timestamp in df['timestamp'].tolist()]
+	figure = create_project_downloads_figure(df[df['timestamp'] == latest_timestamp].iloc[0])
+	return create_composition_panel(dropdown_options, latest_timestamp, figure)
+
+
+@app.callback(
+	Output('origin-chart-panel', 'children'),
+	Input('project-panels', 'data'),
+	background=backgroundCallbackManager is not None
+)
+@profiled("dashboard_update_origin_chart_panel")
+def update_origin_chart_panel(project_ref: dict):
+	df = get_project_origin(dbUrl, project_ref['id'])
+	try:
+		return create_chart_panel('downloads_origin', create_downloads_by_origin_figure(df))
+	except KeyError:
+		return create_chart_panel('downloads_origin', None)
 
 
 @app.callback(
 	Output('downloads_composition', 'figure'),
 	Input('timestamp-dropdown', 'value'),
 	State("url", "pathname"),
-	State('downloads_composition', 'figure')
+	State('downloads_composition', 'figure'),
+	prevent_initial_call=True  # the panel is created with the figure of the selected timestamp
 )
+@profiled("dashboard_update_output")
 def update_output(timestamp, pathname: str, prev_figure):
 
 	if not timestamp:
 		return prev_figure
 
-	db: Database = dataset.connect(dbUrl)
-	project = db['project'].find_one(slug=pathname.split("/")[-1])
+	page_data = load_prerendered_page_data(pathname.split("/")[-1])
+	if page_data is not None:
+		downloads_composition = pd.DataFrame.from_records(page_data['composition'])
+	else:
+		db: Database = connect_db(dbUrl)
+		project = db['project'].find_one(slug=pathname.split("/")[-1])
 
-	if not project:
-		return prev_figure
+		if not project:
+			return prev_figure
 
-	downloads_composition = pd.DataFrame.from_dict(db_util.get_project_downloads_by_composition(db, project['id']))
-	latest_download_composition = downloads_composition[downloads_composition['timestamp'] == timestamp].iloc[0]
+		downloads_composition = pd.DataFrame.from_dict(db_util.get_project_downloads_by_composition(db, project['id']))
+		db.close()
 
-	db.close()
+	latest_download_composition = downloads_composition[downloads_composition['timestamp'] == timestamp].iloc[0]
 	return create_project_downloads_figure(latest_download_composition)
 
 
+@app.callback(
+	Output('search-result', 'children'),
+	Output('search-result', 'className'),
+	Input('search-input', 'value')
+)
+@profiled("dashboard_handle_search")
+def handle_search(text: Optional[str]):
+	if not text or not text.strip():
+		return [], "flex flex-col gap-2 hidden"
+	return create_search_result(search_projects(dbUrl, text)), "flex flex-col gap-2"
+
+
 @app.callback(
 	Output('page-content', 'children'),
-	[Input("url", "pathname")]
+	[Input("url", "pathname"), Input("url", "search")]
 )
-def handle_page_content(pathname: str):
+@profiled("dashboard_handle_page_content")
+def handle_page_content(pathname: str, search: Optional[str]):
 	if pathname == "/":
-		return create_tracked_projects_content()
+		return create_tracked_projects_content(pathname, search)
 	elif pathname.startswith("/data/"):
 		return create_project_content(pathname.replace("/data/", ""))
 	return ""
@@ -392,13 +765,13 @@ def handle_page_content(pathname: str):
 
 @app.callback(
 	Output('sidebar-content', 'children'),
-	[Input("url", "pathname")]
+	[Input("url", "pathname"), Input("url", "search")]
 )
-def handle_sidebar_content(pathname: str):
+def handle_sidebar_content(pathname: str, search: Optional[str]):
 	if pathname == "/":
 		return ""
 	elif pathname.startswith("/data/"):
-		return create_tracked_projects_content()
+		return create_tracked_projects_content(pathname, search)
 	return ""
 
 
@@ -1,29 +1,207 @@
+import re
+from typing import Optional
+from urllib.parse import quote
+
+import dataset
 from dataset import Database, Table
 from dataset.util import ResultIter
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 
+import rollups
 
-def create_view_dependant_downloads(db: Database):
-	db.query("""
-	CREATE VIEW dependant_downloads AS
+# the collector is the only writer, the dashboard (and the cli) only read
+# WAL allows the readers to query the last committed state while the collector holds its long-running transaction
+SQLITE_WRITER_PRAGMAS = {
+	'journal_mode': "WAL",
+	'synchronous': "NORMAL",  # durable enough in WAL mode, a power loss can only drop the last commits
+	'cache_size': -64000,  # in KiB -> 64 MB
+	'mmap_size': 256 * 1024 * 1024,
+	'temp_store': "MEMORY",
+	'busy_timeout': 10000,  # ms
+}
+SQLITE_READER_PRAGMAS = {  # + query_only, it is enabled after the connection is set up
+	'cache_size': -64000,
+	'mmap_size': 256 * 1024 * 1024,
+	'temp_store': "MEMORY",
+	'busy_timeout': 10000,
+}
+
+DEPENDENCIES_SCHEMA = "dependencies"
+PROJECT_SEARCH_TABLE = "project_search"
+
+DEPENDANT_DOWNLOADS_QUERY_TEMPLATE = """
 	SELECT project_id, name, dependency_project_id, SUM(download_count) AS download_count, timestamp
 	FROM (
 		SELECT b.project_id, c.name, b.file_id, a.dependency_project_id, download_count, timestamp
-		FROM file_downloads b
+		FROM {file_downloads} b
 			JOIN file_dependencies a ON b.project_id = a.project_id AND b.file_id = a.file_id
 			JOIN project c ON b.project_id = c.id
 		GROUP BY b.project_id, b.file_id, a.dependency_project_id, timestamp
 	)
 	GROUP BY timestamp, dependency_project_id, project_id
+"""
+DEPENDANT_DOWNLOADS_QUERY = DEPENDANT_DOWNLOADS_QUERY_TEMPLATE.format(file_downloads="file_downloads")
+
+
+def connect(db_url: str, read_only: bool = False, dependencies_db_url: Optional[str] = None) -> Database:
+	"""
+	Connect to the database, file based SQLite databases are tuned with SQLITE_WRITER_PRAGMAS or SQLITE_READER_PRAGMAS
+
+	:param db_url: SQLite, PostgreSQL or MySQL
+	:param read_only: open SQLite databases in read-only mode (the database has to exist)
+	:param dependencies_db_url: SQLite db of the DependencyResolver, it is attached and replaces the file_dependencies table (see attach_dependencies_db)
+	"""
+	url = make_url(db_url)
+	if url.get_backend_name() != 'sqlite' or not url.database or url.database == ':memory:' or url.database.startswith('file:'):
+		if dependencies_db_url:
+			raise ValueError("attaching the dependencies db is only supported for file based SQLite databases")
+		return dataset.connect(db_url)
+
+	dependencies_db_path = None
+	if dependencies_db_url:
+		dependencies_db_path = make_url(dependencies_db_url).database
+		if make_url(dependencies_db_url).get_backend_name() != 'sqlite' or not dependencies_db_path:
+			raise ValueError("attaching the dependencies db is only supported for file based SQLite databases")
+
+	pragmas = SQLITE_WRITER_PRAGMAS
+	if read_only:
+		# no immutable=1, the collector might write to the file while it is read
+		db_url = f"sqlite:///file:{quote(url.database)}?mode=ro&uri=true"
+		pragmas = SQLITE_READER_PRAGMAS
+		if dependencies_db_path:
+			dependencies_db_path = f"file:{quote(dependencies_db_path)}?mode=ro"
+
+	def on_connect(dbapi_connection, connection_record):
+		# changing temp_store drops all temp views and query only connections can't create them, thus the order matters
+		apply_sqlite_pragmas(dbapi_connection, pragmas)
+		if dependencies_db_path:
+			attach_dependencies_db(dbapi_connection, dependencies_db_path)
+		if read_only:
+			apply_sqlite_pragmas(dbapi_connection, {'query_only': "ON"})
+
+	db = dataset.connect(db_url, ensure_schema=not read_only)
+	event.listen(db.engine, 'connect', on_connect)
+	return db
+
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas: dict):
+	cursor = dbapi_connection.cursor()
+	for key, value in pragmas.items():
+		cursor.execute(f"PRAGMA {key}={value}")
+	cursor.close()
+
+
+def attach_dependencies_db(dbapi_connection, dependencies_db_path: str):
+	"""
+	Attach the db of the DependencyResolver and shadow the file_dependencies table and the dependant_downloads view with temp views,
+	thus the dependencies are queried from the dependency table of the resolver instead of a copy
+	"""
+	cursor = dbapi_connection.cursor()
+	cursor.execute(f"ATTACH DATABASE ? AS {DEPENDENCIES_SCHEMA}", (dependencies_db_path,))
+	# views of the main schema can't reference attached databases, thus temp views are used (temp objects are resolved first)
+	# only dependencies on saved projects are relevant, this keeps the aggregation of the manifest dependencies on other mods out of dependant_downloads
+	cursor.execute(f"""
+	CREATE TEMP VIEW file_dependencies AS
+	SELECT project_id, file_id, dependency_project_id, dependency_file_id
+	FROM {DEPENDENCIES_SCHEMA}.dependency
+	WHERE dependency_project_id IN (SELECT id FROM main.project)
 	""")
+	cursor.execute(f"CREATE TEMP VIEW dependant_downloads AS {DEPENDANT_DOWNLOADS_QUERY}")
+	cursor.close()
+
+
+def create_view_dependant_downloads(db: Database):
+	db.query(f"CREATE VIEW dependant_downloads AS {DEPENDANT_DOWNLOADS_QUERY}")
+
+
+def has_project_search_index(db: Database) -> bool:
+	if db.engine.dialect.name != 'sqlite':
+		return False
+	return any(True for _ in db.query(f"SELECT name FROM sqlite_master WHERE type = 'table' AND name = '{PROJECT_SEARCH_TABLE}'"))
+
+
+def create_project_search_index(db: Database):
+	"""
+	Create the FTS5 index over the slug, name and summary of the projects (SQLite only), the rowid is the project id
+
+	It's a standalone index, the DatasetSaveHandler updates it together with the changed project rows.
+	"""
+	if db.engine.dialect.name != 'sqlite' or has_project_search_index(db):
+		return
+	db.query(f"CREATE VIRTUAL TABLE {PROJECT_SEARCH_TABLE} USING fts5(slug, name, summary, tokenize = 'unicode61 remove_diacritics 2')")
+	if db.has_table('project'):
+		db.query(f"INSERT INTO {PROJECT_SEARCH_TABLE} (rowid, slug, name, summary) SELECT id, slug, name, summary FROM project")
+
+
+def update_project_search_index(db: Database, project_id: int, slug: str, name: str, summary: str):
+	db.query(f"DELETE FROM {PROJECT_SEARCH_TABLE} WHERE rowid = :id", id=project_id)
+	db.query(f"INSERT INTO {PROJECT_SEARCH_TABLE} (rowid, slug, name, summary) VALUES (:id, :slug, :name, :summary)", id=project_id, slug=slug, name=name, summary=summary)
+
 
+def _get_search_query(text: str) -> str:
+	"""
+	:return: FTS5 query that matches all words of the text as prefixes, special characters of the query syntax are dropped
+	"""
+	return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text))
 
-def get_tracked_projects_with_logo(db: Database):
+
+def search_projects(db: Database, text: str, limit: int = 10, offset: int = 0):
+	"""
+	Search the projects by slug, name and summary, without the FTS5 index (e.g. PostgreSQL) the slug and name are matched with LIKE
+	"""
+	if has_project_search_index(db):
+		query = _get_search_query(text)
+		if not query:
+			return []
+		return db.query(f"""
+		SELECT p.id, p.slug, p.name, p.type, p.logo, p.date_collected
+			FROM {PROJECT_SEARCH_TABLE} s
+				JOIN project p ON p.id = s.rowid
+			WHERE {PROJECT_SEARCH_TABLE} MATCH :match
+			ORDER BY s.rank
+			LIMIT {int(limit)} OFFSET {int(offset)}
+		""", match=query)
+
+	pattern = f"%{text.strip()}%"
+	return db.query(f"""
+	SELECT id, slug, name, type, logo, date_collected
+		FROM project
+		WHERE slug LIKE :pattern OR name LIKE :pattern
+		ORDER BY slug
+		LIMIT {int(limit)} OFFSET {int(offset)}
+	""", pattern=pattern)
+
+
+def _get_project_type_clause(is_mod: Optional[bool]) -> str:
+	if is_mod is None:
+		return ""
+	return "WHERE type = 'mc-mods'" if is_mod else "WHERE (type IS NULL OR type <> 'mc-mods')"
+
+
+def get_tracked_projects_with_logo(db: Database, is_mod: Optional[bool] = None, limit: Optional[int] = None, offset: int = 0):
+	"""
+	:param db:
+	:param is_mod: only mods (True) or only modpacks and other projects (False)
+	:param limit: page size, None for all projects
+	:param offset:
+	"""
+	page = f"LIMIT {int(limit)} OFFSET {int(offset)}" if limit is not None else ""
 	return db.query(f"""
 		SELECT slug, type, logo, date_collected
 		FROM project
+		{_get_project_type_clause(is_mod)}
+		ORDER BY slug
+		{page}
 	""")
 
 
+def get_project_count(db: Database, is_mod: Optional[bool] = None) -> int:
+	for row in db.query(f"SELECT COUNT(*) AS count FROM project {_get_project_type_clause(is_mod)}"):
+		return row['count']
+	return 0
+
+
 def get_project_download_count_latest(db: Database, mod_id: int):
 	return db.query(f"""
 		SELECT download_count, MAX(timestamp) AS timestamp
@@ -32,30 +210,97 @@ def get_project_download_count_latest(db: Database, mod_id: int):
 	""")
 
 
-def get_project_downloads_by_composition(db: Database, mod_id: int):
+def get_project_snapshot_at(db: Database, mod_id: int, timestamp: Optional[int] = None) -> Optional[dict]:
+	"""
+	Find the latest download snapshot of the project at or before the timestamp
+
+	The raw snapshot is used unless the raw snapshots were compacted, then the rollup row whose rolled up snapshot
+	is the latest one at or before the timestamp is used (a rollup row is labeled with the start of its bucket,
+	but its counts are those of the snapshot at snapshot_timestamp, which can be after the label).
+
+	:param db:
+	:param mod_id:
+	:param timestamp: inclusive, None for the latest snapshot
+	:return: granularity, timestamp (the label of the row), snapshot_timestamp and download_count, None if there is no snapshot
+	"""
+	compacted_before = {}
+	if db.has_table('rollup_compaction'):
+		compacted_before = {row['granularity']: row['compacted_before'] for row in db['rollup_compaction'].all()}
+
+	snapshot = None
+	for granularity in rollups.GRANULARITIES:
+		name = rollups.get_table_name('project_downloads', granularity)
+		if not db.has_table(name):
+			continue
+		column = 'timestamp' if granularity == 'raw' else 'snapshot_timestamp'
+		time_clause = f" AND {column} <= {int(timestamp)}" if timestamp is not None else ""
+		for row in db.query(f"""
+			SELECT download_count, timestamp, {column} AS snapshot_timestamp
+				FROM {name}
+			WHERE project_id = {int(mod_id)}{time_clause}
+			ORDER BY {column} DESC
+			LIMIT 1
+		"""):
+			if snapshot is None or row['snapshot_timestamp'] > snapshot['snapshot_timestamp']:
+				snapshot = dict(granularity=granularity, **row)
+
+		# every snapshot after the compaction cutoff is still in raw, thus the rollups can't hold a later one
+		if granularity == 'raw' and snapshot and snapshot['snapshot_timestamp'] >= compacted_before.get('raw', 0):
+			return snapshot
+
+	return snapshot
+
+
+def _get_granularity(db: Database, mod_id: int, start: Optional[int], end: Optional[int], granularity: Optional[str]) -> str:
+	return granularity if granularity else rollups.choose_granularity(db, mod_id, start, end)
+
+
+def _get_time_range_clause(column: str, start: Optional[int], end: Optional[int]) -> str:
+	clause = ""
+	if start is not None:
+		clause += f" AND {column} >= {int(start)}"
+	if end is not None:
+		clause += f" AND {column} <= {int(end)}"
+	return clause
+
+
+def _get_dependant_downloads_source(granularity: str) -> str:
+	if granularity == 'raw':
+		return "dependant_downloads"
+	return f"({DEPENDANT_DOWNLOADS_QUERY_TEMPLATE.format(file_downloads=rollups.get_table_name('file_downloads', granularity))})"
+
+
+# The download history queries accept an optional time range (inclusive epoch seconds).
+# The granularity ('raw', 'hourly', 'daily' or 'weekly', see rollups.GRANULARITIES) is chosen by the time range if it isn't given.
+
+def get_project_downloads_by_composition(db: Database, mod_id: int, start: Optional[int] = None, end: Optional[int] = None, granularity: Optional[str] = None):
+	granularity = _get_granularity(db, mod_id, start, end, granularity)
 	return db.query(f"""
 	SELECT a.dependency_project_id AS project_id, b.download_count AS total_download_count, SUM(a.download_count) AS dependant_download_count, b.download_count - SUM(a.download_count) AS direct_download_count, b.timestamp
 		FROM
-			(dependant_downloads a INNER JOIN project_downloads b ON a.dependency_project_id = b.project_id AND a.timestamp = b.timestamp)
-		WHERE a.dependency_project_id = {mod_id}
+			({_get_dependant_downloads_source(granularity)} a INNER JOIN {rollups.get_table_name('project_downloads', granularity)} b ON a.dependency_project_id = b.project_id AND a.timestamp = b.timestamp)
+		WHERE a.dependency_project_id = {mod_id}{_get_time_range_clause('a.timestamp', start, end)}
 		GROUP BY a.dependency_project_id, a.timestamp;
 	""")
 
 
-def get_project_downloads_by_origin(db: Database, mod_id: int):
+def get_project_downloads_by_origin(db: Database, mod_id: int, start: Optional[int] = None, end: Optional[int] = None, granularity: Optional[str] = None):
+	granularity = _get_granularity(db, mod_id, start, end, granularity)
+	dependant_downloads = _get_dependant_downloads_source(granularity)
+	time_range = _get_time_range_clause('timestamp', start, end)
 	return db.query(f"""
 	SELECT project_id, name, download_count, 100 * CAST(download_count AS FLOAT) / SUM(download_count) OVER (PARTITION BY timestamp) AS percentage, timestamp
 	FROM
 		(
 		SELECT project_id, name, SUM(download_count) AS download_count, timestamp
-			FROM dependant_downloads
-			WHERE dependency_project_id = {mod_id}
+			FROM {dependant_downloads}
+			WHERE dependency_project_id = {mod_id}{time_range}
 			GROUP BY dependency_project_id, project_id, timestamp
 		UNION ALL
 		SELECT a.dependency_project_id AS project_id, "CurseForge Mod Page" AS name, b.download_count - SUM(a.download_count) AS download_count, b.timestamp
-			FROM dependant_downloads a
-				INNER JOIN project_downloads b ON a.dependency_project_id = b.project_id AND a.timestamp = b.timestamp
-			WHERE a.dependency_project_id = {mod_id}
+			FROM {dependant_downloads} a
+				INNER JOIN {rollups.get_table_name('project_downloads', granularity)} b ON a.dependency_project_id = b.project_id AND a.timestamp = b.timestamp
+			WHERE a.dependency_project_id = {mod_id}{_get_time_range_clause('a.timestamp', start, end)}
 			GROUP BY a.dependency_project_id, a.timestamp
 		)
 	""")
@@ -70,21 +315,23 @@ def get_project_authors(db: Database, mod_id: int):
 	""")
 
 
-def get_project_downloads_by_file(db: Database, mod_id: int):
+def get_project_downloads_by_file(db: Database, mod_id: int, start: Optional[int] = None, end: Optional[int] = None, granularity: Optional[str] = None):
+	granularity = _get_granularity(db, mod_id, start, end, granularity)
 	return db.query(f"""
 	SELECT fd.project_id, f.file_id, f.file_name, download_count, timestamp
-		FROM file_downloads fd
+		FROM {rollups.get_table_name('file_downloads', granularity)} fd
 			JOIN file f ON f.file_id = fd.file_id AND f.project_id = fd.project_id
-		WHERE fd.project_id = {mod_id}
+		WHERE fd.project_id = {mod_id}{_get_time_range_clause('timestamp', start, end)}
 		GROUP BY fd.file_id, timestamp;
 	""")
 
 
-def get_project_file_downloads_total(db: Database, mod_id: int):
+def get_project_file_downloads_total(db: Database, mod_id: int, start: Optional[int] = None, end: Optional[int] = None, granularity: Optional[str] = None):
+	granularity = _get_granularity(db, mod_id, start, end, granularity)
 	return db.query(f"""
 	SELECT project_id, SUM(download_count) AS download_count, timestamp
-		FROM file_downloads
-		WHERE project_id = {mod_id}
+		FROM {rollups.get_table_name('file_downloads', granularity)}
+		WHERE project_id = {mod_id}{_get_time_range_clause('timestamp', start, end)}
 		GROUP BY project_id, timestamp;
 	""")
 
@@ -99,10 +346,11 @@ def get_project_dependents(db: Database, mod_id: int):
 	""")
 
 
-def get_dependant_downloads_total(db: Database, mod_id: int):
+def get_dependant_downloads_total(db: Database, mod_id: int, start: Optional[int] = None, end: Optional[int] = None, granularity: Optional[str] = None):
+	granularity = _get_granularity(db, mod_id, start, end, granularity)
 	return db.query(f"""
 	SELECT project_id, name, SUM(download_count) AS download_count, timestamp
-		FROM dependant_downloads
-		WHERE dependency_project_id = {mod_id}
+		FROM {_get_dependant_downloads_source(granularity)}
+		WHERE dependency_project_id = {mod_id}{_get_time_range_clause('timestamp', start, end)}
 		GROUP BY dependency_project_id, project_id, timestamp;
 	""")
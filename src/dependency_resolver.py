@@ -4,16 +4,26 @@ import logging
 import os
 import time
 import zipfile
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from enum import unique, IntEnum
-from typing import Optional, List
+from typing import Optional, List, Iterator, Tuple, Dict, Callable, Iterable, NamedTuple
 
-import dataset
 import requests
 from dataset import Database, Table
 
+import db_util
+from metrics import metrics
+from profiling import profiled
 from web_apis import ApiHelper
 
 
+FINGERPRINT_BATCH_SIZE = 500  # fingerprints per CFCore request
+UNMATCHED_FINGERPRINT_TTL = 30 * 86400  # seconds until unmatched fingerprints are looked up again (e.g. jars uploaded later)
+HASH_ALGORITHMS = {1: "sha1", 2: "md5"}  # CFCore file hash algos, in order of preference
+
+
 @unique
 class SkipReason(IntEnum):
 	ZERO_DOWNLOADS = 0,
@@ -22,18 +32,83 @@ class SkipReason(IntEnum):
 	FILE_PARSING_ERROR = 4
 
 
-class FileIdentifier:
-	def __init__(self, project_id: int, file_id: int):
-		self._project_id: int = project_id
-		self._file_id: int = file_id
+class FileIdentifier(NamedTuple):
+	project_id: int
+	file_id: int
+
+
+class FileIdSet:
+	"""
+	Set of file identifiers backed by a sorted array of packed int64 keys (project id in the high, file id in the low 32 bits)
+
+	Uses 8 bytes per file instead of a FileIdentifier object per file, the identifiers are created on iteration.
+	Added keys are appended and only sorted and deduplicated when the set is read.
+	"""
+	__slots__ = ('_keys', '_is_sorted')
+
+	def __init__(self, files: Iterable[FileIdentifier] = ()):
+		self._keys = array('q')
+		self._is_sorted = True
+		self.update(files)
+
+	@staticmethod
+	def _pack(project_id: int, file_id: int) -> int:
+		if not (0 <= project_id < 1 << 31 and 0 <= file_id < 1 << 32):
+			raise ValueError(f"ids out of range -> project id: {project_id}, file id: {file_id}")
+		return project_id << 32 | file_id
+
+	def _compact(self):
+		if self._is_sorted:
+			return
+		keys = array('q')
+		previous = None
+		for key in sorted(self._keys):
+			if key != previous:
+				keys.append(key)
+				previous = key
+		self._keys = keys
+		self._is_sorted = True
+
+	def add(self, file: FileIdentifier):
+		key = self._pack(file[0], file[1])
+		if self._is_sorted and len(self._keys) > 0 and key <= self._keys[-1]:
+			self._is_sorted = False
+		self._keys.append(key)
+
+	def update(self, files: Iterable[FileIdentifier]):
+		for file in files:
+			self.add(file)
+
+	def __contains__(self, file) -> bool:
+		self._compact()
+		key = self._pack(file[0], file[1])
+		index = bisect_left(self._keys, key)
+		return index < len(self._keys) and self._keys[index] == key
+
+	def __len__(self) -> int:
+		self._compact()
+		return len(self._keys)
+
+	def __iter__(self) -> Iterator[FileIdentifier]:
+		self._compact()
+		for key in self._keys:
+			yield FileIdentifier(key >> 32, key & 0xFFFFFFFF)
+
+	def __eq__(self, other) -> bool:
+		if not isinstance(other, FileIdSet):
+			return NotImplemented
+		self._compact()
+		other._compact()
+		return self._keys == other._keys
 
-	@property
-	def project_id(self):
-		return self._project_id
+	__hash__ = None  # mutable
 
-	@property
-	def file_id(self):
-		return self._file_id
+	def file_ids(self) -> List[int]:
+		"""
+		:return: the file ids in ascending (project id, file id) order, e.g. for CFCoreApi.get_files
+		"""
+		self._compact()
+		return [key & 0xFFFFFFFF for key in self._keys]
 
 
 class DependencyResolverInterface(metaclass=abc.ABCMeta):
@@ -50,13 +125,25 @@ class DependencyResolverInterface(metaclass=abc.ABCMeta):
 		raise NotImplementedError
 
 	@abc.abstractmethod
-	def get_project_dependents(self, project_id: int, project_name: str) -> [list, List[FileIdentifier]]:
+	def get_project_dependents(self, project_id: int, project_name: str) -> Tuple[list, FileIdSet]:
 		"""
 		Get all files that depend on this project
 
 		:param project_id:
 		:param project_name:
-		:return: list of file dependents
+		:return: dependents and the set of their resolved files
+		"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	def iter_project_dependents(self, project_id: int, project_name: str, skip_dependant: Optional[Callable[[dict], bool]] = None) -> Iterator[Tuple[dict, FileIdSet]]:
+		"""
+		Lazily get the files that depend on this project, one dependant at a time
+
+		:param project_id:
+		:param project_name:
+		:param skip_dependant: predicate that receives the dependant project info, dependents for which it returns True aren't resolved
+		:return: iterator of (dependant project info, resolved file dependents) pairs, yielded as soon as a dependant is resolved
 		"""
 		raise NotImplementedError
 
@@ -83,7 +170,7 @@ class DependencyResolver(DependencyResolverInterface):
 		self.max_file_length = max_file_length
 		self.apiHelper = api_helper
 		self.tempFolderPath = temp_download_folder_path
-		self.db: Database = dataset.connect(db_url)
+		self.db: Database = db_util.connect(db_url)
 		self._init_db()
 
 	def __exit__(self, exc_type, exc_val, exc_tb):
@@ -105,6 +192,14 @@ class DependencyResolver(DependencyResolverInterface):
 			table.create_column('timestamp', db.types.integer)
 			table.create_column('url', db.types.string)
 
+		if not db.has_table('skipped_file_job'):
+			table: Table = db.create_table('skipped_file_job')
+			table.create_column('job_id', db.types.integer)
+			table.create_column('project_id', db.types.integer)
+			table.create_column('file_id', db.types.integer)
+			table.create_column('success', db.types.boolean)
+			table.create_index(['job_id'])
+
 		if not db.has_table('dependency'):
 			table: Table = db.create_table('dependency', primary_id=False)
 			table.create_column('project_id', db.types.integer)
@@ -113,6 +208,23 @@ class DependencyResolver(DependencyResolverInterface):
 			table.create_column('dependency_file_id', db.types.integer)
 			table.create_index(['project_id', 'file_id', 'dependency_project_id'])
 
+		if not db.has_table('archive'):
+			# content-addressed archive cache, the dependencies of an archive are stored once as the dependencies of its first file
+			table: Table = db.create_table('archive', primary_id=False)
+			table.create_column('hash', db.types.string)
+			table.create_column('project_id', db.types.integer)
+			table.create_column('file_id', db.types.integer)
+			table.create_index(['hash'], unique=True)
+
+		if not db.has_table('fingerprint'):
+			# fingerprint -> file cache, the ids of unmatched fingerprints are NULL
+			table: Table = db.create_table('fingerprint', primary_id=False)
+			table.create_column('fingerprint', db.types.bigint)
+			table.create_column('project_id', db.types.integer)
+			table.create_column('file_id', db.types.integer)
+			table.create_column('timestamp', db.types.integer)
+			table.create_index(['fingerprint'], unique=True)
+
 	def is_file_depending_on_project(self, file: FileIdentifier, project_id: int) -> bool:
 		if self.db['dependency'].find_one(project_id=file.project_id, file_id=file.file_id, dependency_project_id=project_id):
 			return True
@@ -124,32 +236,37 @@ class DependencyResolver(DependencyResolverInterface):
 			return FileIdentifier(project_id, result['dependency_file_id'])
 		return None
 
-	def get_project_dependents(self, project_id: int, project_name: str) -> [list, List[FileIdentifier]]:
+	def get_project_dependents(self, project_id: int, project_name: str) -> Tuple[list, FileIdSet]:
+		resolved_files = FileIdSet()
+		resolved_dependents = []
+		for dependant, dependencies in self.iter_project_dependents(project_id, project_name):
+			resolved_dependents.append(dependant)
+			resolved_files.update(dependencies)
+
+		return resolved_dependents, resolved_files
+
+	def iter_project_dependents(self, project_id: int, project_name: str, skip_dependant: Optional[Callable[[dict], bool]] = None) -> Iterator[Tuple[dict, FileIdSet]]:
 		dependents_ids = self.apiHelper.get_mod_dependents(project_id, project_name)
 		if not dependents_ids:
 			self.logger.warning("No Dependents Found")
-			return [], []
+			return
 
 		self.logger.info(f'Found {len(dependents_ids)} dependents')
-		time.sleep(0.5)
 		try:
-			response = self.apiHelper.cf_api.get_mods(dependents_ids)
-			response.raise_for_status()
-			dependents = response.json()["data"]
-		except requests.RequestException as error:
+			# only the used fields of the dependents are kept, they are held in memory while the dependents are resolved
+			dependents = list(self.apiHelper.cf_api.iter_mods(dependents_ids))
+		except (requests.RequestException, ValueError) as error:
 			self.logger.error(f"Failed to query dependents info for project id <{project_id}> -> CFCore API: {error}")
-			return [], []
+			return
 
-		resolved_files = []
-		resolved_dependents = []
 		for dependant in dependents:
+			if skip_dependant and skip_dependant(dependant):
+				self.logger.debug(f"Skipping dependant <{dependant['name']}>")
+				continue
+
 			dependencies = self._resolve_project_dependencies(dependant)
 			if len(dependencies) > 0:
-				resolved_dependents.append(dependant)
-				for dependency in dependencies:
-					resolved_files.append(dependency)
-
-		return resolved_dependents, resolved_files
+				yield dependant, dependencies
 
 	def _are_file_dependencies_resolved(self, file: FileIdentifier) -> bool:
 		result = self.db['file'].find_one(project_id=file.project_id, file_id=file.file_id)
@@ -157,180 +274,597 @@ class DependencyResolver(DependencyResolverInterface):
 			target = result['dependency_count']
 			resolved = self.db['dependency'].count(project_id=file.project_id, file_id=file.file_id)
 			if resolved == target:
+				metrics.inc("cache_requests_total", cache="resolved_file", result="hit")
 				return True
 
+		metrics.inc("cache_requests_total", cache="resolved_file", result="miss")
 		return False
 
-	def _resolve_project_dependencies(self, dependant: dict, skip_zero_downloads=False) -> List[FileIdentifier]:
+	@profiled("dependency_resolution")
+	def _resolve_project_dependencies(self, dependant: dict, skip_zero_downloads=False) -> FileIdSet:
 		self.logger.info(f'Checking dependant <{dependant["name"]}>...')
 		if skip_zero_downloads and dependant['downloadCount'] == 0:
 			self.logger.warning(f"Skipping project <{dependant['name']}> with 0 downloads -> 'skip_zero_downloads' is set to True")
-			return []
+			return FileIdSet()
+
+		files = self.get_project_files(dependant)
+		if files is None:
+			return FileIdSet()
+
+		self.logger.info(f'found {len(files)} files')
+		resolved_dependencies = FileIdSet()
+		for file in files:
+			if self.resolve_file(file, skip_zero_downloads):
+				resolved_dependencies.add(FileIdentifier(file['modId'], file['id']))
+
+		return resolved_dependencies
 
-		time.sleep(0.5)
+	def get_project_files(self, dependant: dict) -> Optional[list]:
+		"""
+		:return: files of the project, None if the query failed
+		"""
 		try:
 			response = self.apiHelper.cf_api.get_mod_files(dependant['id'])  # TODO: handle pagination
 			response.raise_for_status()
-			files = response.json()["data"]
+			return response.json()["data"]
 		except requests.RequestException as error:
 			self.logger.error(f"Failed to query project files for id <{dependant['id']}> -> CFCore API: {error}")
-			return []
+			return None
 
-		self.logger.info(f'found {len(files)} files')
-		resolved_dependencies = []
+	def is_file_resolved(self, file: FileIdentifier) -> bool:
+		"""whether the dependencies of the file are resolved, i.e. resolve_file doesn't have to download it"""
+		return self._are_file_dependencies_resolved(file)
 
-		for file in files:
-			file_identifier = FileIdentifier(file['modId'], file['id'])
+	def resolve_file(self, file: dict, skip_zero_downloads=False) -> bool:
+		"""
+		Resolve the dependencies of a file of the CFCore API, the archive is only downloaded if they aren't known yet
 
-			self.logger.debug("Checking if the file dependencies are already resolved")
-			if self._are_file_dependencies_resolved(file_identifier):
-				resolved_dependencies.append(file_identifier)
-				self.logger.debug(f"Skipping file <{file['fileName']}> -> dependencies are resolved")
-				continue
+		:return: whether the dependencies of the file are resolved
+		"""
+		file_identifier = FileIdentifier(file['modId'], file['id'])
 
-			if skip_zero_downloads and file['downloadCount'] == 0:
-				self.db['skipped_file'].upsert(dict(
-					project_id=file_identifier.project_id, file_id=file_identifier.file_id,
-					reason=SkipReason.ZERO_DOWNLOADS.value, timestamp=int(time.time()), url=file['downloadUrl']
-				), ['project_id', 'file_id'])
-				self.logger.warning(f"Skipping file <{file['fileName']}> with 0 downloads -> 'skip_zero_downloads' is set to True")
-				continue
+		self.logger.debug("Checking if the file dependencies are already resolved")
+		if self._are_file_dependencies_resolved(file_identifier):
+			self.logger.debug(f"Skipping file <{file['fileName']}> -> dependencies are resolved")
+			return True
 
-			if not self._resolve_file_dependencies(file_identifier, file['fileName'], file['downloadUrl'], file['fileLength']):
-				self.logger.error(f"Failed to properly resolve dependencies for <{file['fileName']}>")
-				continue
+		if skip_zero_downloads and file['downloadCount'] == 0:
+			self._save_skipped_file(file_identifier, SkipReason.ZERO_DOWNLOADS, file['downloadUrl'])
+			self.logger.warning(f"Skipping file <{file['fileName']}> with 0 downloads -> 'skip_zero_downloads' is set to True")
+			return False
 
-			resolved_dependencies.append(file_identifier)
+		archive_hash = get_archive_hash(file)
+		if archive_hash and self._link_archive_dependencies(file_identifier, archive_hash):
+			metrics.inc("download_bytes_saved_total", file['fileLength'])
+			self.logger.debug(f"Skipping download of file <{file['fileName']}> -> identical archive was already resolved")
+			return True
 
-		return resolved_dependencies
+		if not self._resolve_file_dependencies(file_identifier, file['fileName'], file['downloadUrl'], file['fileLength'], archive_hash=archive_hash):
+			self.logger.error(f"Failed to properly resolve dependencies for <{file['fileName']}>")
+			return False
+
+		return True
 
 	def remove_skipped_file(self, project_id: int, file_id: int):
 		self.db['skipped_file'].delete(project_id=project_id, file_id=file_id)
 
-	def resolve_skipped_file_dependencies(self, reason: SkipReason, max_file_length: float = 5e8, timestamp: int = None):  # 5e8 = 500 MB
+	def _save_skipped_file(self, file: FileIdentifier, reason: SkipReason, file_url: str):
+		self.db['skipped_file'].upsert(dict(
+			project_id=file.project_id, file_id=file.file_id,
+			reason=reason.value, timestamp=int(time.time()), url=file_url
+		), ['project_id', 'file_id'])
+		metrics.inc("db_rows_written_total", database="dependency_resolver", table="skipped_file")
+
+	@profiled("resolve_skipped_files")
+	def resolve_skipped_file_dependencies(self, reason: SkipReason, max_file_length: float = 5e8, timestamp: int = None, download_workers: int = 2, parse_workers: int = 2, prioritize: bool = True, job_id: int = None, progress_interval: float = 30):  # 5e8 = 500 MB
+		"""
+		Retry the dependency resolution of skipped files with a pool of download threads and parse processes
+
+		:param reason: only retry files that were skipped for this reason
+		:param max_file_length: max download size in bytes
+		:param timestamp: only retry files that were skipped at this time
+		:param download_workers: number of concurrent downloads
+		:param parse_workers: number of processes used for parsing the downloaded archives
+		:param prioritize: resolve the files of the modpacks with the highest download count first
+		:param job_id: id of an interrupted job that should be resumed, files that were already attempted by the job are skipped
+		:param progress_interval: min seconds between progress reports
+		:return: job id that can be used to resume the job
+		"""
 		if timestamp:
-			results = self.db['skipped_file'].find(reason=reason.value, timestamp=timestamp)
-			count = self.db['skipped_file'].count(reason=reason.value, timestamp=timestamp)
+			skipped_files = list(self.db['skipped_file'].find(reason=reason.value, timestamp=timestamp))
 		else:
-			results = self.db['skipped_file'].find(reason=reason.value)
-			count = self.db['skipped_file'].count(reason=reason.value)
-
-		if results:
-			self.logger.info(f"Attempting to resolve the dependencies of {count} files. This may take a while...")
-			resolved = 0
-			for skipped_file in results:
-				fid = FileIdentifier(skipped_file['project_id'], skipped_file['file_id'])
-				url = skipped_file['url']
-				file_name = url.split("/")[-1]
-				if not self._resolve_file_dependencies(fid, file_name, url, 1, max_file_length=max_file_length):
-					self.logger.error(f"Failed to properly resolve dependencies for <{file_name}>")
-				else:
-					self.db['skipped_file'].delete(project_id=fid.project_id, file_id=fid.file_id)
-					resolved += 1
-			self.logger.info(f"Resolved {resolved} of {count} files ({resolved / count * 100}%)")
+			skipped_files = list(self.db['skipped_file'].find(reason=reason.value))
+
+		if job_id is None:
+			job_id = int(time.time())
 		else:
+			attempted = {(row['project_id'], row['file_id']) for row in self.db['skipped_file_job'].find(job_id=job_id)}
+			skipped_files = [row for row in skipped_files if (row['project_id'], row['file_id']) not in attempted]
+			self.logger.info(f"Resuming job <{job_id}>, {len(attempted)} files were already attempted")
+
+		count = len(skipped_files)
+		if count == 0:
 			self.logger.info("No skipped files found.")
+			return job_id
+
+		if prioritize:
+			download_counts = self._get_projects_download_count(list({row['project_id'] for row in skipped_files}))
+			skipped_files.sort(key=lambda row: download_counts.get(row['project_id'], 0), reverse=True)
+
+		self.logger.info(f"Attempting to resolve the dependencies of {count} files with {download_workers} download and {parse_workers} parse workers (job id: {job_id}). This may take a while...")
+		progress = _JobProgress(self.logger, count, progress_interval)
+		queue = iter(skipped_files)
+		downloads = {}
+		parses = {}
+
+		with ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="Downloader") as download_pool, ProcessPoolExecutor(max_workers=parse_workers) as parse_pool:
+			def submit_downloads():
+				# keep the number of downloaded but unparsed archives on disk bounded
+				while len(downloads) + len(parses) < download_workers + parse_workers:
+					row = next(queue, None)
+					if row is None:
+						return
+					fid = FileIdentifier(row['project_id'], row['file_id'])
+					url = row['url']
+					future = download_pool.submit(self._fetch_file, url.split("/")[-1], url, self._get_temp_file_path(fid), max_file_length)
+					downloads[future] = (fid, url)
+
+			submit_downloads()
+			while len(downloads) + len(parses) > 0:
+				done, _ = wait(list(downloads.keys()) + list(parses.keys()), return_when=FIRST_COMPLETED)
+				for future in done:
+					if future in downloads:
+						fid, url = downloads.pop(future)
+						success, skip_reason = future.result()
+						if success:
+							parses[parse_pool.submit(read_archive_dependencies, self._get_temp_file_path(fid))] = (fid, url)
+							continue
+						if skip_reason is not None:
+							self._save_skipped_file(fid, skip_reason, url)
+						self._remove_temp_file(fid)  # a download that failed mid-stream leaves a partial file
+						self._finish_skipped_file_job(job_id, fid, False)
+						progress.update(False)
+					else:
+						fid, url = parses.pop(future)
+						try:
+							dependencies, jar_fingerprints = future.result()
+							if dependencies is None and jar_fingerprints:
+								dependencies = self._match_fingerprints(jar_fingerprints)
+						except (zipfile.BadZipFile, json.JSONDecodeError, KeyError, OSError) as error:
+							self.logger.error(f"Failed to parse file <{url.split('/')[-1]}> -> {error}")
+							dependencies = None
+
+						metrics.inc("archives_parsed_total", result="success" if dependencies is not None else "failure")
+						if dependencies is not None:
+							self._save_file_dependencies(fid, dependencies)
+							self.remove_skipped_file(fid.project_id, fid.file_id)
+						else:
+							self.logger.error(f"Failed to properly resolve dependencies for <{url.split('/')[-1]}>")
+							self._save_skipped_file(fid, SkipReason.FILE_PARSING_ERROR, url)
+
+						self._remove_temp_file(fid)
+						self._finish_skipped_file_job(job_id, fid, dependencies is not None)
+						progress.update(dependencies is not None)
+
+				submit_downloads()
+
+		self.logger.info(f"Resolved {progress.resolved} of {count} files ({progress.resolved / count * 100}%)")
+		return job_id
+
+	@profiled("ingest_archive_mirror")
+	def ingest_archive_mirror(self, root_dir: str, workers: Optional[int] = None, match_fingerprints: bool = True, hash_archives: bool = True, batch_size: int = 500, chunk_size: int = 32, progress_interval: float = 30) -> Tuple[int, int]:
+		"""
+		Resolve the dependencies of the archives of a local mirror without downloading them (see archive_mirror for the naming conventions)
+
+		The archives are parsed by a pool of processes and their dependencies are written in bulk, one transaction per batch.
+		Files whose dependencies are already resolved aren't parsed again, thus an interrupted ingestion is resumed by running it again.
+
+		:param root_dir: root directory of the mirror
+		:param workers: number of parse processes, default: number of cpus
+		:param match_fingerprints: resolve archives without a manifest.json by the fingerprints of their jars (unknown fingerprints are looked up via the CFCore API)
+		:param hash_archives: save the content hashes of the archives, thus re-uploads of them are linked instead of downloaded
+		:param batch_size: archives per db transaction
+		:param chunk_size: archives per pool task
+		:param progress_interval: min seconds between progress reports
+		:return: number of resolved and failed archives
+		"""
+		import archive_mirror  # imports this module
+
+		resolved_files = self._get_resolved_files()
+		# files with rows of a partial resolution or a skipped file row, their rows are replaced
+		known_files = FileIdSet(FileIdentifier(row['project_id'], row['file_id']) for row in self.db.query("SELECT project_id, file_id FROM file UNION SELECT project_id, file_id FROM skipped_file"))
+		archives: Dict[FileIdentifier, str] = {}
+		unmapped = 0
+		for path, file in archive_mirror.scan_mirror(root_dir):
+			if file is None:
+				unmapped += 1
+				self.logger.debug(f"Skipping archive <{path}> -> unknown project and file id")
+			elif file not in resolved_files:
+				archives.setdefault(file, path)
+
+		self.logger.info(f"Found {len(archives)} unresolved archives in <{root_dir}> ({unmapped} archives couldn't be mapped to a file)")
+		if not archives:
+			return 0, 0
+
+		workers = workers or os.cpu_count() or 1
+		items = list(archives.items())
+		chunks = iter([items[i:i + chunk_size] for i in range(0, len(items), chunk_size)])
+		progress = _JobProgress(self.logger, len(items), progress_interval)
+		futures = {}
+		batch = []
+
+		with ProcessPoolExecutor(max_workers=workers) as pool:
+			def submit_chunks():
+				# keep the parsed but unsaved results bounded
+				while len(futures) < 2 * workers:
+					chunk = next(chunks, None)
+					if chunk is None:
+						return
+					futures[pool.submit(archive_mirror.read_archives, [path for _, path in chunk], match_fingerprints, hash_archives)] = chunk
+
+			submit_chunks()
+			while len(futures) > 0:
+				done, _ = wait(list(futures.keys()), return_when=FIRST_COMPLETED)
+				for future in done:
+					chunk = futures.pop(future)
+					batch.extend((file, path, content) for (file, path), content in zip(chunk, future.result()))
+				submit_chunks()
+
+				if len(batch) >= batch_size or len(futures) == 0:
+					self._save_mirrored_archives(batch, known_files, match_fingerprints, progress)
+					batch = []
+
+		self.logger.info(f"Resolved {progress.resolved} of {len(items)} archives ({progress.resolved / len(items) * 100}%)")
+		return progress.resolved, progress.failed
+
+	def _get_resolved_files(self) -> FileIdSet:
+		rows = self.db.query("""
+		SELECT f.project_id, f.file_id
+			FROM file f
+			WHERE f.dependency_count = (SELECT COUNT(*) FROM dependency d WHERE d.project_id = f.project_id AND d.file_id = f.file_id)
+		""")
+		return FileIdSet(FileIdentifier(row['project_id'], row['file_id']) for row in rows)
+
+	def _save_mirrored_archives(self, batch: list, known_files: FileIdSet, match_fingerprints: bool, progress: '_JobProgress'):
+		"""
+		:param batch: (file, path, archive_mirror.ArchiveContent) triples
+		:param known_files: files that might have rows in the file, dependency or skipped_file table
+		"""
+		resolved = []
+		for file, path, content in batch:
+			dependencies = content.dependencies
+			if content.error:
+				self.logger.error(f"Failed to parse archive <{path}> -> {content.error}")
+			elif dependencies is None and match_fingerprints and content.jar_fingerprints:
+				# the fingerprints are matched before the transaction, the lookups might query the api
+				dependencies = self._match_fingerprints(content.jar_fingerprints)
+			elif dependencies is None:
+				self.logger.error(f"Failed to parse archive <{path}> -> Missing manifest.json" + ("" if match_fingerprints else " (fingerprint matching is disabled)"))
+
+			metrics.inc("archives_parsed_total", result="success" if dependencies is not None else "failure")
+			if dependencies is not None:
+				resolved.append((file, list(dict.fromkeys(dependencies)), content.hash))
+
+		self.db.begin()
+		try:
+			self._save_files_dependencies(resolved, known_files)
+		except Exception:
+			self.db.rollback()
+			raise
+		self.db.commit()
+
+		for _ in range(len(resolved)):
+			progress.update(True)
+		for _ in range(len(batch) - len(resolved)):
+			progress.update(False)
+
+	def _save_files_dependencies(self, resolved: List[Tuple[FileIdentifier, List[Tuple[int, int]], Optional[str]]], known_files: FileIdSet):
+		"""
+		Bulk variant of _save_file_dependencies and _save_archive
+
+		:param resolved: (file, deduplicated dependencies, archive hash) triples
+		:param known_files: files that might have rows in the file, dependency or skipped_file table, they are deleted first
+		"""
+		for file, _, _ in resolved:
+			if file in known_files:
+				self.db['file'].delete(project_id=file.project_id, file_id=file.file_id)
+				self.db['dependency'].delete(project_id=file.project_id, file_id=file.file_id)
+				self.remove_skipped_file(file.project_id, file.file_id)
+
+		self._insert_rows('file', ('project_id', 'file_id', 'dependency_count'), [
+			(file.project_id, file.file_id, len(dependencies)) for file, dependencies, _ in resolved
+		])
+		dependency_rows = [
+			(file.project_id, file.file_id, dependency_project_id, dependency_file_id)
+			for file, dependencies, _ in resolved
+			for dependency_project_id, dependency_file_id in dependencies
+		]
+		self._insert_rows('dependency', ('project_id', 'file_id', 'dependency_project_id', 'dependency_file_id'), dependency_rows)
+		self._insert_rows('archive', ('hash', 'project_id', 'file_id'), [
+			(archive_hash, file.project_id, file.file_id) for file, _, archive_hash in resolved if archive_hash
+		], "ON CONFLICT (hash) DO NOTHING")
+		metrics.inc("db_rows_written_total", len(resolved), database="dependency_resolver", table="file")
+		metrics.inc("db_rows_written_total", len(dependency_rows), database="dependency_resolver", table="dependency")
+
+	def _insert_rows(self, table_name: str, columns: Tuple[str, ...], rows: List[tuple], conflict_clause: str = ""):
+		"""executemany of the db driver, a multiple faster than dataset's insert_many for large batches"""
+		if not rows:
+			return
+		placeholder = "?" if self.db.engine.dialect.paramstyle == 'qmark' else "%s"
+		self.db.executable.exec_driver_sql(
+			f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join([placeholder] * len(columns))}) {conflict_clause}", rows
+		)
+
+	def _finish_skipped_file_job(self, job_id: int, file: FileIdentifier, success: bool):
+		self.db['skipped_file_job'].upsert(dict(
+			job_id=job_id, project_id=file.project_id, file_id=file.file_id, success=success
+		), ['job_id', 'project_id', 'file_id'])
+
+	def _get_projects_download_count(self, project_ids: List[int], chunk_size: int = 100) -> Dict[int, int]:
+		download_counts = {}
+		for i in range(0, len(project_ids), chunk_size):
+			try:
+				for project in self.apiHelper.cf_api.iter_mods(project_ids[i:i + chunk_size], fields={'id': None, 'downloadCount': None}):
+					download_counts[project['id']] = int(project['downloadCount'])
+			except (requests.RequestException, ValueError) as error:
+				self.logger.warning(f"Failed to query download counts for prioritization -> CFCore API: {error}")
+		return download_counts
+
+	def _get_temp_file_path(self, file: FileIdentifier) -> str:
+		return f"{self.tempFolderPath}/{file.project_id}_{file.file_id}"
+
+	def _remove_temp_file(self, file: FileIdentifier):
+		file_path = self._get_temp_file_path(file)
+		if os.path.exists(file_path):
+			os.remove(file_path)
+
+	def _link_archive_dependencies(self, file: FileIdentifier, archive_hash: str) -> bool:
+		"""
+		Copy the dependencies of an identical archive that was already resolved
 
-	def _resolve_file_dependencies(self, file: FileIdentifier, file_name: str, file_url: str, file_length: float, max_file_length: float = None, delete_temp_file=True) -> bool:
+		:return: False if the archive is unknown
+		"""
+		entry = self.db['archive'].find_one(hash=archive_hash)
+		source = self.db['file'].find_one(project_id=entry['project_id'], file_id=entry['file_id']) if entry else None
+		dependencies = []
+		if source:
+			dependencies = [(row['dependency_project_id'], row['dependency_file_id']) for row in self.db['dependency'].find(project_id=source['project_id'], file_id=source['file_id'])]
+		if not source or len(dependencies) != source['dependency_count']:
+			metrics.inc("cache_requests_total", cache="archive", result="miss")
+			return False
+
+		metrics.inc("cache_requests_total", cache="archive", result="hit")
+		self._save_file_dependencies(file, dependencies)
+		return True
+
+	def _save_archive(self, file: FileIdentifier, archive_hash: str):
+		self.db['archive'].insert_ignore(dict(hash=archive_hash, project_id=file.project_id, file_id=file.file_id), ['hash'])
+
+	def _resolve_file_dependencies(self, file: FileIdentifier, file_name: str, file_url: str, file_length: float, max_file_length: float = None, delete_temp_file=True, archive_hash: Optional[str] = None) -> bool:
 		if max_file_length is None:
 			max_file_length = self.max_file_length
 
 		if file_length > max_file_length:
-			self.db['skipped_file'].upsert(dict(
-				project_id=file.project_id, file_id=file.file_id,
-				reason=SkipReason.DOWNLOAD_TOO_LARGE.value, timestamp=int(time.time()), url=file_url
-			), ['project_id', 'file_id'])
+			self._save_skipped_file(file, SkipReason.DOWNLOAD_TOO_LARGE, file_url)
 			self.logger.warning(f"Skipping file <{file_name}> -> File length of {file_length / 1e6} MB is larger than {max_file_length / 1e6} MB")
 			return False
 
 		success: bool = False
 		if self._download_file(file, file_name, file_url, max_file_length):
 			start_time = time.perf_counter()
-			if self._parse_file(file):
+			parsed = self._parse_file(file)
+			metrics.observe("phase_duration_seconds", time.perf_counter() - start_time, phase="archive_parse")
+			metrics.inc("archives_parsed_total", result="success" if parsed else "failure")
+			if parsed:
 				self.logger.debug(f"Parsing file <{file_name}> took {time.perf_counter() - start_time} seconds")
+				if archive_hash:
+					self._save_archive(file, archive_hash)
 				success = True
 			else:
-				self.db['skipped_file'].upsert(dict(
-					project_id=file.project_id, file_id=file.file_id,
-					reason=SkipReason.FILE_PARSING_ERROR.value, timestamp=int(time.time()), url=file_url
-				), ['project_id', 'file_id'])
+				self._save_skipped_file(file, SkipReason.FILE_PARSING_ERROR, file_url)
 				success = False
 
 		if delete_temp_file:
-			file_path = f"{self.tempFolderPath}/{file.project_id}_{file.file_id}"
-			if os.path.exists(file_path):
-				os.remove(file_path)
+			self._remove_temp_file(file)
 
 		return success
 
 	def _download_file(self, file: FileIdentifier, file_name: str, file_url: str, max_file_length: float) -> bool:
-		time.sleep(0.5)
+		success, skip_reason = self._fetch_file(file_name, file_url, self._get_temp_file_path(file), max_file_length)
+		if skip_reason is not None:
+			self._save_skipped_file(file, skip_reason, file_url)
+		return success
+
+	def _fetch_file(self, file_name: str, file_url: str, file_path: str, max_file_length: float) -> Tuple[bool, Optional[SkipReason]]:
+		"""
+		Download the file without touching the db, thus it's safe to call from worker threads
+
+		:return: success and the reason why the file should be skipped
+		"""
 		try:
-			response = requests.head(file_url, allow_redirects=True, timeout=5)
+			response = self.apiHelper.controller.request('cdn:head', 'HEAD', file_url, allow_redirects=True, timeout=5)
 			response.raise_for_status()
 			header = response.headers
 			content_length = header.get('content-length', None)
 			if content_length and int(content_length) > max_file_length:
-				self.db['skipped_file'].upsert(dict(
-					project_id=file.project_id, file_id=file.file_id,
-					reason=SkipReason.DOWNLOAD_TOO_LARGE.value, timestamp=int(time.time()), url=file_url
-				), ['project_id', 'file_id'])
 				self.logger.error(f"Skipping download of file <{file_name}> -> File length of {int(content_length) / 1e6} MB is larger than {max_file_length / 1e6} MB")
-				return False
+				return False, SkipReason.DOWNLOAD_TOO_LARGE
 		except requests.RequestException as error:
 			self.logger.error(f"Failed to download headers for file <{file_name}> -> {error}")
-			return False
+			return False, None
 
 		os.makedirs(self.tempFolderPath, exist_ok=True)
-		file_path = f"{self.tempFolderPath}/{file.project_id}_{file.file_id}"
 
-		time.sleep(0.5)
 		start_time = time.perf_counter()
 		try:
-			response = requests.get(file_url, allow_redirects=True, timeout=5)
-			response.raise_for_status()
-			with open(file_path, 'wb') as f:
-				f.write(response.content)
-				self.logger.debug(f"Downloading file <{file_name}> took {time.perf_counter() - start_time} seconds")
-				return True
+			# stream the content to disk, large archives shouldn't be kept in memory
+			with self.apiHelper.controller.request('cdn:download', 'GET', file_url, allow_redirects=True, timeout=5, stream=True) as response:
+				response.raise_for_status()
+				with open(file_path, 'wb') as f:
+					for chunk in response.iter_content(chunk_size=1 << 16):
+						f.write(chunk)
+						metrics.inc("download_bytes_total", len(chunk))
+			metrics.observe("phase_duration_seconds", time.perf_counter() - start_time, phase="archive_download")
+			self.logger.debug(f"Downloading file <{file_name}> took {time.perf_counter() - start_time} seconds")
+			return True, None
 		except requests.RequestException as error:
-			self.db['skipped_file'].upsert(dict(
-				project_id=file.project_id, file_id=file.file_id,
-				reason=SkipReason.DOWNLOAD_ERROR.value, timestamp=int(time.time()), url=file_url
-			), ['project_id', 'file_id'])
 			self.logger.error(f"Failed to download file <{file_name}> -> {error}")
+			return False, SkipReason.DOWNLOAD_ERROR
 		except IOError as error:
 			self.logger.error(f"Failed to save file <{file_name}> as <{file_path}> -> {error}")
 
-		return False
+		return False, None
 
 	def _parse_file(self, file: FileIdentifier) -> bool:
-		file_path = f"{self.tempFolderPath}/{file.project_id}_{file.file_id}"
+		file_path = self._get_temp_file_path(file)
 		assert os.path.exists(file_path)
 
 		with zipfile.ZipFile(file_path) as z:
 			if 'manifest.json' in z.namelist():
 				return self._parse_file_manifest(file, z)
-			else:
-				# TODO: find mod jars and get fingerprints and identify mod file with CF Core API
-				self.logger.error("Missing manifest.json")
-				return False
+
+		# archives without a manifest (e.g. server packs) are resolved by the fingerprints of their mod jars
+		import fingerprints  # numpy is only loaded for these archives
+		return self._parse_file_fingerprints(file, fingerprints.get_archive_fingerprints(file_path))
 
 	def _parse_file_manifest(self, file: FileIdentifier, zip_file: zipfile.ZipFile) -> bool:
-		with zip_file.open('manifest.json') as f:
-			data = json.load(f)
-			if "files" in data:
-				projects = data["files"]
-
-				self.db['file'].upsert(dict(
-					project_id=file.project_id, file_id=file.file_id, dependency_count=len(projects)
-				), ['project_id', 'file_id'])
-
-				for project in projects:
-					self.db['dependency'].insert_ignore(dict(
-						project_id=file.project_id, file_id=file.file_id,
-						dependency_project_id=project["projectID"], dependency_file_id=project["fileID"]
-					), ['project_id', 'file_id', 'dependency_project_id', 'dependency_file_id'])
-				return True
+		dependencies = parse_manifest_dependencies(zip_file)
+		if dependencies is not None:
+			self._save_file_dependencies(file, dependencies)
+			return True
+
+		return False
+
+	def _parse_file_fingerprints(self, file: FileIdentifier, jar_fingerprints: List[int]) -> bool:
+		if not jar_fingerprints:
+			self.logger.error("Missing manifest.json and mod jars")
+			return False
+
+		dependencies = self._match_fingerprints(jar_fingerprints)
+		if dependencies is not None:
+			self.logger.debug(f"Matched {len(dependencies)} of {len(jar_fingerprints)} jars by their fingerprint")
+			self._save_file_dependencies(file, dependencies)
+			return True
 
 		return False
+
+	def _match_fingerprints(self, jar_fingerprints: List[int]) -> Optional[List[Tuple[int, int]]]:
+		"""
+		Identify the jars with the cached or CFCore fingerprint matches, the api is only queried for unknown fingerprints
+
+		:return: list of (project id, file id) pairs of the matched jars, None if the fingerprints couldn't be matched
+		"""
+		now = int(time.time())
+		unique_fingerprints = list(dict.fromkeys(jar_fingerprints))
+		matches: Dict[int, Optional[Tuple[int, int]]] = {}
+		for i in range(0, len(unique_fingerprints), FINGERPRINT_BATCH_SIZE):
+			for row in self.db['fingerprint'].find(fingerprint=unique_fingerprints[i:i + FINGERPRINT_BATCH_SIZE]):
+				if row['file_id'] is not None:
+					matches[row['fingerprint']] = (row['project_id'], row['file_id'])
+				elif row['timestamp'] > now - UNMATCHED_FINGERPRINT_TTL:
+					matches[row['fingerprint']] = None
+
+		missing = [fingerprint for fingerprint in unique_fingerprints if fingerprint not in matches]
+		metrics.inc("cache_requests_total", len(unique_fingerprints) - len(missing), cache="fingerprint", result="hit")
+		metrics.inc("cache_requests_total", len(missing), cache="fingerprint", result="miss")
+
+		for i in range(0, len(missing), FINGERPRINT_BATCH_SIZE):
+			batch = missing[i:i + FINGERPRINT_BATCH_SIZE]
+			try:
+				response = self.apiHelper.cf_api.get_fingerprint_matches(batch)
+				response.raise_for_status()
+				exact_matches = response.json()['data']['exactMatches']
+			except (requests.RequestException, ValueError, KeyError) as error:
+				self.logger.error(f"Failed to match {len(batch)} fingerprints -> CFCore API: {error}")
+				return None
+
+			batch_matches = dict.fromkeys(batch)
+			for match in exact_matches:
+				if match['file']['fileFingerprint'] in batch_matches:
+					batch_matches[match['file']['fileFingerprint']] = (match['file']['modId'], match['file']['id'])
+
+			self.db['fingerprint'].upsert_many([
+				dict(fingerprint=fingerprint, project_id=ids[0] if ids else None, file_id=ids[1] if ids else None, timestamp=now)
+				for fingerprint, ids in batch_matches.items()
+			], ['fingerprint'])
+			metrics.inc("db_rows_written_total", len(batch_matches), database="dependency_resolver", table="fingerprint")
+			matches.update(batch_matches)
+
+		return list(dict.fromkeys(matches[fingerprint] for fingerprint in jar_fingerprints if matches[fingerprint] is not None))
+
+	def _save_file_dependencies(self, file: FileIdentifier, dependencies: List[Tuple[int, int]]):
+		self.db['file'].upsert(dict(
+			project_id=file.project_id, file_id=file.file_id, dependency_count=len(dependencies)
+		), ['project_id', 'file_id'])
+		metrics.inc("db_rows_written_total", database="dependency_resolver", table="file")
+		metrics.inc("db_rows_written_total", len(dependencies), database="dependency_resolver", table="dependency")
+
+		for dependency_project_id, dependency_file_id in dependencies:
+			self.db['dependency'].insert_ignore(dict(
+				project_id=file.project_id, file_id=file.file_id,
+				dependency_project_id=dependency_project_id, dependency_file_id=dependency_file_id
+			), ['project_id', 'file_id', 'dependency_project_id', 'dependency_file_id'])
+
+
+def get_archive_hash(file: dict) -> Optional[str]:
+	"""
+	:param file: CFCore file data
+	:return: content hash of the file (e.g. 'sha1:<hex>'), None if the api didn't return a known hash
+	"""
+	hashes = {entry['algo']: entry['value'] for entry in file.get('hashes', []) if entry.get('value')}
+	for algo, name in HASH_ALGORITHMS.items():
+		if algo in hashes:
+			return f"{name}:{hashes[algo].lower()}"
+	return None
+
+
+def parse_manifest_dependencies(zip_file: zipfile.ZipFile) -> Optional[List[Tuple[int, int]]]:
+	"""
+	:return: list of (project id, file id) pairs listed in the manifest.json of the modpack archive
+	"""
+	with zip_file.open('manifest.json') as f:
+		data = json.load(f)
+		if "files" in data:
+			return [(project["projectID"], project["fileID"]) for project in data["files"]]
+	return None
+
+
+def read_archive_dependencies(file_path: str) -> Tuple[Optional[List[Tuple[int, int]]], List[int]]:
+	"""
+	Process pool friendly variant of DependencyResolver._parse_file
+
+	:return: the dependencies listed in the manifest.json or, if the archive has none, the fingerprints of its jars
+	"""
+	with zipfile.ZipFile(file_path) as z:
+		if 'manifest.json' in z.namelist():
+			return parse_manifest_dependencies(z), []
+	import fingerprints  # numpy is only loaded for archives without a manifest
+	# the job already parses the archives in parallel
+	return None, fingerprints.get_archive_fingerprints(file_path, max_workers=1)
+
+
+class _JobProgress:
+	"""Tracks and periodically logs the progress of a long-running job"""
+
+	def __init__(self, logger: logging.Logger, total: int, interval: float):
+		self.logger = logger
+		self.total = total
+		self.interval = interval
+		self.resolved = 0
+		self.failed = 0
+		self._start_time = time.perf_counter()
+		self._last_report = self._start_time
+
+	def update(self, success: bool):
+		if success:
+			self.resolved += 1
+		else:
+			self.failed += 1
+
+		now = time.perf_counter()
+		done = self.resolved + self.failed
+		if now - self._last_report >= self.interval or done == self.total:
+			self._last_report = now
+			elapsed = now - self._start_time
+			eta = elapsed / done * (self.total - done)
+			self.logger.info(f"Progress: {done}/{self.total} files ({self.resolved} resolved, {self.failed} failed), elapsed: {elapsed:.0f}s, eta: {eta:.0f}s")
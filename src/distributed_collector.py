@@ -0,0 +1,190 @@
+# collection of a run by several workers that pull the work from the work queue (see work_queue)
+#
+# A run is split into items of three kinds:
+#   project    tracked project -> project info, files and the dependents (dependant items)
+#   dependant  dependent modpack of a tracked project -> project info, files whose dependencies are resolved (archive items for the rest)
+#   archive    file of a dependant whose dependencies have to be resolved by downloading its archive
+# An item is saved and completed in one transaction of the save handler, the API requests and downloads happen
+# before its writes, thus the write transactions are short and several processes can share one SQLite db.
+import logging
+import time
+from typing import List
+
+import requests
+
+import mod_data_collector
+from dependency_resolver import DependencyResolver, FileIdentifier
+from metrics import metrics
+from save_handlers import SaveHandlerInterface
+from web_apis import ApiHelper, FILE_FIELDS
+from work_queue import WorkQueue, WorkItem, Heartbeat
+
+PROJECT = "project"
+DEPENDANT = "dependant"
+ARCHIVE = "archive"
+
+POLL_INTERVAL = 1  # seconds a worker waits for new items while other workers still hold leases
+
+
+def enqueue_projects(queue: WorkQueue, run: int, mod_ids: List[int], force: bool = False) -> int:
+	"""
+	:param queue:
+	:param run: timestamp of the run
+	:param mod_ids: CurseForge ids of the tracked projects
+	:param force: collect the data even if the download count hasn't changed
+	:return: number of added items (0 for the projects of a resumed run)
+	"""
+	return queue.enqueue(run, ((PROJECT, str(mod_id), mod_id, dict(force=force)) for mod_id in mod_ids))
+
+
+def _get_project_ref(project: dict) -> dict:
+	return dict(id=project['id'], name=project['name'], slug=project['slug'])
+
+
+def _get_archive_payload(project: dict, file: dict) -> dict:
+	# only the fields of the file info and its hashes (archive cache) are kept
+	archive_file = {key: file[key] for key in FILE_FIELDS if key in file}
+	archive_file['hashes'] = file.get('hashes', [])
+	return dict(project=project, file=archive_file)
+
+
+class QueueWorker:
+	"""Processes the items of a run until the queue is drained"""
+
+	def __init__(self, logger: logging.Logger, queue: WorkQueue, save_handler: SaveHandlerInterface, dependency_resolver: DependencyResolver, api_helper: ApiHelper, run: int, poll_interval: float = POLL_INTERVAL):
+		"""
+		:param logger:
+		:param queue: queue in the db of the save handler
+		:param save_handler: save handler of the run, has to be created with shared_run=True
+		:param dependency_resolver:
+		:param api_helper:
+		:param run: timestamp of the run
+		:param poll_interval: seconds between claim attempts while other workers still process items
+		"""
+		self.logger = logger
+		self.queue = queue
+		self.save_handler = save_handler
+		self.dependency_resolver = dependency_resolver
+		self.api_helper = api_helper
+		self.run = run
+		self.poll_interval = poll_interval
+
+	def work(self) -> int:
+		"""
+		:return: number of processed items
+		"""
+		processors = {PROJECT: self._process_project, DEPENDANT: self._process_dependant, ARCHIVE: self._process_archive}
+		processed = 0
+		with Heartbeat(self.queue, self.logger) as heartbeat:
+			while True:
+				item = self.queue.claim(self.run)
+				if item is None:
+					if self.queue.is_drained(self.run):
+						break
+					time.sleep(self.poll_interval)  # items in progress might add new items or their lease expires
+					continue
+
+				self.logger.info(f"processing work item <{item.kind}:{item.key}> (attempt {item.attempts})")
+				heartbeat.add(item)
+				db = self.save_handler.db
+				db.begin()
+				try:
+					with metrics.phase(f"work_item_{item.kind}"):
+						processors[item.kind](item)
+					self.queue.complete(item)
+				except Exception as error:
+					self.logger.exception(f"failed to process work item <{item.kind}:{item.key}>, rollback...")
+					db.rollback()
+					self.queue.fail(item, f"{type(error).__name__}: {error}")
+				else:
+					db.commit()
+				finally:
+					heartbeat.remove(item)
+				processed += 1
+
+		self.logger.info(f"work queue of run <{self.run}> is drained, processed {processed} items")
+		return processed
+
+	def _process_project(self, item: WorkItem):
+		mod_id = item.project_id
+		api_helper = self.api_helper
+		response = api_helper.cf_api.get_mod(mod_id)
+		response.raise_for_status()
+		project = response.json()["data"]
+
+		if not item.payload.get('force', False) and not mod_data_collector.is_stored_project_outdated(self.save_handler, project):
+			self.logger.warning(f"Skipping data collection for project <{project['slug']}> because the project data didn't change")
+			return
+
+		response = api_helper.cf_api.get_mod_files(mod_id)  # TODO: handle pagination
+		response.raise_for_status()
+		files = response.json()["data"]
+
+		dependents = []
+		dependents_ids = api_helper.get_mod_dependents(project['id'], project['name'])
+		if dependents_ids:
+			dependents = list(api_helper.cf_api.iter_mods(dependents_ids))
+		self.logger.info(f"Found {len(files)} files and {len(dependents)} dependents of <{project['slug']}>")
+
+		mod_data_collector.store_project_info(self.save_handler, project)
+		mod_data_collector.store_files(self.save_handler, files)
+		self.save_handler.mark_step_done(f"project:{mod_id}")
+		self.save_handler.mark_step_done(f"files:{mod_id}")
+
+		project_ref = _get_project_ref(project)
+		self.queue.enqueue(self.run, (
+			(DEPENDANT, f"{mod_id}:{dependant['id']}", mod_id, dict(project=project_ref, dependant=dependant))
+			for dependant in dependents
+		))
+
+	def _process_dependant(self, item: WorkItem):
+		project, dependant = item.payload['project'], item.payload['dependant']
+		files = self.dependency_resolver.get_project_files(dependant)
+		if files is None:
+			raise requests.RequestException(f"failed to query the files of dependant <{dependant['name']}>")
+
+		resolved, unresolved = [], []
+		for file in files:
+			if self.dependency_resolver.is_file_resolved(FileIdentifier(file['modId'], file['id'])):
+				resolved.append(file)
+			else:
+				unresolved.append(file)
+		self.logger.info(f"Dependant <{dependant['name']}> has {len(files)} files, {len(unresolved)} archives have to be resolved")
+
+		if files:
+			mod_data_collector.store_project_info(self.save_handler, dependant)
+		for file in resolved:
+			self._store_dependent_file(project, file)
+
+		self.queue.enqueue(self.run, (
+			(ARCHIVE, f"{project['id']}:{file['modId']}:{file['id']}", project['id'], _get_archive_payload(project, file))
+			for file in unresolved
+		))
+
+	def _process_archive(self, item: WorkItem):
+		project, file = item.payload['project'], item.payload['file']
+		# a file that can't be resolved (e.g. too large) is saved as a skipped file by the resolver, retrying it is pointless
+		if self.dependency_resolver.resolve_file(file):
+			self._store_dependent_file(project, file)
+
+	def _store_dependent_file(self, project: dict, file: dict):
+		dependency = self.dependency_resolver.get_file_dependency(FileIdentifier(file['modId'], file['id']), project['id'])
+		if dependency:
+			mod_data_collector.store_file_info(self.save_handler, file)
+			mod_data_collector.store_file_dependency(self.save_handler, file, dependency)
+		else:
+			self.logger.debug(f"Skipping file <{file['fileName']}> -> File does not depend on <{project['slug']}>")
+
+
+def finish_run(queue: WorkQueue, save_handler: SaveHandlerInterface, run: int, mod_ids: List[int]) -> List[int]:
+	"""
+	Journal the tracked projects of a drained run whose items all succeeded as done
+
+	:return: ids of the projects with failed items
+	"""
+	failed = set(queue.get_failed_project_ids(run))
+	for mod_id in mod_ids:
+		if mod_id not in failed and save_handler.is_step_done(f"files:{mod_id}"):
+			save_handler.mark_step_done(f"dependents:{mod_id}")
+			save_handler.mark_step_done(f"run:{mod_id}")
+	return sorted(failed)
@@ -4,8 +4,10 @@ import time
 import dataset
 from dataset import Table
 
+import db_util
 import mod_data_collector
 from dependency_resolver import DependencyResolver, SkipReason
+from metrics import metrics
 from save_handlers import DatasetSaveHandler
 from web_apis import ApiHelper
 
@@ -21,24 +23,45 @@ def create_logger():
 	return logger
 
 
-def main():
+def main(timestamp: int = None, metrics_file_path: str = None):
+	"""
+	:param timestamp: timestamp of an interrupted run that should be resumed
+	:param metrics_file_path: write the run metrics in the Prometheus text format to this file
+	"""
 	logger = create_logger()
 
 	cf_api_key = "CF_CORE_API_KEY"
 	mod_id = 492939  # Project Id (you can find it on the cf mod page) or use the CFCoreAPI to search for the mod by name
-	timestamp = int(time.time())
+	if timestamp is None:
+		timestamp = int(time.time())
 
 	api_helper = ApiHelper(cf_api_key)
 	with DependencyResolver(api_helper, logger.getChild("DependencyResolver")) as dependency_resolver:
 		# SaveHandler implementation of your choice
 		with DatasetSaveHandler("sqlite:///mod_stats.db", timestamp) as save_handler:
+			# completed steps are committed at checkpoints, thus only the unfinished step is rolled back on failure
 			save_handler.db.begin()
-			if mod_data_collector.collect_data(logger.getChild("DataCollector"), save_handler, dependency_resolver, api_helper, mod_id):
+			try:
+				success = mod_data_collector.collect_data(logger.getChild("DataCollector"), save_handler, dependency_resolver, api_helper, mod_id)
+			except Exception:
+				logger.info("rollback db changes of the unfinished step...")
+				save_handler.db.rollback()
+				logger.info(f"resume the run by calling main({timestamp})")
+				raise
+
+			if success:
 				logger.info("committing changes to db...")
 				save_handler.db.commit()
 			else:
 				logger.info("rollback db changes...")
 				save_handler.db.rollback()
+				if save_handler.is_resuming or save_handler.is_step_done(f"project:{mod_id}"):
+					logger.info(f"resume the run by calling main({timestamp})")
+
+	logger.debug(f"api request stats:\n{api_helper.controller.summary()}")
+	logger.info(f"run metrics:\n{metrics.summary()}")
+	if metrics_file_path:
+		metrics.write_prometheus_file(metrics_file_path)
 
 
 def resolve_skipped_dependencies():
@@ -49,7 +72,7 @@ def resolve_skipped_dependencies():
 
 
 def dumb_db_info(db_url: str):
-	db = dataset.connect(db_url)
+	db = db_util.connect(db_url, read_only=True)
 	print("dumping database info...")
 	print("---")
 	tables = db.tables
@@ -0,0 +1,102 @@
+# CurseForge fingerprints of the mod jars inside modpack archives
+#
+# CurseForge identifies files by the 32-bit Murmur2 hash (seed 1) of their content without whitespace bytes.
+# Archives without a manifest.json (e.g. server packs) are resolved by matching the fingerprints of their jars.
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+
+MURMUR2_M = 0x5bd1e995
+MURMUR2_SEED = 1
+UINT32_MASK = 0xFFFFFFFF
+WHITESPACE_BYTES = np.array([9, 10, 13, 32], dtype=np.uint8)  # removed before hashing
+
+PARALLEL_MIN_JAR_BYTES = 64 * 1024 * 1024  # uncompressed jar bytes from which an archive is fingerprinted by a process pool
+
+
+def murmur2(data: bytes, seed: int = MURMUR2_SEED) -> int:
+	"""
+	32-bit MurmurHash2 of the data
+
+	The mixing of the 4 byte blocks is independent and vectorized with NumPy, only the chained state update runs in Python.
+	"""
+	data = np.frombuffer(data, dtype=np.uint8)
+	length = len(data)
+	block_count = length // 4
+	h = (seed ^ length) & UINT32_MASK
+
+	if block_count > 0:
+		k = data[:block_count * 4].view('<u4').astype(np.uint32)
+		with np.errstate(over='ignore'):
+			k *= np.uint32(MURMUR2_M)
+			k ^= k >> np.uint32(24)
+			k *= np.uint32(MURMUR2_M)
+		for block in k.tolist():
+			h = ((h * MURMUR2_M) & UINT32_MASK) ^ block
+
+	tail = data[block_count * 4:].tolist()
+	if tail:
+		for i in reversed(range(len(tail))):
+			h ^= tail[i] << (8 * i)
+		h = (h * MURMUR2_M) & UINT32_MASK
+
+	h ^= h >> 13
+	h = (h * MURMUR2_M) & UINT32_MASK
+	h ^= h >> 15
+	return h
+
+
+def get_fingerprint(data: bytes) -> int:
+	"""
+	:return: CurseForge fingerprint of the file content
+	"""
+	data = np.frombuffer(data, dtype=np.uint8)
+	return murmur2(data[~np.isin(data, WHITESPACE_BYTES)].tobytes())
+
+
+def get_jars(zip_file: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+	return [info for info in zip_file.infolist() if not info.is_dir() and info.filename.lower().endswith('.jar')]
+
+
+def read_jar_fingerprints(file_path: str, jar_names: Optional[List[str]] = None) -> List[int]:
+	"""
+	Process pool friendly fingerprinting of the jars inside the archive
+
+	:param file_path: path of the archive
+	:param jar_names: jars that are fingerprinted, None for all jars of the archive
+	"""
+	with zipfile.ZipFile(file_path) as z:
+		if jar_names is None:
+			jar_names = [info.filename for info in get_jars(z)]
+		return [get_fingerprint(z.read(name)) for name in jar_names]
+
+
+def get_archive_fingerprints(file_path: str, max_workers: Optional[int] = None, parallel_min_bytes: int = PARALLEL_MIN_JAR_BYTES) -> List[int]:
+	"""
+	Fingerprints of all jars inside the archive, large archives are split across a process pool
+
+	:param file_path: path of the archive
+	:param max_workers: max number of processes, 1 fingerprints the archive in the current process (e.g. inside a pool worker)
+	:param parallel_min_bytes: min uncompressed size of the jars for using a process pool
+	"""
+	with zipfile.ZipFile(file_path) as z:
+		jars = get_jars(z)
+
+	max_workers = max_workers if max_workers else os.cpu_count() or 1
+	if max_workers <= 1 or len(jars) <= 1 or sum(info.file_size for info in jars) < parallel_min_bytes:
+		return read_jar_fingerprints(file_path, [info.filename for info in jars])
+
+	# spread the jars by size, every worker opens the archive itself
+	chunks: List[List[str]] = [[] for _ in range(min(max_workers, len(jars)))]
+	chunk_sizes = [0] * len(chunks)
+	for info in sorted(jars, key=lambda info: info.file_size, reverse=True):
+		index = chunk_sizes.index(min(chunk_sizes))
+		chunks[index].append(info.filename)
+		chunk_sizes[index] += info.file_size
+
+	with ProcessPoolExecutor(max_workers=len(chunks)) as pool:
+		results = pool.map(read_jar_fingerprints, [file_path] * len(chunks), chunks)
+		return [fingerprint for fingerprints in results for fingerprint in fingerprints]
@@ -0,0 +1,206 @@
+import bisect
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple, List
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+DESCRIPTIONS: Dict[str, str] = {
+	"api_requests_total": "Number of api requests by endpoint and response status",
+	"api_request_duration_seconds": "Latency of api requests by endpoint",
+	"api_retries_total": "Number of retried api requests by endpoint",
+	"download_bytes_total": "Number of downloaded archive bytes",
+	"download_bytes_saved_total": "Number of archive bytes that weren't downloaded because an identical archive was already resolved",
+	"archives_parsed_total": "Number of parsed modpack archives by result",
+	"db_rows_written_total": "Number of written db rows by database and table",
+	"db_rows_skipped_total": "Number of unchanged db rows that weren't written by database and table",
+	"cache_requests_total": "Number of cache lookups by cache and result",
+	"work_items_total": "Number of work queue items by kind and result (claimed, done, pending = released for a retry, failed)",
+	"phase_duration_seconds": "Duration of the phases of a run",
+}
+
+
+def _label_key(labels: Dict[str, object]) -> LabelKey:
+	return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+	pairs = key + extra
+	if not pairs:
+		return ""
+	escaped = [(k, v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in pairs]
+	return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+	if math.isinf(value):
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+	"""Monotonically increasing value per label set"""
+
+	def __init__(self, name: str, description: str):
+		self.name = name
+		self.description = description
+		self.values: Dict[LabelKey, float] = {}
+
+	def inc(self, value: float = 1, **labels):
+		key = _label_key(labels)
+		self.values[key] = self.values.get(key, 0) + value
+
+	@property
+	def total(self) -> float:
+		return sum(self.values.values())
+
+	def to_prometheus_text(self) -> List[str]:
+		lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+		for key, value in sorted(self.values.items()):
+			lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+		return lines
+
+
+class Histogram:
+	"""Distribution of observed values (e.g. latencies) per label set"""
+
+	def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+		self.name = name
+		self.description = description
+		self.buckets = tuple(sorted(buckets))
+		self.counts: Dict[LabelKey, List[int]] = {}
+		self.sums: Dict[LabelKey, float] = {}
+		self.maxima: Dict[LabelKey, float] = {}
+
+	def observe(self, value: float, **labels):
+		key = _label_key(labels)
+		if key not in self.counts:
+			self.counts[key] = [0] * (len(self.buckets) + 1)
+			self.sums[key] = 0
+			self.maxima[key] = value
+		self.counts[key][bisect.bisect_left(self.buckets, value)] += 1
+		self.sums[key] += value
+		self.maxima[key] = max(self.maxima[key], value)
+
+	def count(self, key: LabelKey) -> int:
+		return sum(self.counts[key])
+
+	def to_prometheus_text(self) -> List[str]:
+		lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+		for key in sorted(self.counts.keys()):
+			cumulative = 0
+			for upper_bound, count in zip(self.buckets + (math.inf,), self.counts[key]):
+				cumulative += count
+				lines.append(f"{self.name}_bucket{_format_labels(key, (('le', _format_value(upper_bound)),))} {cumulative}")
+			lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(self.sums[key])}")
+			lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+		return lines
+
+
+class MetricsRegistry:
+	"""
+	Collects counters and histograms of a run
+
+	The metrics can be exported in the Prometheus text format (as file or via a local http endpoint) or summarized for the log.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._metrics: Dict[str, object] = {}
+
+	def counter(self, name: str, description: str = None) -> Counter:
+		with self._lock:
+			if name not in self._metrics:
+				self._metrics[name] = Counter(name, description or DESCRIPTIONS.get(name, name))
+			return self._metrics[name]
+
+	def histogram(self, name: str, description: str = None, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+		with self._lock:
+			if name not in self._metrics:
+				self._metrics[name] = Histogram(name, description or DESCRIPTIONS.get(name, name), buckets)
+			return self._metrics[name]
+
+	def inc(self, name: str, value: float = 1, **labels):
+		counter = self.counter(name)
+		with self._lock:
+			counter.inc(value, **labels)
+
+	def observe(self, name: str, value: float, **labels):
+		histogram = self.histogram(name)
+		with self._lock:
+			histogram.observe(value, **labels)
+
+	@contextmanager
+	def phase(self, name: str):
+		"""Measure the duration of a phase of the run"""
+		start_time = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe("phase_duration_seconds", time.perf_counter() - start_time, phase=name)
+
+	def reset(self):
+		with self._lock:
+			self._metrics.clear()
+
+	def to_prometheus_text(self) -> str:
+		with self._lock:
+			lines = []
+			for name in sorted(self._metrics.keys()):
+				lines.extend(self._metrics[name].to_prometheus_text())
+			return "\n".join(lines) + "\n"
+
+	def write_prometheus_file(self, file_path: str):
+		"""Atomically write the metrics in the Prometheus text format, e.g. for the node exporter textfile collector"""
+		temp_file_path = f"{file_path}.tmp"
+		with open(temp_file_path, 'w') as f:
+			f.write(self.to_prometheus_text())
+		os.replace(temp_file_path, file_path)
+
+	def serve(self, port: int = 9464, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+		"""Expose the metrics at http://host:port/metrics in a background thread"""
+		registry = self
+
+		class _Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path != "/metrics":
+					self.send_error(404)
+					return
+				body = registry.to_prometheus_text().encode()
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		server = ThreadingHTTPServer((host, port), _Handler)
+		threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+		return server
+
+	def summary(self) -> str:
+		with self._lock:
+			lines = []
+			for name in sorted(self._metrics.keys()):
+				metric = self._metrics[name]
+				if isinstance(metric, Counter):
+					for key, value in sorted(metric.values.items()):
+						lines.append(f"{name}{_format_labels(key)}: {value:g}")
+				else:
+					for key in sorted(metric.counts.keys()):
+						count = metric.count(key)
+						total = metric.sums[key]
+						lines.append(f"{name}{_format_labels(key)}: count={count} sum={total:.3f} mean={total / count:.3f} max={metric.maxima[key]:.3f}")
+			return "\n".join(lines)
+
+
+# default registry that is used by the collector, dependency resolver and save handler
+metrics: MetricsRegistry = MetricsRegistry()
@@ -1,9 +1,12 @@
 import logging
-import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Optional, Tuple
 
 import requests
 
 from dependency_resolver import DependencyResolverInterface, FileIdentifier
+from metrics import metrics
+from profiling import profiled
 from save_handlers import SaveHandlerInterface
 from web_apis import ApiHelper
 
@@ -68,6 +71,7 @@ def is_stored_project_outdated(save_handler: SaveHandlerInterface, data: dict):
 	return save_handler.is_saved_project_outdated(data['id'], data['dateModified'], int(data['downloadCount']))
 
 
+@profiled("collect_data")
 def collect_data(logger: logging.Logger, save_handler: SaveHandlerInterface, dependency_resolver: DependencyResolverInterface, api_helper: ApiHelper, mod_id: int, force=False) -> bool:
 	"""
 	:param logger:
@@ -80,71 +84,150 @@ def collect_data(logger: logging.Logger, save_handler: SaveHandlerInterface, dep
 	"""
 
 	try:
-		response = api_helper.cf_api.get_mod(mod_id)
-		response.raise_for_status()
-		project = response.json()["data"]
+		with metrics.phase("project_query"):
+			response = api_helper.cf_api.get_mod(mod_id)
+			response.raise_for_status()
+			project = response.json()["data"]
 	except requests.RequestException as error:
 		logger.error(f"Failed to query project info for id <{mod_id}> -> CFCore API: {error}")
 		return False
 
-	if not force and not is_stored_project_outdated(save_handler, project):
+	# a journal entry for this run means that a previous attempt with the same timestamp was interrupted
+	resuming = save_handler.is_step_done(f"project:{mod_id}")
+	if resuming:
+		logger.info(f"Resuming interrupted data collection for project <{project['slug']}>")
+	elif not force and not is_stored_project_outdated(save_handler, project):
 		logger.warning(f"Skipping data collection for project <{project['slug']}> because the project data didn't change")
 		return False
 
-	logger.info("Storing Project Info...")
-	store_project_info(save_handler, project)
-
-	logger.info("Fetching Project Files Info...")
-	try:
-		time.sleep(0.5)
-		response = api_helper.cf_api.get_mod_files(mod_id)  # TODO: handle pagination
-		response.raise_for_status()
-		files = response.json()["data"]
-	except requests.RequestException as error:
-		logger.error(f"Failed to query files info for project <{project['slug']}> -> CFCore API: {error}")
-		return False
+	if not resuming:
+		logger.info("Storing Project Info...")
+		with metrics.phase("project_info"):
+			store_project_info(save_handler, project)
+			save_handler.mark_step_done(f"project:{mod_id}")
+			save_handler.checkpoint()
+
+	if not save_handler.is_step_done(f"files:{mod_id}"):
+		logger.info("Fetching Project Files Info...")
+		with metrics.phase("project_files"):
+			try:
+				response = api_helper.cf_api.get_mod_files(mod_id)  # TODO: handle pagination
+				response.raise_for_status()
+				files = response.json()["data"]
+			except requests.RequestException as error:
+				logger.error(f"Failed to query files info for project <{project['slug']}> -> CFCore API: {error}")
+				return False
+
+			if len(files) > 0:
+				store_files(save_handler, files)
+				save_handler.mark_step_done(f"files:{mod_id}")
+				save_handler.checkpoint()
+			else:
+				logger.warning("No Project Files Found")
+				return False
 
-	if len(files) > 0:
-		store_files(save_handler, files)
-	else:
-		logger.warning("No Project Files Found")
-		return False
+	if not save_handler.is_step_done(f"dependents:{mod_id}"):
+		with metrics.phase("dependents"):
+			if not _collect_data_for_project_dependents(logger, save_handler, dependency_resolver, api_helper, project['id'], project['name'], project['slug']):
+				logger.warning(f"Failed to find dependents for <{project['name']}>")
 
-	if not _collect_data_for_project_dependents(logger, save_handler, dependency_resolver, api_helper, project['id'], project['name'], project['slug']):
-		logger.warning(f"Failed to find dependents for <{project['name']}>")
+	if save_handler.is_step_done(f"dependents:{mod_id}"):
+		save_handler.mark_step_done(f"run:{mod_id}")
+		save_handler.checkpoint()
 
 	return True
 
 
+# max number of file ids that are queried at once via the CFCore files endpoint
+FILES_CHUNK_SIZE: int = 50
+
+
 def _collect_data_for_project_dependents(logger: logging.Logger, save_handler: SaveHandlerInterface, dependency_resolver: DependencyResolverInterface, api_helper: ApiHelper, project_id: int, project_name: str, project_slug: str) -> bool:
-	dependents, files = dependency_resolver.get_project_dependents(project_id, project_name)
+	"""
+	Streams the resolved dependents from the dependency resolver and stores each batch right away.
+	The file info is queried in a background thread, so it overlaps with the resolution of the next dependents.
+	All save handler writes happen on the calling thread.
 
-	if len(dependents) > 0:
-		logger.info("Storing dependents Info...")
-		for dependant in dependents:
-			store_project_info(save_handler, dependant)
+	A dependant is journaled as done once the chunk that contains its last file is stored,
+	dependents that are already done are skipped when an interrupted run is resumed (the files of the others are stored again).
+	"""
+	found_files = False
+	success = True
+	file_ids: List[Tuple[int, Optional[int]]] = []  # (file id, id of the dependant if it's the dependants last file)
+	pending: List[Tuple[Future, List[int]]] = []
 
-	if len(files) > 0:
-		file_ids = [ufid.file_id for ufid in files]
-		logger.debug(f"Retrieving data for {len(file_ids)} files that depend on project <{project_name}>")
-		try:
-			time.sleep(0.5)
-			response = api_helper.cf_api.get_files(file_ids)
-			response.raise_for_status()
-			files = response.json()["data"]
-		except requests.RequestException as error:
-			logger.error(f"Failed to query files by id -> CFCore API: {error}")
-			return False
+	def is_dependant_done(dependant: dict) -> bool:
+		return save_handler.is_step_done(f"dependant:{project_id}:{dependant['id']}")
 
-		for file in files:
-			logger.debug(f"Checking if the file <{file['fileName']}> depends on the project <{project_name}>")
-			dependency = dependency_resolver.get_file_dependency(FileIdentifier(file['modId'], file['id']), project_id)
-			if dependency:
-				store_file_info(save_handler, file)
-				store_file_dependency(save_handler, file, dependency)
-			else:
-				logger.warning(f"Skipping file <{file['fileName']}> -> Unable to determine the files dependencies")
-				logger.warning(f"Skipping file <{file['fileName']}> -> File is does not depend on <{project_slug}>")
+	def submit_chunk(chunk: List[Tuple[int, Optional[int]]]):
+		ids = [file_id for file_id, _ in chunk]
+		finished_dependents = [dependant_id for _, dependant_id in chunk if dependant_id is not None]
+		pending.append((executor.submit(_fetch_files_info, logger, api_helper, ids), finished_dependents))
+
+	def store_chunk(future: Future, finished_dependents: List[int]) -> bool:
+		if not _store_dependent_files(logger, save_handler, dependency_resolver, future.result(), project_id, project_name, project_slug):
+			return False
 
+		# after a failed chunk the files of the finished dependents might be incomplete
+		if success:
+			for dependant_id in finished_dependents:
+				save_handler.mark_step_done(f"dependant:{project_id}:{dependant_id}")
+		save_handler.checkpoint()
 		return True
-	return False
+
+	with ThreadPoolExecutor(max_workers=1, thread_name_prefix="FileInfoFetcher") as executor:
+		for dependant, files in dependency_resolver.iter_project_dependents(project_id, project_name, skip_dependant=is_dependant_done):
+			logger.info(f"Storing dependant <{dependant['name']}> Info...")
+			store_project_info(save_handler, dependant)
+
+			if len(files) > 0:
+				found_files = True
+				ids = files.file_ids()
+				file_ids.extend((file_id, None) for file_id in ids[:-1])
+				file_ids.append((ids[-1], dependant['id']))
+
+			while len(file_ids) >= FILES_CHUNK_SIZE:
+				submit_chunk(file_ids[:FILES_CHUNK_SIZE])
+				file_ids = file_ids[FILES_CHUNK_SIZE:]
+
+			# store the batches that already arrived without blocking the resolution
+			while len(pending) > 0 and pending[0][0].done():
+				success &= store_chunk(*pending.pop(0))
+
+		if len(file_ids) > 0:
+			submit_chunk(file_ids)
+
+		for chunk in pending:
+			success &= store_chunk(*chunk)
+
+	if success:
+		save_handler.mark_step_done(f"dependents:{project_id}")
+		save_handler.checkpoint()
+
+	return found_files and success
+
+
+def _fetch_files_info(logger: logging.Logger, api_helper: ApiHelper, file_ids: List[int]) -> Optional[list]:
+	logger.debug(f"Retrieving data for {len(file_ids)} files")
+	try:
+		return list(api_helper.cf_api.iter_files(file_ids))
+	except (requests.RequestException, ValueError) as error:
+		logger.error(f"Failed to query files by id -> CFCore API: {error}")
+		return None
+
+
+def _store_dependent_files(logger: logging.Logger, save_handler: SaveHandlerInterface, dependency_resolver: DependencyResolverInterface, files: Optional[list], project_id: int, project_name: str, project_slug: str) -> bool:
+	if files is None:
+		return False
+
+	for file in files:
+		logger.debug(f"Checking if the file <{file['fileName']}> depends on the project <{project_name}>")
+		dependency = dependency_resolver.get_file_dependency(FileIdentifier(file['modId'], file['id']), project_id)
+		if dependency:
+			store_file_info(save_handler, file)
+			store_file_dependency(save_handler, file, dependency)
+		else:
+			logger.warning(f"Skipping file <{file['fileName']}> -> Unable to determine the files dependencies")
+			logger.warning(f"Skipping file <{file['fileName']}> -> File is does not depend on <{project_slug}>")
+
+	return True
@@ -0,0 +1,173 @@
+# opt-in profiling of the collector, the dependency resolver and the dashboard callbacks
+#
+# Enable it by setting the env var DS_MM_CF_PROFILE_DIR to the output directory (or by calling `profiling.enable(output_dir)`).
+# Every phase gets its own accumulated cProfile profile (<phase>.prof, viewable with e.g. snakeviz)
+# and a summary of the top hot spots and allocation sites (<phase>.txt).
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Optional, Dict, List
+
+PROFILE_DIR_ENV_VAR = "DS_MM_CF_PROFILE_DIR"
+
+logger = logging.getLogger("Profiler")
+
+_output_dir: Optional[str] = os.environ.get(PROFILE_DIR_ENV_VAR, None) or None
+_lock = threading.Lock()
+_phases: Dict[str, "_PhaseProfile"] = {}
+_local = threading.local()
+_owner: Optional[int] = None  # only one thread can be profiled at a time (e.g. concurrent dashboard callbacks)
+
+
+class _PhaseProfile:
+	"""Accumulated profile of all calls of a phase"""
+
+	def __init__(self, name: str):
+		self.name = name
+		self.profile = cProfile.Profile()
+		self.calls = 0
+		self.wall_time = 0.0
+		self.peak_memory = 0
+
+
+class _ActivePhase:
+	def __init__(self, phase: _PhaseProfile):
+		self.phase = phase
+		self.start_time = time.perf_counter()
+		self.peak_memory = 0
+
+
+def enable(output_dir: str):
+	"""Enable profiling for all following phases"""
+	global _output_dir
+	_output_dir = output_dir
+
+
+def is_enabled() -> bool:
+	return _output_dir is not None
+
+
+@contextmanager
+def profile_phase(name: str):
+	"""
+	Profile the enclosed code as part of the phase, does nothing if profiling isn't enabled
+
+	Nested phases are excluded from the profile of the enclosing phase.
+	The profiles are written to disk when the outermost phase of the thread exits.
+	"""
+	if not is_enabled():
+		yield
+		return
+
+	global _owner
+	with _lock:
+		if _owner is not None and _owner != threading.get_ident():
+			profiled_thread = False
+		else:
+			_owner = threading.get_ident()
+			profiled_thread = True
+		phase = _phases.setdefault(name, _PhaseProfile(name))
+
+	if not profiled_thread:
+		yield
+		return
+
+	stack: List[_ActivePhase] = getattr(_local, 'stack', None)
+	if stack is None:
+		stack = _local.stack = []
+
+	if not tracemalloc.is_tracing():
+		tracemalloc.start(10)
+
+	if len(stack) > 0:
+		outer = stack[-1]
+		outer.phase.profile.disable()
+		outer.peak_memory = max(outer.peak_memory, tracemalloc.get_traced_memory()[1])
+
+	active = _ActivePhase(phase)
+	stack.append(active)
+	tracemalloc.reset_peak()
+	phase.profile.enable()
+	try:
+		yield
+	finally:
+		phase.profile.disable()
+		stack.pop()
+		active.peak_memory = max(active.peak_memory, tracemalloc.get_traced_memory()[1])
+		phase.calls += 1
+		phase.wall_time += time.perf_counter() - active.start_time
+		phase.peak_memory = max(phase.peak_memory, active.peak_memory)
+
+		if len(stack) > 0:
+			outer = stack[-1]
+			outer.peak_memory = max(outer.peak_memory, active.peak_memory)
+			tracemalloc.reset_peak()
+			outer.phase.profile.enable()
+		else:
+			try:
+				dump_profiles()
+			finally:
+				with _lock:
+					_owner = None
+
+
+def profiled(name: str):
+	"""Decorator that profiles every call of the function as part of the phase"""
+
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			with profile_phase(name):
+				return func(*args, **kwargs)
+
+		return wrapper
+
+	return decorator
+
+
+def dump_profiles(top: int = 25):
+	"""Write the profile and the hot spot summary of every phase to the output dir"""
+	if not is_enabled():
+		return
+
+	os.makedirs(_output_dir, exist_ok=True)
+	snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+
+	with _lock:
+		phases = list(_phases.values())
+
+	for phase in phases:
+		if phase.calls == 0:
+			continue
+		file_path = os.path.join(_output_dir, phase.name)
+		phase.profile.dump_stats(f"{file_path}.prof")
+
+		stream = io.StringIO()
+		stats = pstats.Stats(phase.profile, stream=stream)
+		stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+		stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+		with open(f"{file_path}.txt", 'w') as f:
+			f.write(f"phase: {phase.name}\ncalls: {phase.calls}\nwall time: {phase.wall_time:.3f}s\npeak traced memory: {phase.peak_memory / 1e6:.2f} MB\n\n")
+			f.write(stream.getvalue())
+			if snapshot:
+				f.write(f"\ntop {top} allocation sites (live at dump time):\n")
+				for statistic in snapshot.statistics('lineno')[:top]:
+					f.write(f"{statistic}\n")
+
+		logger.info(f"profiled phase <{phase.name}> -> calls: {phase.calls}, wall time: {phase.wall_time:.3f}s, peak memory: {phase.peak_memory / 1e6:.2f} MB, hot spots: {', '.join(get_hot_spots(phase.profile, 3))}")
+
+
+def get_hot_spots(profile: cProfile.Profile, count: int) -> List[str]:
+	"""
+	:return: the functions with the highest own (exclusive) time
+	"""
+	stats = pstats.Stats(profile)
+	entries = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:count]
+	return [f"{os.path.basename(file)}:{line}({func}) {total_time:.3f}s" for (file, line, func), (_, _, total_time, _, _) in entries]
@@ -0,0 +1,201 @@
+# time-bucket rollups of the download snapshots and the retention policy of the raw snapshots
+#
+# The download counts are cumulative, thus a bucket keeps the counts of the latest snapshot within the bucket.
+# Rollup rows are labeled with the start of their bucket (UTC), thus the rollups of file_downloads and project_downloads
+# can be joined on the timestamp like the raw snapshots of a run.
+import time
+from typing import Dict, Optional, Iterable
+
+from dataset import Database
+
+# finest to coarsest
+GRANULARITIES: Dict[str, Optional[int]] = {
+	'raw': None,
+	'hourly': 3600,
+	'daily': 86400,
+	'weekly': 7 * 86400,
+}
+ROLLUP_GRANULARITIES = [name for name, size in GRANULARITIES.items() if size]
+WEEK_OFFSET = 4 * 86400  # the epoch started on a thursday, weeks start on monday
+
+SNAPSHOT_TABLES: Dict[str, tuple] = {
+	'file_downloads': ('project_id', 'file_id'),
+	'project_downloads': ('project_id',),
+}
+
+# timestamps of the last run of each project, the raw snapshots of these runs are never compacted
+# (the derived table lets MySQL select from the table a DELETE modifies)
+LATEST_RUNS_QUERY = "SELECT timestamp FROM (SELECT MAX(timestamp) AS timestamp FROM project_downloads GROUP BY project_id) latest_run"
+
+MAX_POINTS = 400  # max number of snapshots per series choose_granularity aims for
+
+
+def get_table_name(table: str, granularity: str) -> str:
+	return table if granularity == 'raw' else f"{table}_{granularity}"
+
+
+def get_bucket(timestamp: int, granularity: str) -> int:
+	size = GRANULARITIES[granularity]
+	if not size:
+		return timestamp
+	offset = WEEK_OFFSET if granularity == 'weekly' else 0
+	return timestamp - (timestamp - offset) % size
+
+
+def create_rollup_tables(db: Database):
+	for table_name, key_columns in SNAPSHOT_TABLES.items():
+		if db.has_table(table_name):
+			# the snapshots of a run are selected by their timestamp
+			db[table_name].create_index(['timestamp'])
+
+		for granularity in ROLLUP_GRANULARITIES:
+			name = get_table_name(table_name, granularity)
+			if not db.has_table(name):
+				table = db.create_table(name, primary_id=False)
+				for column in key_columns:
+					table.create_column(column, db.types.integer)
+				table.create_column('timestamp', db.types.integer)  # start of the bucket
+				table.create_column('download_count', db.types.integer)
+				table.create_column('snapshot_timestamp', db.types.integer)  # timestamp of the rolled up snapshot
+				table.create_index(list(key_columns) + ['timestamp'], unique=True)
+
+	if not db.has_table('rollup_run'):
+		table = db.create_table('rollup_run', primary_id=False)
+		table.create_column('timestamp', db.types.integer)  # rolled up run
+		table.create_index(['timestamp'], unique=True)
+
+	if not db.has_table('rollup_compaction'):
+		table = db.create_table('rollup_compaction', primary_id=False)
+		table.create_column('granularity', db.types.string)
+		table.create_column('compacted_before', db.types.integer)  # the snapshots before were deleted
+
+
+def _get_upsert_clause(db: Database, name: str, keys: str) -> str:
+	"""the bucket keeps the counts of the latest snapshot, a run that is rolled up again overwrites its own counts"""
+	if db.engine.dialect.name == 'mysql':
+		# the assignments are evaluated in order, thus download_count is compared with the old snapshot_timestamp
+		return f"""ON DUPLICATE KEY UPDATE
+			{name}.download_count = IF(VALUES(snapshot_timestamp) >= {name}.snapshot_timestamp, VALUES(download_count), {name}.download_count),
+			{name}.snapshot_timestamp = GREATEST({name}.snapshot_timestamp, VALUES(snapshot_timestamp))"""
+	return f"""ON CONFLICT ({keys}, timestamp) DO UPDATE SET download_count = excluded.download_count, snapshot_timestamp = excluded.snapshot_timestamp
+		WHERE excluded.snapshot_timestamp >= {name}.snapshot_timestamp"""
+
+
+def update_rollups(db: Database, timestamps: Iterable[int] = ()) -> int:
+	"""
+	Roll up the snapshots of the given runs and of all runs that weren't rolled up yet (e.g. the history of an existing db)
+
+	Rolling up a run again (e.g. after it was resumed) is idempotent.
+
+	:param db:
+	:param timestamps: timestamps of the runs that have to be rolled up (again)
+	:return: number of rolled up runs
+	"""
+	if not db.has_table('project_downloads'):
+		return 0
+
+	create_rollup_tables(db)
+	pending = set(timestamps)
+	pending.update(row['timestamp'] for row in db.query("SELECT DISTINCT timestamp FROM project_downloads WHERE timestamp NOT IN (SELECT timestamp FROM rollup_run)"))
+
+	for timestamp in sorted(pending):
+		for table_name, key_columns in SNAPSHOT_TABLES.items():
+			if not db.has_table(table_name):
+				continue
+			keys = ", ".join(key_columns)
+			for granularity in ROLLUP_GRANULARITIES:
+				name = get_table_name(table_name, granularity)
+				db.query(f"""
+				INSERT INTO {name} ({keys}, timestamp, download_count, snapshot_timestamp)
+				SELECT {keys}, :bucket, MAX(download_count), :timestamp
+					FROM {table_name}
+					WHERE timestamp = :timestamp
+					GROUP BY {keys}
+				{_get_upsert_clause(db, name, keys)}
+				""", bucket=get_bucket(timestamp, granularity), timestamp=timestamp)
+		db['rollup_run'].upsert(dict(timestamp=timestamp), ['timestamp'])
+
+	return len(pending)
+
+
+def compact_snapshots(db: Database, retention: Dict[str, Optional[float]], now: Optional[int] = None) -> Dict[str, int]:
+	"""
+	Delete the snapshots that are older than the retention period of their granularity, they stay available in the coarser rollups
+
+	The raw snapshots of the last run of each project are kept regardless of their age, thus the latest snapshot of a project
+	that wasn't collected again (unchanged download count) is still available in raw.
+
+	:param db:
+	:param retention: max age in seconds by granularity, e.g. {'raw': 30 * 86400, 'hourly': 180 * 86400}; the coarsest granularity is always kept
+	:param now:
+	:return: number of deleted rows by granularity
+	"""
+	if not db.has_table('project_downloads'):
+		return {}
+
+	update_rollups(db)  # the snapshots have to be rolled up before they are deleted
+	now = now if now is not None else int(time.time())
+	deleted = {}
+	for granularity in list(GRANULARITIES)[:-1]:
+		max_age = retention.get(granularity, None)
+		if not max_age:
+			continue
+
+		cutoff = get_bucket(int(now - max_age), granularity)  # only whole buckets are deleted
+		# the collector skips unchanged projects, thus the last run of a dormant project can be older than the cutoff
+		kept_clause = f" AND timestamp NOT IN ({LATEST_RUNS_QUERY})" if granularity == 'raw' else ""
+		deleted[granularity] = 0
+		for table_name in SNAPSHOT_TABLES:
+			name = get_table_name(table_name, granularity)
+			if db.has_table(name):
+				for row in db.query(f"SELECT COUNT(*) AS count FROM {name} WHERE timestamp < :cutoff{kept_clause}", cutoff=cutoff):
+					deleted[granularity] += row['count']
+				db.begin()
+				try:
+					db.query(f"DELETE FROM {name} WHERE timestamp < :cutoff{kept_clause}", cutoff=cutoff)
+				except Exception:
+					db.rollback()
+					raise
+				db.commit()
+
+		previous = db['rollup_compaction'].find_one(granularity=granularity)
+		if not previous or previous['compacted_before'] < cutoff:
+			db['rollup_compaction'].upsert(dict(granularity=granularity, compacted_before=cutoff), ['granularity'])
+
+	return deleted
+
+
+def choose_granularity(db: Database, project_id: int, start: Optional[int] = None, end: Optional[int] = None, max_points: int = MAX_POINTS) -> str:
+	"""
+	Choose the finest granularity that covers the time range and has at most max_points snapshots of the project in it
+
+	:param db:
+	:param project_id:
+	:param start: inclusive, None for the whole history
+	:param end: inclusive, None for the latest snapshot
+	:param max_points:
+	:return: granularity name, 'raw' if the db has no rollups
+	"""
+	if not db.has_table('rollup_compaction'):
+		return 'raw'
+
+	compacted_before = {row['granularity']: row['compacted_before'] for row in db['rollup_compaction'].all()}
+	granularities = list(GRANULARITIES)
+	for granularity in granularities:
+		if granularity in compacted_before and (start is None or start < compacted_before[granularity]):
+			continue  # the beginning of the time range was deleted
+
+		if granularity == granularities[-1]:
+			return granularity
+
+		name = get_table_name('project_downloads', granularity)
+		range_clause = ""
+		if start is not None:
+			range_clause += f" AND timestamp >= {int(get_bucket(start, granularity))}"
+		if end is not None:
+			range_clause += f" AND timestamp <= {int(end)}"
+		for row in db.query(f"SELECT COUNT(*) AS count FROM {name} WHERE project_id = {int(project_id)}{range_clause}"):
+			if row['count'] <= max_points:
+				return granularity
+
+	return granularities[-1]
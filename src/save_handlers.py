@@ -1,7 +1,12 @@
 import abc
 from datetime import datetime
-import dataset
-from typing import List
+from typing import List, Optional, Dict, Tuple
+
+from sqlalchemy import event
+
+import db_util
+import rollups
+from metrics import metrics
 
 
 def parse_datetime_string(datetime_str: str) -> float:
@@ -104,6 +109,29 @@ class SaveHandlerInterface(metaclass=abc.ABCMeta):
 		"""
 		pass
 
+	def is_step_done(self, step: str) -> bool:
+		"""
+		Check the run journal if the step was already completed by an interrupted attempt of the same run (same timestamp)
+		:param step: unique name of the step, e.g. "project:<id>"
+		:return:
+		"""
+		return False
+
+	def mark_step_done(self, step: str):
+		"""
+		Record in the run journal that the step is completed
+		:param step: unique name of the step, e.g. "project:<id>"
+		:return:
+		"""
+		pass
+
+	def checkpoint(self):
+		"""
+		Persist everything that was saved so far together with the run journal
+		:return:
+		"""
+		pass
+
 
 # TODO create JsonSaveHandler
 # class JsonSaveHandler(SaveHandlerInterface)
@@ -111,25 +139,179 @@ class SaveHandlerInterface(metaclass=abc.ABCMeta):
 
 class DatasetSaveHandler(SaveHandlerInterface):
 
-	def __init__(self, db_url: str, timestamp: int):
+	# (key columns, content columns) of the tables whose rows are only written if their content changed
+	# columns that change with every run (e.g. date_collected) aren't part of the content
+	DIRTY_CHECKED_TABLES: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...]]] = {
+		'project': (('id',), ('slug', 'name', 'type', 'mc_version', 'summary', 'logo', 'date_created', 'date_modified')),
+		'author': (('id',), ('name',)),
+		'project_authors': (('project_id', 'author_id'), ()),
+		'file': (('project_id', 'file_id'), ('display_name', 'file_name', 'release_type', 'mc_versions', 'date_created', 'size')),
+	}
+
+	def __init__(self, db_url: str, timestamp: int, dependencies_db_url: Optional[str] = None, shared_run: bool = False):
 		"""
 		:param db_url: SQLite, PostgreSQL or MySQL
 		:param timestamp: when was the data collected/saved
+		:param dependencies_db_url: SQLite db of the DependencyResolver, if set the file dependencies are queried from it instead of being copied into the file_dependencies table
+		:param shared_run: several workers save the same run (see work_queue), thus a snapshot might be saved more than once,
+			requires SQLite or PostgreSQL (unique indexes on the snapshot keys and ON CONFLICT upserts)
 		"""
 		self.timestamp = timestamp
+		self.shared_run = shared_run
+		self.dependencies_db_url = dependencies_db_url
+		self._done_steps = set()
+		self._resuming = False
+		self._unique_snapshots = False  # the snapshot keys have unique indexes, the snapshots are upserted with ON CONFLICT
+		self._row_hashes: Dict[str, Dict[tuple, int]] = {}  # content hashes of the committed rows
+		self._pending_row_hashes: Dict[str, Dict[tuple, int]] = {}  # content hashes of the rows written in the current transaction
 
 		# TODO: use transactions? e.g. transaction can be used through context manager, db changes will be thrown away when an exception occurs
-		self.db = dataset.connect(db_url)
+		self.db = db_util.connect(db_url, dependencies_db_url=dependencies_db_url)
+		# rolled back rows have to be written again, thus their hashes are only kept after the commit
+		event.listen(self.db.engine, 'commit', lambda connection: self._apply_pending_row_hashes())
+		event.listen(self.db.engine, 'rollback', lambda connection: self._pending_row_hashes.clear())
 		self._setup_db()
 
 	def __exit__(self, exc_type, exc_val, exc_tb):
 		self.db.close()
 
 	def _setup_db(self):
-		import db_util
 		if 'dependant_downloads' not in self.db.views:
 			db_util.create_view_dependant_downloads(self.db)
 
+		db_util.create_project_search_index(self.db)
+		self._has_search_index = db_util.has_project_search_index(self.db)
+
+		if not self.db.has_table('run_journal'):
+			table = self.db.create_table('run_journal')
+			table.create_column('timestamp', self.db.types.integer)
+			table.create_column('step', self.db.types.string)
+			table.create_index(['timestamp'])
+
+		self._done_steps = {row['step'] for row in self.db['run_journal'].find(timestamp=self.timestamp)}
+		self._resuming = len(self._done_steps) > 0
+		if self.shared_run:
+			self._create_snapshot_unique_indexes()
+		self._unique_snapshots = all(self._has_snapshot_unique_index(table_name) for table_name in rollups.SNAPSHOT_TABLES)
+		if self._resuming and not self._unique_snapshots and self.db.has_table('file_downloads'):
+			self.db['file_downloads'].create_index(['project_id', 'file_id', 'timestamp'])
+
+	def _has_snapshot_unique_index(self, table_name: str) -> bool:
+		columns = list(rollups.SNAPSHOT_TABLES[table_name]) + ['timestamp']
+		if not self.db.has_table(table_name):
+			return False
+		return any(index['unique'] and list(index['column_names']) == columns for index in self.db.inspect.get_indexes(table_name))
+
+	def _create_snapshot_unique_indexes(self):
+		"""
+		The workers of a shared run might save the same snapshot concurrently (e.g. a modpack that depends on two tracked mods),
+		an upsert of dataset (UPDATE, then INSERT) can't prevent two inserts, thus the snapshots are upserted with ON CONFLICT.
+
+		Duplicate snapshots of earlier runs (same key and timestamp) are removed before the unique index is created.
+		"""
+		for table_name, key_columns in rollups.SNAPSHOT_TABLES.items():
+			if self._has_snapshot_unique_index(table_name):
+				continue
+			columns = list(key_columns) + ['timestamp']
+			self.db.begin()
+			try:
+				if not self.db.has_table(table_name):
+					table = self.db.create_table(table_name)
+					for column in columns + ['download_count']:
+						table.create_column(column, self.db.types.bigint)
+				keys = ", ".join(columns)
+				self.db.query(f"DELETE FROM {table_name} WHERE id NOT IN (SELECT MIN(id) FROM {table_name} GROUP BY {keys})")
+				self.db.query(f"CREATE UNIQUE INDEX ux_{table_name}_snapshot ON {table_name} ({keys})")
+			except Exception:
+				self.db.rollback()
+				raise
+			self.db.commit()
+
+	def _save_snapshot(self, table_name: str, row: dict):
+		if self._unique_snapshots:
+			# the count might have been saved by the interrupted attempt or, concurrently, by another worker
+			keys = ", ".join(list(rollups.SNAPSHOT_TABLES[table_name]) + ['timestamp'])
+			self.db.query(f"""
+			INSERT INTO {table_name} ({", ".join(row)}) VALUES ({", ".join(f":{column}" for column in row)})
+			ON CONFLICT ({keys}) DO UPDATE SET download_count = excluded.download_count
+			""", **row)
+		elif self.is_resuming:
+			# the count might have been saved by the interrupted attempt
+			self.db[table_name].upsert(row, list(rollups.SNAPSHOT_TABLES[table_name]) + ['timestamp'])
+		else:
+			self.db[table_name].insert(row)
+		metrics.inc("db_rows_written_total", database="save_handler", table=table_name)
+
+	@property
+	def is_resuming(self) -> bool:
+		"""whether an interrupted run with the same timestamp is resumed"""
+		return self._resuming
+
+	def is_step_done(self, step: str) -> bool:
+		return step in self._done_steps
+
+	def mark_step_done(self, step: str):
+		if step not in self._done_steps:
+			self.db['run_journal'].insert(dict(timestamp=self.timestamp, step=step))
+			self._done_steps.add(step)
+
+	def checkpoint(self):
+		if self.db.in_transaction:
+			self.db.commit()
+			self.db.begin()
+
+	def _load_row_hashes(self, table_name: str) -> Dict[tuple, int]:
+		"""Load the content hashes of the saved rows on first use"""
+		hashes = self._row_hashes.get(table_name, None)
+		if hashes is not None:
+			return hashes
+
+		hashes = {}
+		key_columns, content_columns = self.DIRTY_CHECKED_TABLES[table_name]
+		columns = key_columns + content_columns
+		if self.db.has_table(table_name) and set(columns).issubset(self.db[table_name].columns):
+			key_length = len(key_columns)
+			for row in self.db.query(f"SELECT {', '.join(columns)} FROM {table_name}"):
+				values = tuple(row.values())
+				hashes[values[:key_length]] = hash(values[key_length:])
+		self._row_hashes[table_name] = hashes
+		return hashes
+
+	def _apply_pending_row_hashes(self):
+		for table_name, hashes in self._pending_row_hashes.items():
+			self._load_row_hashes(table_name).update(hashes)
+		self._pending_row_hashes.clear()
+
+	def _is_row_changed(self, table_name: str, row: dict) -> bool:
+		"""
+		Compare the row with the saved row and remember its content hash, thus the caller has to write the row if it changed
+		(repeated rows in the same run, e.g. authors of several projects, are only written once)
+		"""
+		key_columns, content_columns = self.DIRTY_CHECKED_TABLES[table_name]
+		key = tuple(row[column] for column in key_columns)
+		content_hash = hash(tuple(row[column] for column in content_columns))
+
+		pending = self._pending_row_hashes.setdefault(table_name, {})
+		saved_hash = pending.get(key, None)
+		if saved_hash is None:
+			saved_hash = self._load_row_hashes(table_name).get(key, None)
+		if saved_hash == content_hash:
+			metrics.inc("db_rows_skipped_total", database="save_handler", table=table_name)
+			return False
+
+		pending[key] = content_hash
+		return True
+
+	def update_rollups(self, retention: Optional[Dict[str, Optional[float]]] = None):
+		"""
+		Roll up the download snapshots of this run (and of older runs that weren't rolled up yet) and apply the retention policy
+
+		:param retention: max age in seconds of the snapshots by granularity (see rollups.compact_snapshots), None keeps all snapshots
+		"""
+		rollups.update_rollups(self.db, [self.timestamp])
+		if retention:
+			rollups.compact_snapshots(self.db, retention)
+
 	def is_saved_project_outdated(self, project_id: int, project_date_modified: str, project_download_count: int) -> bool:
 		if self.db.has_table('project'):
 			result = self.db['project'].find_one(id=project_id)
@@ -137,14 +319,13 @@ class DatasetSaveHandler(SaveHandlerInterface):
 				return True
 
 		if self.db.has_table('project_downloads'):
-			import db_util
 			for row in db_util.get_project_download_count_latest(self.db, project_id):
 				return row['download_count'] != project_download_count
 
 		return True
 
 	def save_project_info(self, p_id: int, slug: str, name: str, p_type: str, mc_versions: List[str], summary: str, logo_url: str, date_created: str, date_modified: str):
-		self.db['project'].upsert(dict(
+		row = dict(
 			id=p_id,  # primary key
 			slug=slug, name=name,
 			type=p_type,
@@ -154,48 +335,77 @@ class DatasetSaveHandler(SaveHandlerInterface):
 			date_created=parse_datetime_string(date_created),
 			date_modified=parse_datetime_string(date_modified),
 			date_collected=self.timestamp  # when was the mod info collected/updated
-		), ['id'])
+		)
+		if self._is_row_changed('project', row):
+			self.db['project'].upsert(row, ['id'])
+			metrics.inc("db_rows_written_total", database="save_handler", table="project")
+			if self._has_search_index:
+				db_util.update_project_search_index(self.db, p_id, slug, name, summary)
+		else:
+			self.db['project'].update(dict(id=p_id, date_collected=self.timestamp), ['id'])
 
 	def save_project_authors(self, project_id: int, authors: List[dict]):
+		unchanged_author_ids = []
 		for author in authors:
-			self.db['project_authors'].upsert(dict(
+			row = dict(
 				project_id=project_id,
 				author_id=author['id'],
 				timestamp=self.timestamp  # if not up-to-date with newest project timestamp the member was removed
-			), ['project_id', 'author_id'])
+			)
+			if self._is_row_changed('project_authors', row):
+				self.db['project_authors'].upsert(row, ['project_id', 'author_id'])
+				metrics.inc("db_rows_written_total", database="save_handler", table="project_authors")
+			else:
+				unchanged_author_ids.append(author['id'])
 
 			self._save_author(author['id'], author['name'])
 
+		if unchanged_author_ids:
+			# one statement for all members instead of an upsert per member
+			self.db['project_authors'].update(dict(project_id=project_id, author_id=unchanged_author_ids, timestamp=self.timestamp), ['project_id', 'author_id'])
+
 	def _save_author(self, a_id: int, name: str):
-		# upsert because the name could change
-		self.db['author'].upsert(dict(id=a_id, name=name), ['id'])
+		row = dict(id=a_id, name=name)
+		if self._is_row_changed('author', row):
+			# upsert because the name could change
+			self.db['author'].upsert(row, ['id'])
+			metrics.inc("db_rows_written_total", database="save_handler", table="author")
 
 	def save_project_download_count(self, project_id: int, download_count: int):
-		self.db['project_downloads'].insert(dict(
+		row = dict(
 			project_id=project_id,
 			download_count=download_count,
 			timestamp=self.timestamp
-		))
+		)
+		self._save_snapshot('project_downloads', row)
 
 	def save_file_info(self, project_id: int, file_id: int, release_type: str, mc_versions: List[str], display_name: str, file_name: str, date_created: int, file_length: int):
-		self.db['file'].upsert(dict(
+		row = dict(
 			project_id=project_id, file_id=file_id,  # both ids are needed to uniquely identified a file
 			display_name=display_name, file_name=file_name,
 			release_type=release_type,
 			mc_versions=", ".join(mc_versions),
 			date_created=date_created,
 			size=file_length
-		), ['project_id', 'file_id'])
+		)
+		if self._is_row_changed('file', row):
+			self.db['file'].upsert(row, ['project_id', 'file_id'])
+			metrics.inc("db_rows_written_total", database="save_handler", table="file")
 
 	def save_file_download_count(self, project_id: int, file_id: int, download_count: int):
-		self.db['file_downloads'].insert(dict(
+		row = dict(
 			project_id=project_id, file_id=file_id,
 			download_count=download_count,
 			timestamp=self.timestamp
-		))
+		)
+		self._save_snapshot('file_downloads', row)
 
 	def save_file_dependency(self, project_id: int, file_id: int, dependency_project_id: int, dependency_file_id: int):
+		if self.dependencies_db_url:
+			return  # already stored by the DependencyResolver
+
 		self.db['file_dependencies'].insert_ignore(dict(
 			project_id=project_id, file_id=file_id,
 			dependency_project_id=dependency_project_id, dependency_file_id=dependency_file_id
 		), ['id', 'project_id', 'dependency_project_id', 'dependency_file_id'])
+		metrics.inc("db_rows_written_total", database="save_handler", table="file_dependencies")
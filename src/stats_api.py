@@ -0,0 +1,140 @@
+# read-only json api of the download stats, served by the flask server of the dashboard
+#
+# GET /api/v1/projects/<slug>                          project summary with the latest download composition
+# GET /api/v1/projects/<slug>/composition?timestamp=  download composition at (or before) the timestamp, default latest
+# GET /api/v1/projects/<slug>/origin?timestamp=       downloads by origin at (or before) the timestamp, default latest
+# GET /api/v1/projects/<slug>/files?start=&end=&granularity=   download time series of the files
+#
+# The responses only change when a run is complete (its snapshots are rolled up at the end) or the snapshots are compacted,
+# thus their ETag is derived from the latest rolled up run and the compaction state. A response that is requested while
+# a run is collected might be partial, its ETag changes once the run is complete. Polling clients send If-None-Match
+# and get a 304 without any stats query. Errors are returned as json objects with the status and a description.
+import hashlib
+from typing import Callable, Optional
+
+from dataset import Database
+from flask import Blueprint, Response, abort, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+import db_util
+import rollups
+
+API_PREFIX = "/api/v1"
+
+
+def get_data_version(db: Database, project: dict) -> str:
+	"""
+	:return: version of the stats of the project, changes once the data of a run is complete and when the snapshots are compacted
+	"""
+	if not db.has_table('rollup_run'):
+		return str(project['date_collected'])  # db without rollups (the stats api is read-only, thus it doesn't create them)
+	version = [str(row['timestamp']) for row in db.query("SELECT MAX(timestamp) AS timestamp FROM rollup_run")]
+	if db.has_table('rollup_compaction'):
+		version.extend(f"{row['granularity']}:{row['compacted_before']}" for row in db.query("SELECT granularity, compacted_before FROM rollup_compaction ORDER BY granularity"))
+	return ",".join(version)
+
+
+def get_etag(db: Database, project: dict) -> str:
+	"""
+	:return: ETag of the requested representation of the project stats
+	"""
+	return hashlib.sha1(f"{request.full_path}|{project['id']}|{get_data_version(db, project)}".encode()).hexdigest()
+
+
+def _get_granularity_arg() -> Optional[str]:
+	granularity = request.args.get('granularity', None)
+	if granularity is not None and granularity not in rollups.GRANULARITIES:
+		abort(400, f"unknown granularity, expected one of {', '.join(rollups.GRANULARITIES)}")
+	return granularity
+
+
+def _get_rows_at(db: Database, query: Callable, project_id: int, snapshot: Optional[dict]) -> list:
+	"""
+	:param snapshot: see db_util.get_project_snapshot_at
+	:return: the rows of the query for the snapshot, in its granularity
+	"""
+	if snapshot is None:
+		return []
+	return [dict(row) for row in query(db, project_id, start=snapshot['timestamp'], end=snapshot['timestamp'], granularity=snapshot['granularity'])]
+
+
+def create_blueprint(connect: Callable[[], Database]) -> Blueprint:
+	"""
+	:param connect: opens a read-only connection to the mod stats db
+	"""
+	blueprint = Blueprint('stats_api', __name__, url_prefix=API_PREFIX)
+
+	@blueprint.errorhandler(HTTPException)
+	def handle_error(error: HTTPException):
+		response = jsonify(status=error.code, error=error.name, description=error.description)
+		response.status_code = error.code
+		return response
+
+	def handle(slug: str, create_data: Callable[[Database, dict], object]) -> Response:
+		db = connect()
+		try:
+			project = db['project'].find_one(slug=slug)
+			if not project:
+				abort(404, "project not found")
+
+			etag = get_etag(db, project)
+			if request.if_none_match.contains(etag):
+				response = Response(status=304)
+			else:
+				response = jsonify(create_data(db, project))
+		finally:
+			db.close()
+
+		response.set_etag(etag)
+		response.headers['Cache-Control'] = "no-cache"  # always revalidate
+		return response
+
+	@blueprint.route("/projects/<slug>")
+	def get_project_summary(slug: str):
+		def create_data(db: Database, project: dict):
+			snapshot = db_util.get_project_snapshot_at(db, project['id'])
+			composition = _get_rows_at(db, db_util.get_project_downloads_by_composition, project['id'], snapshot)
+			return dict(
+				id=project['id'], slug=project['slug'], name=project['name'], type=project['type'], summary=project['summary'],
+				logo=project['logo'], date_created=project['date_created'], date_modified=project['date_modified'], date_collected=project['date_collected'],
+				authors=[row['name'] for row in db_util.get_project_authors(db, project['id'])],
+				download_count=snapshot['download_count'] if snapshot else None,
+				composition=composition[0] if composition else None,
+			)
+
+		return handle(slug, create_data)
+
+	@blueprint.route("/projects/<slug>/composition")
+	def get_project_composition(slug: str):
+		timestamp = request.args.get('timestamp', None, type=int)
+
+		def create_data(db: Database, project: dict):
+			rows = _get_rows_at(db, db_util.get_project_downloads_by_composition, project['id'], db_util.get_project_snapshot_at(db, project['id'], timestamp))
+			if not rows:
+				abort(404, "no download composition found")
+			return rows[0]
+
+		return handle(slug, create_data)
+
+	@blueprint.route("/projects/<slug>/origin")
+	def get_project_origin(slug: str):
+		timestamp = request.args.get('timestamp', None, type=int)
+
+		def create_data(db: Database, project: dict):
+			rows = _get_rows_at(db, db_util.get_project_downloads_by_origin, project['id'], db_util.get_project_snapshot_at(db, project['id'], timestamp))
+			return sorted(rows, key=lambda row: row['download_count'], reverse=True)
+
+		return handle(slug, create_data)
+
+	@blueprint.route("/projects/<slug>/files")
+	def get_project_files(slug: str):
+		start = request.args.get('start', None, type=int)
+		end = request.args.get('end', None, type=int)
+		granularity = _get_granularity_arg()
+
+		def create_data(db: Database, project: dict):
+			return [dict(row) for row in db_util.get_project_downloads_by_file(db, project['id'], start=start, end=end, granularity=granularity)]
+
+		return handle(slug, create_data)
+
+	return blueprint
@@ -1,8 +1,140 @@
-from typing import Optional, List
+import codecs
+import json
+import time
+from typing import Optional, List, Dict, Tuple, Iterable, Iterator
 
-import requests
+from dataset import Database, Table
 from requests import Response
 
+import db_util
+from adaptive_throttle import AdaptiveController
+from metrics import metrics
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+NUMBER_CHARS = frozenset("0123456789.eE+-")  # characters that can continue a json number
+
+# fields of the CFCore mod and file objects that are used by the collector and the dependency resolver
+# None keeps the whole value, a dict selects the fields of a nested object (or of every object in a nested list)
+MOD_FIELDS: dict = {
+	'id': None, 'slug': None, 'name': None, 'summary': None, 'downloadCount': None, 'dateCreated': None, 'dateModified': None,
+	'links': {'websiteUrl': None},
+	'logo': {'thumbnailUrl': None},
+	'latestFilesIndexes': {'gameVersion': None},
+	'authors': {'id': None, 'name': None},
+}
+FILE_FIELDS: dict = {
+	'id': None, 'modId': None, 'displayName': None, 'fileName': None, 'releaseType': None, 'gameVersions': None,
+	'fileDate': None, 'fileLength': None, 'downloadCount': None, 'downloadUrl': None,
+}
+
+
+def select_fields(value, fields: Optional[dict]):
+	if fields is None:
+		return value
+	if isinstance(value, list):
+		return [select_fields(item, fields) for item in value]
+	if isinstance(value, dict):
+		return {key: select_fields(value[key], nested_fields) for key, nested_fields in fields.items() if key in value}
+	return value
+
+
+def iter_json_array(chunks: Iterable[bytes], key: str = "data", fields: Optional[dict] = None) -> Iterator:
+	"""
+	Incrementally decode the array with the given key of a json object, e.g. the "data" of a CFCore response
+
+	Only the current chunk and the current array item are kept in memory.
+
+	:param chunks: utf-8 encoded json, e.g. Response.iter_content()
+	:param key: key of the array in the top level object
+	:param fields: fields of the items to keep (see select_fields), None keeps all
+	:return: iterator of the array items
+	:raises ValueError: if the json is invalid or the key is missing
+	"""
+	decoder = json.JSONDecoder()
+	text_decoder = codecs.getincrementaldecoder('utf-8')()
+	chunks = iter(chunks)
+	buffer = ""
+	pos = 0
+	eof = False
+	state = 'object'  # object -> key -> value -> (next key ...) or items -> done
+
+	def read() -> bool:
+		nonlocal buffer, pos, eof
+		if eof:
+			return False
+		chunk = next(chunks, None)
+		if chunk is None:
+			eof = True
+			buffer = buffer[pos:] + text_decoder.decode(b"", final=True)
+		else:
+			buffer = buffer[pos:] + text_decoder.decode(chunk)
+		pos = 0
+		return True
+
+	def skip_whitespace() -> Optional[str]:
+		nonlocal pos
+		while True:
+			while pos < len(buffer) and buffer[pos] in " \t\n\r":
+				pos += 1
+			if pos < len(buffer):
+				return buffer[pos]
+			if not read():
+				return None
+
+	def decode_value():
+		nonlocal pos
+		while True:
+			try:
+				value, end = decoder.raw_decode(buffer, pos)
+				# a value that ends with the buffer or is followed by a number character might be a truncated number (e.g. `1.` of `1.5`)
+				if eof or (end < len(buffer) and buffer[end] not in NUMBER_CHARS):
+					pos = end
+					return value
+			except json.JSONDecodeError:
+				if eof:
+					raise
+			# read at least as much as the already buffered part of the value, thus large values aren't parsed again for every chunk
+			pending = len(buffer) - pos
+			while read() and len(buffer) < 2 * pending:
+				pass
+
+	while True:
+		char = skip_whitespace()
+		if char is None:
+			raise ValueError(f"unexpected end of json (array <{key}>)")
+
+		if state == 'object':
+			if char != '{':
+				raise ValueError(f"expected a json object, got <{char}>")
+			pos += 1
+			state = 'key'
+		elif state == 'key':
+			if char == ',':
+				pos += 1
+				continue
+			if char == '}':
+				raise ValueError(f"missing array <{key}>")
+			current_key = decode_value()
+			if skip_whitespace() != ':':
+				raise ValueError("expected <:> after the object key")
+			pos += 1
+			state = 'items' if current_key == key else 'value'
+			if state == 'items':
+				if skip_whitespace() != '[':
+					raise ValueError(f"<{key}> isn't an array")
+				pos += 1
+		elif state == 'value':
+			decode_value()  # skip the values of other keys
+			state = 'key'
+		else:
+			if char == ',':
+				pos += 1
+			elif char == ']':
+				return
+			else:
+				yield select_fields(decode_value(), fields)
+
 
 class CFCoreApi:
 	"""A simple helper class for the CurseForge Core API"""
@@ -14,8 +146,13 @@ class CFCoreApi:
 		"minecraft": 432,
 	}
 
-	def __init__(self, api_key):
+	def __init__(self, api_key, controller: AdaptiveController = None):
+		"""
+		:param api_key:
+		:param controller: controls the request rate and retries, can be shared with other apis
+		"""
 		self._api_key = api_key
+		self.controller = controller if controller else AdaptiveController()
 
 	def _get_standard_headers(self) -> dict:
 		return {
@@ -24,7 +161,7 @@ class CFCoreApi:
 		}
 
 	def get_mod(self, mod_id: int) -> Response:
-		return requests.get(f'{self.base_url}/v1/mods/{mod_id}', headers=self._get_standard_headers(), timeout=5)
+		return self.controller.request('cf:/v1/mods/{id}', 'GET', f'{self.base_url}/v1/mods/{mod_id}', headers=self._get_standard_headers(), timeout=5)
 
 	def get_mods(self, mod_ids: List[int]) -> Response:
 		headers = {
@@ -32,10 +169,10 @@ class CFCoreApi:
 			'Accept': 'application/json',
 			'x-api-key': self._api_key
 		}
-		return requests.post(f'{self.base_url}/v1/mods', headers=headers, json={"modIds": mod_ids}, timeout=5)
+		return self.controller.request('cf:/v1/mods', 'POST', f'{self.base_url}/v1/mods', headers=headers, json={"modIds": mod_ids}, timeout=5)
 
 	def find_mod(self, query: dict) -> Response:
-		return requests.get(f'{self.base_url}/v1/mods/search', headers=self._get_standard_headers(), params=query, timeout=5)
+		return self.controller.request('cf:/v1/mods/search', 'GET', f'{self.base_url}/v1/mods/search', headers=self._get_standard_headers(), params=query, timeout=5)
 
 	def find_minecraft_mod(self, query: dict) -> Response:
 		query['gameId'] = self.game_ids['minecraft']
@@ -46,19 +183,19 @@ class CFCoreApi:
 		return self.find_mod(query)
 
 	def get_mod_desc(self, mod_id: int) -> Response:
-		return requests.get(f'{self.base_url}/v1/mods/{mod_id}/description', headers=self._get_standard_headers(), timeout=5)
+		return self.controller.request('cf:/v1/mods/{id}/description', 'GET', f'{self.base_url}/v1/mods/{mod_id}/description', headers=self._get_standard_headers(), timeout=5)
 
 	def get_mod_file(self, mod_id: int, file_id: int) -> Response:
 		"""
 		Get one mod files
 		"""
-		return requests.get(f'{self.base_url}/v1/mods/{mod_id}/files/{file_id}', headers=self._get_standard_headers(), timeout=5)
+		return self.controller.request('cf:/v1/mods/{id}/files/{file_id}', 'GET', f'{self.base_url}/v1/mods/{mod_id}/files/{file_id}', headers=self._get_standard_headers(), timeout=5)
 
 	def get_mod_files(self, mod_id: int) -> Response:
 		"""
 		Get all files of the given mod
 		"""
-		return requests.get(f'{self.base_url}/v1/mods/{mod_id}/files', headers=self._get_standard_headers(), timeout=5)
+		return self.controller.request('cf:/v1/mods/{id}/files', 'GET', f'{self.base_url}/v1/mods/{mod_id}/files', headers=self._get_standard_headers(), timeout=5)
 
 	def get_files(self, file_ids: List[int]) -> Response:
 		headers = {
@@ -66,7 +203,46 @@ class CFCoreApi:
 			'Accept': 'application/json',
 			'x-api-key': self._api_key
 		}
-		return requests.post(f'{self.base_url}/v1/mods/files', headers=headers, json={"fileIds": file_ids}, timeout=5)
+		return self.controller.request('cf:/v1/mods/files', 'POST', f'{self.base_url}/v1/mods/files', headers=headers, json={"fileIds": file_ids}, timeout=5)
+
+	def get_fingerprint_matches(self, fingerprints: List[int]) -> Response:
+		"""
+		Get the files that match the CurseForge (Murmur2) fingerprints
+		"""
+		headers = {
+			'Content-Type': 'application/json',
+			'Accept': 'application/json',
+			'x-api-key': self._api_key
+		}
+		return self.controller.request('cf:/v1/fingerprints', 'POST', f'{self.base_url}/v1/fingerprints', headers=headers, json={"fingerprints": fingerprints}, timeout=10)
+
+	def _iter_data(self, endpoint: str, url: str, payload: dict, fields: Optional[dict]) -> Iterator[dict]:
+		headers = {
+			'Content-Type': 'application/json',
+			'Accept': 'application/json',
+			'x-api-key': self._api_key
+		}
+		with self.controller.request(endpoint, 'POST', url, headers=headers, json=payload, timeout=5, stream=True) as response:
+			response.raise_for_status()
+			yield from iter_json_array(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), "data", fields)
+
+	def iter_mods(self, mod_ids: List[int], fields: Optional[dict] = MOD_FIELDS) -> Iterator[dict]:
+		"""
+		Like get_mods, but the response is decoded while it is received and only the given fields are kept
+
+		:raises requests.RequestException:
+		:raises ValueError: if the response isn't valid json
+		"""
+		return self._iter_data('cf:/v1/mods', f'{self.base_url}/v1/mods', {"modIds": mod_ids}, fields)
+
+	def iter_files(self, file_ids: List[int], fields: Optional[dict] = FILE_FIELDS) -> Iterator[dict]:
+		"""
+		Like get_files, but the response is decoded while it is received and only the given fields are kept
+
+		:raises requests.RequestException:
+		:raises ValueError: if the response isn't valid json
+		"""
+		return self._iter_data('cf:/v1/mods/files', f'{self.base_url}/v1/mods/files', {"fileIds": file_ids}, fields)
 
 
 class ModpackIndexApi:
@@ -74,8 +250,11 @@ class ModpackIndexApi:
 
 	base_url: str = "https://www.modpackindex.com/api"
 
-	def __init__(self):
-		pass
+	def __init__(self, controller: AdaptiveController = None):
+		"""
+		:param controller: controls the request rate and retries, can be shared with other apis
+		"""
+		self.controller = controller if controller else AdaptiveController()
 
 	def _get_standard_headers(self) -> dict:
 		return {
@@ -83,10 +262,10 @@ class ModpackIndexApi:
 		}
 
 	def get_mod(self, mod_id: int) -> Response:
-		return requests.get(f'{self.base_url}/v1/mod/{mod_id}', headers=self._get_standard_headers(), timeout=5)
+		return self.controller.request('mpi:/v1/mod/{id}', 'GET', f'{self.base_url}/v1/mod/{mod_id}', headers=self._get_standard_headers(), timeout=5)
 
 	def find_mods(self, query: dict) -> Response:
-		return requests.get(f'{self.base_url}/v1/mods', headers=self._get_standard_headers(), params=query, timeout=5)
+		return self.controller.request('mpi:/v1/mods', 'GET', f'{self.base_url}/v1/mods', headers=self._get_standard_headers(), params=query, timeout=5)
 
 	def find_mods_by_name(self, name: str) -> Response:
 		query = {
@@ -98,13 +277,64 @@ class ModpackIndexApi:
 	def get_mod_dependents(self, mod_id: int) -> Response:
 		"""Returns the mod-packs that include this mod"""
 		query = {'limit': '100', 'page': '1'}
-		return requests.get(f'{self.base_url}/v1/mod/{mod_id}/modpacks', headers=self._get_standard_headers(), params=query, timeout=5)
+		return self.controller.request('mpi:/v1/mod/{id}/modpacks', 'GET', f'{self.base_url}/v1/mod/{mod_id}/modpacks', headers=self._get_standard_headers(), params=query, timeout=5)
 
 	def get_modpack(self, modpack_id: int) -> Response:
-		return requests.get(f'{self.base_url}/v1/modpack/{modpack_id}', headers=self._get_standard_headers(), timeout=5)
+		return self.controller.request('mpi:/v1/modpack/{id}', 'GET', f'{self.base_url}/v1/modpack/{modpack_id}', headers=self._get_standard_headers(), timeout=5)
 
 	def get_modpack_dependencies(self, modpack_id: int) -> Response:
-		return requests.get(f'{self.base_url}/v1/modpack/{modpack_id}/mods', headers=self._get_standard_headers(), timeout=5)
+		return self.controller.request('mpi:/v1/modpack/{id}/mods', 'GET', f'{self.base_url}/v1/modpack/{modpack_id}/mods', headers=self._get_standard_headers(), timeout=5)
+
+
+class ModIdMappingStore:
+	"""
+	Persistent CurseForge -> ModpackIndex mod id mapping
+
+	The mapping almost never changes, thus it's cached for a long time.
+	Mods that couldn't be found on the ModpackIndex are cached as well (negative result), but they expire sooner.
+	"""
+
+	def __init__(self, db_url: str = "sqlite:///api_cache.db", ttl: float = 30 * 86400, negative_ttl: float = 86400):
+		"""
+		:param db_url: SQLite, PostgreSQL or MySQL
+		:param ttl: seconds until a found mapping has to be refreshed
+		:param negative_ttl: seconds until a mod that wasn't found is looked up again
+		"""
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.db: Database = db_util.connect(db_url)
+		self._init_db()
+
+	def close(self):
+		self.db.close()
+
+	def _init_db(self):
+		db = self.db
+		if not db.has_table('mpi_mod_id'):
+			table: Table = db.create_table('mpi_mod_id', primary_id='cf_mod_id', primary_type=db.types.integer, primary_increment=False)
+			table.create_column('mpi_mod_id', db.types.integer)
+			table.create_column('timestamp', db.types.integer)
+
+	def get(self, cf_mod_id: int) -> Tuple[bool, Optional[int]]:
+		"""
+		:return: whether a valid (not expired) entry was found and the ModpackIndex mod id, None for cached negative results
+		"""
+		row = self.db['mpi_mod_id'].find_one(cf_mod_id=cf_mod_id)
+		if row:
+			ttl = self.ttl if row['mpi_mod_id'] is not None else self.negative_ttl
+			if time.time() - row['timestamp'] < ttl:
+				metrics.inc("cache_requests_total", cache="mpi_mod_id", result="hit")
+				return True, row['mpi_mod_id']
+		metrics.inc("cache_requests_total", cache="mpi_mod_id", result="miss")
+		return False, None
+
+	def put(self, cf_mod_id: int, mpi_mod_id: Optional[int]):
+		self.put_many({cf_mod_id: mpi_mod_id})
+
+	def put_many(self, mapping: Dict[int, Optional[int]]):
+		timestamp = int(time.time())
+		rows = [dict(cf_mod_id=cf_mod_id, mpi_mod_id=mpi_mod_id, timestamp=timestamp) for cf_mod_id, mpi_mod_id in mapping.items()]
+		self.db['mpi_mod_id'].upsert_many(rows, ['cf_mod_id'])
 
 
 class ApiHelper:
@@ -112,10 +342,23 @@ class ApiHelper:
 
 	cf_api: CFCoreApi = None
 	mpi_api: ModpackIndexApi = None
+	mod_id_store: Optional[ModIdMappingStore] = None
+	controller: AdaptiveController = None
+
+	def __init__(self, cf_api_key, mod_id_store_db_url: Optional[str] = "sqlite:///api_cache.db"):
+		"""
+		:param cf_api_key:
+		:param mod_id_store_db_url: url of the db that persists the CF -> ModpackIndex mod id mapping, None disables the persistent mapping
+		"""
+		self.controller = AdaptiveController()
+		self.cf_api = CFCoreApi(cf_api_key, self.controller)
+		self.mpi_api = ModpackIndexApi(self.controller)
+		if mod_id_store_db_url:
+			self.mod_id_store = ModIdMappingStore(mod_id_store_db_url)
 
-	def __init__(self, cf_api_key):
-		self.cf_api = CFCoreApi(cf_api_key)
-		self.mpi_api = ModpackIndexApi()
+	def close(self):
+		if self.mod_id_store:
+			self.mod_id_store.close()
 
 	def get_cf_modpack_ids(self, mpi_mod_id) -> Optional[List[int]]:
 		response = self.mpi_api.get_mod_dependents(mpi_mod_id)  # TODO: handle pagination
@@ -128,18 +371,50 @@ class ApiHelper:
 				return modpack_ids
 		return None
 
-	def get_mpi_mod_id(self, cf_mod_id: int, cf_mod_name: str) -> Optional[int]:
+	def get_mpi_mod_id(self, cf_mod_id: int, cf_mod_name: str, refresh: bool = False) -> Optional[int]:
+		"""
+		:param cf_mod_id:
+		:param cf_mod_name: used to search for the mod if the mapping isn't cached
+		:param refresh: ignore the cached mapping
+		:return: ModpackIndex mod id
+		"""
+		if self.mod_id_store and not refresh:
+			found, mpi_mod_id = self.mod_id_store.get(cf_mod_id)
+			if found:
+				return mpi_mod_id
+
 		response = self.mpi_api.find_mods_by_name(cf_mod_name)
 		if response:
 			result = response.json()
 			# we don't care about pagination
 			# if the mod isn't in the first 100 entries, we can assume it can't be found
-			if len(result['data']) > 0:
-				for mod in result['data']:
-					if mod['curse_info']['curse_id'] == cf_mod_id:
-						return mod['id']
+			mapping = {mod['curse_info']['curse_id']: mod['id'] for mod in result['data']}
+			mpi_mod_id = mapping.get(cf_mod_id, None)
+			if self.mod_id_store:
+				# remember every mod of the search result, other tracked mods might be among them
+				mapping[cf_mod_id] = mpi_mod_id
+				self.mod_id_store.put_many(mapping)
+			return mpi_mod_id
 		return None
 
+	def warm_up_mpi_mod_ids(self, mods: Dict[int, str]) -> int:
+		"""
+		Fill the persistent mod id mapping for all given mods, so following lookups don't need a search request
+
+		:param mods: CF mod id -> CF mod name
+		:return: number of search requests that were necessary
+		"""
+		if not self.mod_id_store:
+			return 0
+
+		requests_made = 0
+		for cf_mod_id, cf_mod_name in mods.items():
+			found, _ = self.mod_id_store.get(cf_mod_id)
+			if not found:
+				self.get_mpi_mod_id(cf_mod_id, cf_mod_name, refresh=True)
+				requests_made += 1
+		return requests_made
+
 	def get_mod_dependents(self, cf_mod_id: int, cf_mod_name: str) -> Optional[List[int]]:
 		mpi_mod_id = self.get_mpi_mod_id(cf_mod_id, cf_mod_name)
 		if mpi_mod_id:
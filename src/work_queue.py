@@ -0,0 +1,264 @@
+# lease based work queue stored in the mod stats db, several workers (processes or nodes sharing the db) pull the items of a run
+#
+# A worker claims an item by taking a lease on it and renews the lease with heartbeats while the item is processed.
+# The items of crashed or stuck workers are claimed again once their lease expired, thus processing an item has to be
+# idempotent (e.g. the save handler upserts the snapshots of a shared run). Completing an item is idempotent as well,
+# a worker that lost its lease can still complete the item.
+import json
+import threading
+import time
+import uuid
+from enum import unique, IntEnum
+from typing import Optional, List, Dict, Iterable, NamedTuple, Tuple
+
+from dataset import Database
+from sqlalchemy.engine import make_url
+
+from metrics import metrics
+
+TABLE_NAME = "work_item"
+
+LEASE_DURATION = 300  # seconds a claimed item is leased to a worker without a heartbeat
+MAX_ATTEMPTS = 3  # claims of an item until it is marked as failed
+
+# the claim and enqueue statements use ON CONFLICT and an UPDATE that selects from its own table, which MySQL rejects
+SUPPORTED_BACKENDS = ('sqlite', 'postgresql')
+
+
+@unique
+class ItemState(IntEnum):
+	PENDING = 0,
+	LEASED = 1,
+	DONE = 2,
+	FAILED = 3
+
+
+class WorkItem(NamedTuple):
+	id: int
+	run: int
+	kind: str
+	key: str
+	project_id: Optional[int]  # tracked project the item belongs to
+	payload: dict
+	attempts: int
+	lease_token: str
+
+
+def is_supported_db_url(db_url: str) -> bool:
+	return make_url(db_url).get_backend_name() in SUPPORTED_BACKENDS
+
+
+class WorkQueue:
+
+	def __init__(self, db: Database, worker_id: Optional[str] = None, lease_duration: float = LEASE_DURATION, max_attempts: int = MAX_ATTEMPTS):
+		"""
+		:param db: the queue shares the db (and thus the transactions) with the save handler, completing an item can be committed with its data
+		:param worker_id: name of the worker in the lease of its items, default: random
+		:param lease_duration: seconds until the lease of an item expires without a heartbeat
+		:param max_attempts: claims of an item until it is marked as failed
+		"""
+		if db.engine.dialect.name not in SUPPORTED_BACKENDS:
+			raise ValueError(f"the work queue doesn't support {db.engine.dialect.name} databases, use SQLite or PostgreSQL")
+		self.db = db
+		self.worker_id = worker_id or uuid.uuid4().hex[:12]
+		self.lease_duration = lease_duration
+		self.max_attempts = max_attempts
+		self._init_db()
+
+	def _init_db(self):
+		db = self.db
+		if not db.has_table(TABLE_NAME):
+			table = db.create_table(TABLE_NAME)
+			table.create_column('run', db.types.integer)  # timestamp of the run
+			table.create_column('kind', db.types.string)
+			table.create_column('key', db.types.string)  # unique per run and kind, enqueuing an item twice is a noop
+			table.create_column('project_id', db.types.integer)
+			table.create_column('payload', db.types.text)  # json
+			table.create_column('state', db.types.integer)
+			table.create_column('worker', db.types.string)
+			table.create_column('lease_token', db.types.string)
+			table.create_column('lease_expires', db.types.float)
+			table.create_column('attempts', db.types.integer)
+			table.create_column('error', db.types.text)
+			table.create_column('updated', db.types.float)
+			table.create_index(['run', 'kind', 'key'], unique=True)
+			table.create_index(['run', 'state'])
+
+	def _execute(self, query: str, **params):
+		self.db.begin()
+		try:
+			self.db.query(query, **params)
+		except Exception:
+			self.db.rollback()
+			raise
+		self.db.commit()
+
+	def enqueue(self, run: int, items: Iterable[Tuple[str, str, Optional[int], dict]]) -> int:
+		"""
+		Add the items that aren't queued yet, within a transaction of the caller they are only visible to other workers after its commit
+
+		:param run: timestamp of the run
+		:param items: (kind, key, project id, payload)
+		:return: number of added items, items that were already queued aren't counted
+		"""
+		count = 0
+		now = time.time()
+		self.db.begin()
+		try:
+			for kind, key, project_id, payload in items:
+				result = self.db.query(f"""
+				INSERT INTO {TABLE_NAME} (run, kind, key, project_id, payload, state, attempts, updated)
+				VALUES (:run, :kind, :key, :project_id, :payload, :state, 0, :now)
+				ON CONFLICT (run, kind, key) DO NOTHING
+				""", run=run, kind=kind, key=key, project_id=project_id, payload=json.dumps(payload), state=ItemState.PENDING.value, now=now)
+				count += max(result.result_proxy.rowcount, 0)
+		except Exception:
+			self.db.rollback()
+			raise
+		self.db.commit()
+		return count
+
+	def claim(self, run: int) -> Optional[WorkItem]:
+		"""
+		Lease the oldest pending item of the run (or an item whose lease expired), must not be called within a transaction
+
+		:return: None if there is no claimable item
+		"""
+		now = time.time()
+		token = uuid.uuid4().hex
+		claimable = "(state = :pending OR (state = :leased AND lease_expires < :now)) AND attempts < :max_attempts"
+		self.db.begin()
+		try:
+			# the items of expired leases that were attempted too often are given up
+			self.db.query(f"""
+			UPDATE {TABLE_NAME} SET state = :failed, error = 'lease expired', updated = :now
+				WHERE run = :run AND state = :leased AND lease_expires < :now AND attempts >= :max_attempts
+			""", run=run, failed=ItemState.FAILED.value, leased=ItemState.LEASED.value, now=now, max_attempts=self.max_attempts)
+			# a single statement, the condition is repeated in the outer WHERE so that concurrent claims of the same item can't both win
+			self.db.query(f"""
+			UPDATE {TABLE_NAME} SET state = :leased, worker = :worker, lease_token = :token, lease_expires = :expires, attempts = attempts + 1, updated = :now
+				WHERE id = (SELECT id FROM {TABLE_NAME} WHERE run = :run AND {claimable} ORDER BY id LIMIT 1) AND {claimable}
+			""", run=run, pending=ItemState.PENDING.value, leased=ItemState.LEASED.value, worker=self.worker_id, token=token,
+				expires=now + self.lease_duration, now=now, max_attempts=self.max_attempts)
+			row = self.db[TABLE_NAME].find_one(lease_token=token)
+		except Exception:
+			self.db.rollback()
+			raise
+		self.db.commit()
+
+		if not row:
+			return None
+		metrics.inc("work_items_total", kind=row['kind'], result="claimed")
+		return WorkItem(row['id'], row['run'], row['kind'], row['key'], row['project_id'], json.loads(row['payload']), row['attempts'], token)
+
+	def heartbeat(self, items: Iterable[WorkItem]) -> List[WorkItem]:
+		"""
+		Renew the leases of the items
+
+		:return: the items whose lease was lost (e.g. after a long pause it expired and another worker claimed the item)
+		"""
+		lost = []
+		expires = time.time() + self.lease_duration
+		self.db.begin()
+		try:
+			for item in items:
+				self.db.query(f"""
+				UPDATE {TABLE_NAME} SET lease_expires = :expires WHERE id = :id AND state = :leased AND lease_token = :token
+				""", id=item.id, token=item.lease_token, leased=ItemState.LEASED.value, expires=expires)
+				if not self.db[TABLE_NAME].find_one(id=item.id, lease_token=item.lease_token, state=ItemState.LEASED.value):
+					lost.append(item)
+		except Exception:
+			self.db.rollback()
+			raise
+		self.db.commit()
+		return lost
+
+	def complete(self, item: WorkItem):
+		"""
+		Mark the item as done, completing it again (e.g. by a worker that lost its lease) is a noop
+
+		Within a transaction of the caller the item is completed atomically with the data that was saved for it.
+		"""
+		self._execute(f"""
+		UPDATE {TABLE_NAME} SET state = :done, lease_expires = NULL, error = NULL, updated = :now WHERE id = :id AND state != :done
+		""", id=item.id, done=ItemState.DONE.value, now=time.time())
+		metrics.inc("work_items_total", kind=item.kind, result="done")
+
+	def fail(self, item: WorkItem, error: str):
+		"""
+		Release the item for a retry, or mark it as failed once it was attempted max_attempts times
+
+		Only the lease holder can release the item, must not be called within a transaction that is rolled back.
+		"""
+		state = ItemState.FAILED if item.attempts >= self.max_attempts else ItemState.PENDING
+		self._execute(f"""
+		UPDATE {TABLE_NAME} SET state = :state, lease_expires = NULL, error = :error, updated = :now
+			WHERE id = :id AND state = :leased AND lease_token = :token
+		""", id=item.id, token=item.lease_token, state=state.value, leased=ItemState.LEASED.value, error=error, now=time.time())
+		metrics.inc("work_items_total", kind=item.kind, result=state.name.lower())
+
+	def get_counts(self, run: int) -> Dict[ItemState, int]:
+		"""
+		:return: number of items of the run by state
+		"""
+		counts = {state: 0 for state in ItemState}
+		for row in self.db.query(f"SELECT state, COUNT(*) AS count FROM {TABLE_NAME} WHERE run = :run GROUP BY state", run=run):
+			counts[ItemState(row['state'])] = row['count']
+		return counts
+
+	def is_drained(self, run: int) -> bool:
+		"""whether all items of the run are done or failed, i.e. no worker can get new items of the run"""
+		counts = self.get_counts(run)
+		return counts[ItemState.PENDING] == 0 and counts[ItemState.LEASED] == 0
+
+	def get_failed_project_ids(self, run: int) -> List[int]:
+		"""
+		:return: tracked projects with failed items in the run, i.e. the data of the project is incomplete
+		"""
+		rows = self.db.query(f"SELECT DISTINCT project_id FROM {TABLE_NAME} WHERE run = :run AND state = :failed", run=run, failed=ItemState.FAILED.value)
+		return [row['project_id'] for row in rows]
+
+
+class Heartbeat:
+	"""
+	Background thread that renews the leases of the items that are currently processed by the worker
+
+	The thread uses its own connection of the db (dataset connections are per thread), thus it doesn't interfere with the
+	transaction of the worker. Heartbeats are sent at a third of the lease duration.
+	"""
+
+	def __init__(self, queue: WorkQueue, logger):
+		self.queue = queue
+		self.logger = logger
+		self._items: Dict[int, WorkItem] = {}
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, name="WorkQueueHeartbeat", daemon=True)
+
+	def __enter__(self):
+		self._thread.start()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self._stop.set()
+		self._thread.join()
+
+	def add(self, item: WorkItem):
+		with self._lock:
+			self._items[item.id] = item
+
+	def remove(self, item: WorkItem):
+		with self._lock:
+			self._items.pop(item.id, None)
+
+	def _run(self):
+		while not self._stop.wait(self.queue.lease_duration / 3):
+			with self._lock:
+				items = list(self._items.values())
+			if not items:
+				continue
+			try:
+				for item in self.queue.heartbeat(items):
+					self.logger.warning(f"lost the lease of work item <{item.kind}:{item.key}>, another worker might process it as well")
+			except Exception as error:
+				self.logger.warning(f"failed to renew the work item leases -> {error}")